@@ -0,0 +1,3 @@
+"""
+benchmarks -- FastTQ性能基准：入队、出队和端到端吞吐，结果以JSON Lines输出，便于版本间对比
+"""
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+"""
+用法：
+    python -m benchmarks --client fasttq.local.LocalClient --url local://127.0.0.1:6399 --out bench.jsonl
+    python -m benchmarks --url redis://localhost:6379/15 --scenario e2e --workers 1,4,8 --chunksize 1,100
+    python -m benchmarks --client fasttq.sharded.ShardedRedisClient --url redis://localhost:6379/15,redis://localhost:6380/15
+"""
+
+import argparse
+import json
+import sys
+
+from fasttq.worker import Assignor
+
+from .suite import SCENARIOS, run
+
+def ints(s:str):
+    return [int(v) for v in s.split(",")]
+
+def main(argv:list = None):
+    parser = argparse.ArgumentParser(prog="benchmarks", description="FastTQ throughput/latency benchmarks")
+    parser.add_argument("--client", default="fasttq.client.RedisClient", help="client class path, as used by client_str")
+    parser.add_argument("--url", default="redis://localhost:6379/15", help="conn_url, the database will be written to")
+    parser.add_argument("--scenario", default=",".join(SCENARIOS), help=f"comma separated: {','.join(SCENARIOS)}")
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument("--payload", type=ints, default=[64, 4096], help="payload sizes in bytes")
+    parser.add_argument("--chunksize", type=ints, default=[1, 100])
+    parser.add_argument("--workers", type=ints, default=[1, 4])
+    parser.add_argument("--topics", type=ints, default=[1, 8])
+    parser.add_argument("--assignor", default="PriorityAll", help=f"comma separated: {','.join(a.name for a in Assignor)}")
+    parser.add_argument("--worker-options", default="{}", help='JSON worker options, e.g. {"blocking": true}')
+    parser.add_argument("--out", default="-", help="JSON Lines output file, - for stdout")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout if args.out=="-" else open(args.out, "a", encoding="utf8")
+    try:
+        for rs in run(args.client, args.url, args.scenario.split(","), args.jobs, args.payload, args.chunksize,
+                      args.workers, args.topics, args.assignor.split(","), json.loads(args.worker_options)):
+            out.write(json.dumps(rs)+"\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+"""
+handlers.py -- 基准测试使用的处理器，必须可以被Worker子进程按模块路径导入
+"""
+
+import time
+import os
+
+# 延迟结果目录，由suite在启动Worker前通过环境变量传给子进程
+RESULTS_ENV = "FASTTQ_BENCH_RESULTS"
+
+# 空处理器：返回 "入队到完成的延迟,完成时间"
+def noop(data:dict, context:dict):
+    done = time.time()
+    return f"{done-data['ts']},{done}"
+
+def collect(topic:str):
+    return {"_result":[]}
+
+# 每个chunk的结果追加到本进程的结果文件，不经过队列，避免结果本身成为待处理的topic
+def record(data:dict, context:dict):
+    if len(context["_result"])<1:
+        return
+    with open(os.path.join(os.environ[RESULTS_ENV], f"{os.getpid()}.txt"), "a", encoding="utf8") as f:
+        f.write("\n".join(context["_result"])+"\n")
+
+# 任务生成函数，count个约payload字节的任务；声明了shard/shards，pending_mp会按分片并行生成
+def generate(topic:str, shard:int = 0, shards:int = 1, count:int = 0, payload:int = 0):
+    pad = "x"*payload
+    return ({"ts":time.time(), "pad":pad} for _ in range(count//shards+(1 if shard<count%shards else 0)))
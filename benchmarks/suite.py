@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+"""
+suite.py -- 基准场景：生产者入队、客户端出队和端到端处理
+"""
+
+from typing import Iterable, List
+from multiprocessing import get_context
+from queue import Empty
+import itertools
+import platform
+import tempfile
+import traceback
+import time
+import sys
+import os
+import psutil
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+import fasttq
+from fasttq import FastQueue
+from fasttq.client import Client, str2func, serialize
+from fasttq.worker import Assignor
+
+from . import handlers
+
+TOPIC = "bench"
+
+def percentile(values:List[float], p:float):
+    if len(values)<1:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values)*p), len(values)-1)]
+
+# 本进程的峰值RSS，以及已回收的子进程（Worker、推送进程）中最大的峰值RSS（MB）。
+# 每个场景在新的进程中运行（见isolate），峰值只包含本场景；Windows没有resource，用psutil的峰值工作集，不统计子进程
+def rss_mb():
+    if resource is None:
+        info = psutil.Process().memory_info()
+        return dict(rss_mb=getattr(info, "peak_wset", info.rss)/1024/1024, children_rss_mb=None)
+    scale = 1024*1024 if sys.platform=="darwin" else 1024
+    return dict(
+        rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale,
+        children_rss_mb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/scale)
+
+def topic_names(topics:int):
+    return [TOPIC] if topics<2 else [f"{TOPIC}#{i}" for i in range(topics)]
+
+def payloads(jobs:int, payload:int):
+    return handlers.generate(None, count=jobs, payload=payload)
+
+def reset(client:Client, topics:int):
+    for topic in topic_names(topics):
+        client.unregister(topic)
+    client.register(TOPIC, handlers.noop, handlers.collect, handlers.record)
+
+def record(scenario:str, params:dict, jobs:int, seconds:float, latencies:List[float] = None):
+    rs = dict(
+        scenario=scenario,
+        version=fasttq.__version__,
+        python=platform.python_version(),
+        ts=time.time(),
+        params=params,
+        jobs=jobs,
+        seconds=seconds,
+        jobs_per_s=jobs/seconds if seconds>0 else None)
+    if latencies is not None:
+        rs.update(
+            p50_ms=None if len(latencies)<1 else percentile(latencies, 0.5)*1000,
+            p99_ms=None if len(latencies)<1 else percentile(latencies, 0.99)*1000)
+    rs.update(rss_mb())
+    return rs
+
+# 生产者：FastQueue.push流式入队
+def bench_enqueue(client:Client, jobs:int, payload:int, chunksize:int, topics:int, **_):
+    reset(client, topics)
+    fq = FastQueue(client)
+    names = topic_names(topics)
+    start = time.perf_counter()
+    for topic in names:
+        fq.push(topic, payloads(jobs//len(names), payload), chunksize=chunksize)
+    seconds = time.perf_counter()-start
+    return record("enqueue", dict(payload=payload, chunksize=chunksize, topics=topics), jobs//len(names)*len(names), seconds)
+
+# 生产者：FastQueue.pending_mp多进程入队
+def bench_enqueue_mp(client:Client, client_str:str, jobs:int, payload:int, chunksize:int, topics:int, workers:int, **_):
+    reset(client, topics)
+    fq = FastQueue(client)
+    for topic in topic_names(topics):
+        fq.jobs(topic)(handlers.generate)
+    start = time.perf_counter()
+    shards = fq.pending_mp(client_str, client.conn_url, chunksize=chunksize, processes=workers, count=jobs//topics, payload=payload)
+    seconds = time.perf_counter()-start
+    rs = record("enqueue_mp", dict(payload=payload, chunksize=chunksize, topics=topics, processes=workers), jobs//topics*topics, seconds)
+    rs["shards"] = shards
+    return rs
+
+# 客户端：push_topic/get_jobs往返，延迟为单次get_jobs调用耗时
+def bench_client(client:Client, jobs:int, payload:int, chunksize:int, topics:int, **_):
+    reset(client, topics)
+    names = topic_names(topics)
+    chunk = [serialize(data) for data in payloads(chunksize, payload)]
+    rounds = max(jobs//chunksize//len(names), 1)
+
+    start = time.perf_counter()
+    for topic in names:
+        for _ in range(rounds):
+            client.push_topic(topic, chunk)
+    push_seconds = time.perf_counter()-start
+
+    latencies = []
+    start = time.perf_counter()
+    for topic in names:
+        while True:
+            t = time.perf_counter()
+            rs = client.get_jobs(topic, chunksize)
+            latencies.append(time.perf_counter()-t)
+            if len(rs)<1:
+                break
+    pop_seconds = time.perf_counter()-start
+
+    total = rounds*chunksize*len(names)
+    params = dict(payload=payload, chunksize=chunksize, topics=topics)
+    return [
+        record("client_push", params, total, push_seconds),
+        record("client_pop", params, total, pop_seconds, latencies),
+    ]
+
+# 端到端：入队后启动workers个Worker处理完所有任务，延迟为入队到处理完成
+def bench_e2e(client:Client, client_str:str, jobs:int, payload:int, chunksize:int, topics:int, workers:int, assignor:str, worker_options:dict = None, **_):
+    reset(client, topics)
+    fq = FastQueue(client)
+    names = topic_names(topics)
+    for topic in names:
+        fq.push(topic, payloads(jobs//len(names), payload), chunksize=chunksize)
+
+    latencies, finished = [], time.time()
+    with tempfile.TemporaryDirectory(prefix="fasttq-bench-") as results:
+        os.environ[handlers.RESULTS_ENV] = results
+        start = time.time()
+        fq.start_workers(client_str, client.conn_url, workers, Assignor[assignor], chunksize, retrys=5, retry_delay=0.05, **(worker_options or {}))
+        for name in os.listdir(results):
+            with open(os.path.join(results, name), encoding="utf8") as f:
+                for line in f:
+                    latency, done = (float(v) for v in line.split(","))
+                    latencies.append(latency)
+                    finished = max(finished, done)
+
+    params = dict(payload=payload, chunksize=chunksize, topics=topics, workers=workers, assignor=assignor, **(worker_options or {}))
+    return record("e2e", params, len(latencies), finished-start, latencies)
+
+SCENARIOS = dict(enqueue=bench_enqueue, enqueue_mp=bench_enqueue_mp, client=bench_client, e2e=bench_e2e)
+
+def run_scenario(scenario:str, kwargs:dict, outbox):
+    try:
+        client = str2func(kwargs["client_str"])(kwargs["conn_url"])
+        outbox.put((True, SCENARIOS[scenario](client=client, **kwargs)))
+    except BaseException:
+        outbox.put((False, traceback.format_exc()))
+
+# 在新启动（spawn）的进程中运行一个场景，ru_maxrss是进程生命周期内的峰值，不能跨场景共用一个进程
+def isolate(scenario:str, **kwargs):
+    ctx = get_context("spawn")
+    outbox = ctx.Queue()
+    process = ctx.Process(target=run_scenario, args=(scenario, kwargs, outbox))
+    process.start()
+    while True:
+        try:
+            ok, rs = outbox.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                ok, rs = False, f"scenario {scenario} exited with code {process.exitcode}"
+                break
+    process.join()
+    if not ok:
+        raise RuntimeError(rs)
+    return rs
+
+# 按参数网格运行场景，逐条产出结果
+def run(client_str:str, conn_url:str, scenarios:Iterable[str], jobs:int, sizes:List[int], chunksizes:List[int], workers:List[int], topics:List[int], assignors:List[str], worker_options:dict = None):
+    # 本进程持有的客户端保证LocalClient的存储在各场景之间一直存在；场景进程使用它的conn_url（含LocalClient生成的authkey）
+    client = str2func(client_str)(conn_url)
+    for scenario in scenarios:
+        grid = itertools.product(sizes, chunksizes, workers, topics, assignors)
+        seen = set()
+        for payload, chunksize, worker, topic, assignor in grid:
+            # 只有端到端和多进程入队场景与worker数有关，只有端到端场景与Assignor有关
+            key = (payload, chunksize, worker if scenario in ("e2e", "enqueue_mp") else None, topic, assignor if scenario=="e2e" else None)
+            if key in seen:
+                continue
+            seen.add(key)
+            rs = isolate(
+                scenario, client_str=client_str, conn_url=client.conn_url, jobs=jobs, payload=payload, chunksize=chunksize,
+                topics=topic, workers=worker, assignor=assignor, worker_options=worker_options)
+            yield from (rs if isinstance(rs, list) else [rs])
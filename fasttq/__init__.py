@@ -1,5 +1,12 @@
 from .client import Client, RedisClient, serialize
+from .local import LocalClient
+from .sharded import ShardedRedisClient
+from .codec import Codec, JsonCodec, BinaryCodec, set_codec
 from .queue import FastQueue
 from .worker import Worker
+from .aio import AsyncWorker
+from .metrics import Metrics, Sink, MemorySink, ClientSink, TextSink
+from .results import ResultSink, TopicSink, ResultHandle, JobError
+from .blob import BlobStore, FileBlobStore, SharedMemoryBlobStore, ClientBlobStore, BlobCodec
 
 __version__ = "1.0.8"
\ No newline at end of file
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/06/18 09:42:16
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+aio.py -- 基于asyncio的Worker，单进程内并发执行大量IO密集型任务
+"""
+
+from typing import List
+from functools import partial
+import asyncio
+import inspect
+import math
+import time
+
+from .client import Client, RedisClient, POP_SCRIPT, to_str, unserialize
+from .worker import Worker, Assignor, BatchHandler
+from .results import ResultSink
+from .blob import load_blob
+
+class AsyncClient:
+    """通用异步适配：在线程池中调用同步客户端的方法"""
+
+    def __init__(self, client:Client):
+        self.client = client
+
+    def __getattr__(self, name:str):
+        func = getattr(self.client, name)
+        async def call(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+        return call
+
+    async def close(self):
+        pass
+
+class AsyncRedisClient:
+    """基于redis.asyncio的异步客户端，只包含AsyncWorker需要的出队和结果推送"""
+
+    def __init__(self, client:RedisClient):
+        from redis import asyncio as aioredis
+        self.client = client
+        self.conn = aioredis.from_url(client.conn_url)
+        self._pop_script = self.conn.register_script(POP_SCRIPT)
+
+    async def priority(self, topic:str):
+        topic = to_str(topic).partition("#")[0]
+        if topic not in self.client._priorities:
+            self.client._priorities[topic] = await self.conn.zscore(self.client.default_topics_header, topic) or 0
+        return self.client._priorities[topic]
+
+    async def get_topics(self, withscores:bool = False):
+        return await self.conn.zrevrange(self.client.default_active_header, 0, -1, withscores=withscores)
+
+    async def get_topics_registered(self):
+        return await self.conn.zrevrange(self.client.default_topics_header, 0, -1)
+
+    async def get_jobs(self, topic:str, chunksize:int = 10):
+        return await self._pop_script(
+            keys=[self.client.jobs_key(topic), self.client.default_active_header],
+            args=[max(chunksize, 1), to_str(topic)])
+
+    async def wait_jobs(self, topics:List[str], chunksize:int = 1, timeout:float = 1.0):
+        if len(topics)<1:
+            await asyncio.sleep(timeout)
+            return None, []
+        # Redis<6.0的阻塞超时只支持整数秒，服务端版本号与同步客户端共用缓存
+        with self.client.connect() as conn:
+            version = await asyncio.get_running_loop().run_in_executor(None, self.client.server_version, conn)
+        timeout = timeout if version >= (6, 0) else max(math.ceil(timeout), 1)
+        rs = await self.conn.brpop([self.client.jobs_key(topic) for topic in topics], timeout)
+        if rs is None:
+            return None, []
+        key, job = rs
+        topic = self.client.key2topic(key)
+        jobs = [job]
+        if chunksize>1:
+            jobs.extend(await self.get_jobs(topic, chunksize-1))
+        return topic, jobs
+
+    async def push_topic(self, topic:str, jobs:List[str]):
+        if len(jobs)<1:
+            return 0
+        priority = await self.priority(topic)
+        async with self.conn.pipeline(transaction=True) as pipe:
+            pipe.lpush(self.client.jobs_key(topic), *jobs)
+            pipe.zadd(self.client.default_active_header, {to_str(topic):priority})
+            return (await pipe.execute())[0]
+
+    async def push_topics(self, jobs:dict):
+        return {topic:await self.push_topic(topic, _jobs) for topic, _jobs in jobs.items()}
+
+    async def close(self):
+        await self.conn.close()
+
+class AsyncWorker(Worker):
+    """
+    异步Worker：处理器可以是 async def，单进程最多同时执行 concurrency 个任务。
+    出队按剩余并发额度批量进行，每个chunk各自调用after并推送结果，before按context_cache缓存。
+    暂不支持可靠模式；多个chunk并发执行，无法保证topic@的顺序，topic@只由同步Worker独占处理。
+    """
+
+    def __init__(self, client_str:str, conn_url:str, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 1, retrys:int = 10, retry_delay:int = 1, concurrency:int = 100, **options):
+        super().__init__(client_str, conn_url, assignor, chunksize, retrys, retry_delay, **options)
+        if self.reliable:
+            raise ValueError("AsyncWorker does not support reliable mode")
+        self.concurrency = max(concurrency, 1)
+        self.inflight = 0
+        # 第一个执行失败的chunk的异常，run()停止出队并在其他chunk结束后重新抛出
+        self._error:BaseException = None
+
+    async def run_job(self, topic:bytes, handle, job:dict, context:dict, semaphore:asyncio.Semaphore):
+        data, retrys, retry_delay = job["data"], int(job["retrys"]), float(job["retry_delay"])
+        error = None
+        for retry_times in range(1, retrys+1):
+            start = time.perf_counter()
+            try:
+                async with semaphore:
+                    rs = handle(data, context)
+                    if inspect.isawaitable(rs):
+                        rs = await rs
+                self.metrics.observe("handler_seconds", topic, time.perf_counter()-start)
+                self.metrics.incr("succeeded", topic)
+                return True, rs
+            except Exception as e:
+                self.metrics.observe("handler_seconds", topic, time.perf_counter()-start)
+                error = e
+                if retry_times<retrys:
+                    self.metrics.incr("retried", topic)
+                    if self.retry_backoff:
+                        return None, error
+                    await asyncio.sleep(retry_delay)
+        self.metrics.incr("failed", topic)
+        return False, error
+
+    # 批处理器可以是 async def
+    async def run_batch_async(self, topic:bytes, handle:BatchHandler, jobs:list, context:dict, semaphore:asyncio.Semaphore):
+        start = time.perf_counter()
+        try:
+            async with semaphore:
+                results, error = handle([job["data"] for job in jobs], context), None
+                if inspect.isawaitable(results):
+                    results = await results
+        except Exception as e:
+            results, error = None, e
+        self.metrics.observe("handler_seconds", topic, time.perf_counter()-start)
+        return self.settle_batch(topic, jobs, results, error)
+
+    async def run_chunk(self, aclient, topic:bytes, jobs:list, semaphore:asyncio.Semaphore):
+        context, teardown = None, None
+        try:
+            handle, before, after, teardown = self.load_handlers(topic)
+            context = self.stream_results(self.acquire_context(topic, before, teardown), after)
+            if isinstance(handle, BatchHandler):
+                results = await self.run_batch_async(topic, handle, jobs, context, semaphore)
+            else:
+                results = await asyncio.gather(*(self.run_job(topic, handle, job, context, semaphore) for job in jobs))
+            if isinstance(context["_result"], ResultSink):
+                # 结果每满result_flush_size个写入下游，在线程池中执行，不阻塞事件循环
+                await asyncio.get_running_loop().run_in_executor(None, context["_result"].extend, [rs for ok, rs in results if ok])
+            else:
+                context["_result"].extend(rs for ok, rs in results if ok)
+            for job, (ok, rs) in zip(jobs, results):
+                if "reply" in job and ok is not None:
+                    self.add_reply(job, ok, rs)
+            # 需要重试的任务延迟重新入队，在线程池中执行，不阻塞事件循环
+            retries = [job for job, (ok, _) in zip(jobs, results) if ok is None]
+            if len(retries)>0:
+                await asyncio.get_running_loop().run_in_executor(None, self.requeue_jobs, topic, retries)
+
+            start = time.perf_counter()
+            results = context["_result"]
+            if after is not None:
+                after(jobs[-1]["data"], context)
+            elif "topic" in context and not isinstance(results, ResultSink):
+                await aclient.push_topic(context["topic"], results)
+            elif "topics" in context:
+                await aclient.push_topics(context["topics"])
+            if isinstance(results, ResultSink):
+                await asyncio.get_running_loop().run_in_executor(None, results.flush)
+            if len(self._replies)>0:
+                await asyncio.get_running_loop().run_in_executor(None, self.push_replies)
+            self.metrics.observe("push_seconds", topic, time.perf_counter()-start)
+            self.processed += len(jobs)
+        finally:
+            self.inflight -= len(jobs)
+            # 出错时同样归还context，被淘汰的context在最后一个使用它的chunk结束后teardown
+            if context is not None:
+                self.contexts.release(topic, context, teardown)
+
+    def spawn(self, aclient, topic:bytes, jobs:list, semaphore:asyncio.Semaphore, tasks:set):
+        self.metrics.incr("dequeued", topic, len(jobs))
+        self.limiter.consume(topic, len(jobs))
+        self.serve(topic)
+        self.inflight += len(jobs)
+        task = asyncio.ensure_future(self.run_chunk(aclient, topic, [load_blob(unserialize(job), self.client) for job in jobs], semaphore))
+        tasks.add(task)
+        task.add_done_callback(partial(self.done, tasks))
+
+    # 取回chunk的异常，和同步Worker一样以异常退出，由Supervisor按非0退出码重启
+    def done(self, tasks:set, task:asyncio.Task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None and self._error is None:
+            self._error = task.exception()
+
+    async def run(self):
+        aclient = self.client.aio()
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        retry_times = 0
+        await loop.run_in_executor(None, self.refresh_handlers)
+        try:
+            while not self._stop and self._error is None and retry_times<self.retrys:
+                if time.time()-self._handlers_checked_at>=self.handlers_check_interval:
+                    await loop.run_in_executor(None, self.check_handlers)
+                if time.time()>=self._promote_at:
+                    await loop.run_in_executor(None, self.promote_delayed)
+                if time.time()>=self._heartbeat_at:
+                    await loop.run_in_executor(None, self.heartbeat)
+                if self.should_recycle():
+                    # 达到max_jobs/max_rss_mb后不再出队，已出队的chunk执行完后退出，由Supervisor重启
+                    self.recycled = True
+                    break
+                loaded, throttled = 0, False
+                free = self.concurrency-self.inflight
+                if free>0:
+                    # topic@只由取得租约的同步Worker处理
+                    topics = [(topic, score) for topic, score in await aclient.get_topics(withscores=True) if not to_str(topic).endswith("@")]
+                    if len(self.limiter.limits)>0:
+                        # 一次往返批量申请限速topic的令牌，没有令牌的topic本轮跳过
+                        allowed = await loop.run_in_executor(None, self.limiter.acquire, topics, free)
+                        throttled = len(allowed)<len(topics)
+                        topics = allowed
+                    if self.steal_threshold>0:
+                        # 积压检查需要查询队列深度，在线程池中执行
+                        preferred, rest = await loop.run_in_executor(None, self.affine, topics)
+                    else:
+                        preferred, rest = self.affine(topics)
+                    # 依次取空优先的topic，剩余额度按调度器分配
+                    for topic, _ in preferred:
+                        n = self.limiter.clamp(topic, free-loaded)
+                        if n<1:
+                            continue
+                        jobs = await aclient.get_jobs(topic, n)
+                        if len(jobs)>0:
+                            loaded += len(jobs)
+                            self.spawn(aclient, topic, jobs, semaphore, tasks)
+                    plan = self.scheduler.plan(rest, free-loaded)
+                    try:
+                        topic, n = next(plan)
+                        while True:
+                            n = self.limiter.clamp(topic, n)
+                            jobs = await aclient.get_jobs(topic, n) if n>0 else []
+                            if len(jobs)>0:
+                                loaded += len(jobs)
+                                self.spawn(aclient, topic, jobs, semaphore, tasks)
+                            topic, n = plan.send(len(jobs))
+                    except StopIteration:
+                        pass
+
+                if self.metrics.due():
+                    await loop.run_in_executor(None, self.flush_metrics)
+
+                if loaded>0:
+                    retry_times = 0
+                    if self.inflight>=self.concurrency:
+                        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                elif len(tasks)>0:
+                    await asyncio.wait(tasks, timeout=self.retry_delay, return_when=asyncio.FIRST_COMPLETED)
+                elif throttled:
+                    # 等到下一个令牌，不计入重试次数
+                    await asyncio.sleep(min(max(self.limiter.wait, 0.001), self.idle_timeout()))
+                elif self.blocking:
+                    topics = [topic for topic in await aclient.get_topics_registered() if not to_str(topic).endswith("@")]
+                    topic, jobs = await aclient.wait_jobs(topics, self.limiter.clamp_all(topics, self.chunksize if self.assignor.chunked else 1), self.idle_timeout())
+                    if topic is not None:
+                        self.spawn(aclient, topic, jobs, semaphore, tasks)
+                    elif self._delayed_due is None:
+                        break
+                elif self._delayed_due is not None:
+                    # 还有未到期的延迟任务时继续等待，不计入重试次数
+                    await asyncio.sleep(self.idle_timeout())
+                else:
+                    retry_times += 1
+                    await asyncio.sleep(self.retry_delay)
+
+            if len(tasks)>0:
+                await asyncio.wait(tasks)
+            if self._error is not None:
+                raise self._error
+            await loop.run_in_executor(None, self.flush_metrics, True)
+            try:
+                self.contexts.clear()
+            finally:
+                # teardown出错也要完成退出清理
+                await loop.run_in_executor(None, self.release_affinity)
+                await loop.run_in_executor(None, self.limiter.release)
+                await loop.run_in_executor(None, self.client.unreport, self.name)
+                await loop.run_in_executor(None, self.client.delete_metrics, self.name)
+        finally:
+            await aclient.close()
+
+    def work(self):
+        asyncio.run(self.run())
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/07/30 10:05:12
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+blob.py -- 大任务数据的存取凭证（claim check）：超过阈值的payload写入按内容寻址的blob存储，队列中只保留引用
+"""
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Union
+from urllib import parse
+import tempfile
+import hashlib
+import struct
+import mmap
+import time
+import os
+
+from .client import Client, func2str, str2func
+from .codec import BinaryCodec, binary_codec
+
+class BlobStore(ABC):
+    """按内容寻址：key为payload的sha256，相同的payload只存一份"""
+
+    url:str = None
+
+    def key(self, payload:bytes):
+        return hashlib.sha256(payload).hexdigest()
+
+    # 写入payload，已存在时返回False
+    @abstractmethod
+    def put(self, key:str, payload:bytes) -> bool:
+        pass
+
+    # 只读视图，尽量不复制
+    @abstractmethod
+    def get(self, key:str) -> memoryview:
+        pass
+
+    @abstractmethod
+    def delete(self, key:str):
+        pass
+
+class FileBlobStore(BlobStore):
+    """单机：每个blob一个文件，读取时mmap映射，多个Worker共享同一份页缓存。Linux下默认放在内存文件系统/dev/shm"""
+
+    def __init__(self, path:str = None):
+        default = "/dev/shm/fasttq" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "fasttq")
+        self.path = os.path.abspath(path or default)
+        self.url = "file://"+self.path
+        os.makedirs(self.path, exist_ok=True)
+
+    def put(self, key:str, payload:bytes):
+        path = os.path.join(self.path, key)
+        if os.path.exists(path):
+            # 更新修改时间，cleanup按最近一次写入计算过期
+            os.utime(path)
+            return False
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+        return True
+
+    def get(self, key:str):
+        with open(os.path.join(self.path, key), "rb") as f:
+            if os.fstat(f.fileno()).st_size<1:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def delete(self, key:str):
+        try:
+            os.remove(os.path.join(self.path, key))
+            return 1
+        except FileNotFoundError:
+            return 0
+
+    # 删除max_age秒内没有再写入过的blob
+    def cleanup(self, max_age:float = 86400):
+        n, deadline = 0, time.time()-max_age
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.stat().st_mtime<deadline:
+                n += self.delete(entry.name)
+        return n
+
+def attach(name:str, create:bool = False, size:int = 0):
+    # multiprocessing.shared_memory需要Python 3.8，用到时才导入
+    from multiprocessing import shared_memory
+    # blob的生命周期不跟随进程，不交给resource_tracker在进程退出时回收
+    try:
+        return shared_memory.SharedMemory(name, create, size, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name, create, size)
+        if os.name=="posix":
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+# 删除attach打开的共享内存段；Python 3.13以前unlink会向resource_tracker注销，而段在attach时已经注销过
+def remove(shm):
+    if hasattr(shm, "_track") or os.name!="posix":
+        shm.unlink()
+    else:
+        import _posixshmem
+        _posixshmem.shm_unlink(shm._name)
+
+class SharedMemoryBlobStore(BlobStore):
+    """
+    单机：每个blob一段共享内存（8字节长度头 + payload），Worker直接读取共享内存，不经过文件系统（需要Python 3.8）。
+    每个进程最多缓存max_segments个打开的共享内存段，最久未用的先关闭。
+    共享内存段不随创建它的进程退出而回收（不登记到resource_tracker），由使用者负责删除：
+    确定不再需要时调用delete，或像FileBlobStore一样定期调用cleanup(max_age)删除长时间没有再写入的段。
+    """
+
+    # POSIX共享内存段在Linux下对应该目录中的文件，cleanup据此枚举段和写入时间
+    SHM_PATH = "/dev/shm"
+
+    LENGTH = struct.Struct("!Q")
+
+    def __init__(self, prefix:str = "fq", max_segments:int = 64):
+        self.prefix = prefix
+        self.url = "shm://"+prefix
+        self.max_segments = max(max_segments, 1)
+        self._segments = OrderedDict()
+        # 处理器仍持有视图、暂时关闭不了的共享内存段
+        self._closing = []
+
+    def __getstate__(self):
+        return dict(self.__dict__, _segments=OrderedDict(), _closing=[])
+
+    # 关闭共享内存段，还有视图引用它时返回False
+    @staticmethod
+    def close(shm):
+        try:
+            shm.close()
+            return True
+        except BufferError:
+            return False
+
+    # 关闭超出max_segments的最久未用的段，顺带重试之前没能关闭的段
+    def evict(self):
+        self._closing = [shm for shm in self._closing if not self.close(shm)]
+        while len(self._segments)>self.max_segments:
+            _, shm = self._segments.popitem(last=False)
+            if not self.close(shm):
+                self._closing.append(shm)
+
+    # 部分平台共享内存名最长31个字符
+    def name(self, key:str):
+        return f"{self.prefix}{key[:24]}"
+
+    def put(self, key:str, payload:bytes):
+        try:
+            shm = attach(self.name(key), True, self.LENGTH.size+len(payload))
+        except FileExistsError:
+            # 更新修改时间，cleanup按最近一次写入计算过期
+            try:
+                os.utime(os.path.join(self.SHM_PATH, self.name(key)))
+            except OSError:
+                pass
+            return False
+        shm.buf[self.LENGTH.size:self.LENGTH.size+len(payload)] = payload
+        self.LENGTH.pack_into(shm.buf, 0, len(payload))
+        shm.close()
+        return True
+
+    # 打开的共享内存段缓存在进程内，返回的视图引用它，视图释放后才能关闭
+    def get(self, key:str):
+        name = self.name(key)
+        if name in self._segments:
+            self._segments.move_to_end(name)
+        else:
+            self._segments[name] = attach(name)
+            self.evict()
+        buf = self._segments[name].buf
+        return buf[self.LENGTH.size:self.LENGTH.size+self.LENGTH.unpack_from(buf)[0]]
+
+    def delete(self, key:str):
+        return self.unlink(self.name(key))
+
+    # 删除共享内存段，本进程仍打开着的段在视图释放后关闭
+    def unlink(self, name:str):
+        try:
+            shm = self._segments.pop(name, None) or attach(name)
+        except FileNotFoundError:
+            return 0
+        try:
+            remove(shm)
+        except FileNotFoundError:
+            return 0
+        finally:
+            if not self.close(shm):
+                self._closing.append(shm)
+        return 1
+
+    # 删除max_age秒内没有再写入过的段；只有Linux能枚举共享内存段，其他平台返回0
+    def cleanup(self, max_age:float = 86400):
+        if not os.path.isdir(self.SHM_PATH):
+            return 0
+        n, deadline = 0, time.time()-max_age
+        for entry in os.scandir(self.SHM_PATH):
+            if len(entry.name)==len(self.prefix)+24 and entry.name.startswith(self.prefix) and entry.is_file() and entry.stat().st_mtime<deadline:
+                n += self.unlink(entry.name)
+        return n
+
+class ClientBlobStore(BlobStore):
+    """多机：blob存放在任务队列所在的存储中（Client.set_blob/get_blob），ttl秒后过期，重复写入时刷新过期时间"""
+
+    url = "client"
+
+    def __init__(self, client:Client, ttl:float = 86400):
+        self.client_str = func2str(client)
+        self.conn_url = client.conn_url
+        self.ttl = ttl
+        self._client = client
+
+    # 跨进程传递时只传递连接参数，用到时再连接
+    def __getstate__(self):
+        return dict(self.__dict__, _client=None)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = str2func(self.client_str)(self.conn_url)
+        return self._client
+
+    def put(self, key:str, payload:bytes):
+        return self.client.set_blob(key, payload, self.ttl)
+
+    def get(self, key:str):
+        payload = self.client.get_blob(key)
+        if payload is None:
+            raise KeyError(f"blob {key} not found or expired")
+        return memoryview(payload)
+
+    def delete(self, key:str):
+        return self.client.delete_blob(key)
+
+_stores:Dict[str, BlobStore] = {}
+
+# 按引用中的url打开blob存储，"client"表示Worker自己的客户端
+def open_store(url:str, client:Client = None):
+    if url=="client":
+        return ClientBlobStore(client)
+    if url not in _stores:
+        u = parse.urlparse(url)
+        if u.scheme=="file":
+            _stores[url] = FileBlobStore(u.path)
+        elif u.scheme=="shm":
+            _stores[url] = SharedMemoryBlobStore(u.netloc)
+        else:
+            raise ValueError(f"unknown blob store {url}")
+    return _stores[url]
+
+class BlobCodec(BinaryCodec):
+    """
+    二进制信封，payload超过threshold字节时写入store，信封只带引用（meta中的blob/blob_fmt/blob_store）。
+    同一进程内写过的blob不再重复写入。Worker按引用自动取回，原始字节数据以memoryview形式零拷贝交给处理器。
+    """
+
+    def __init__(self, store:BlobStore = None, threshold:int = 1<<20, use_msgpack:bool = False):
+        super().__init__(use_msgpack)
+        self.store = store or FileBlobStore()
+        self.threshold = threshold
+        self._stored = set()
+
+    def __getstate__(self):
+        return dict(self.__dict__, _stored=set())
+
+    def encode(self, data:Any, retrys:int = 1, retry_delay:float = 0.01, **meta) -> bytes:
+        fmt, payload = self.dumps(data)
+        if len(payload)<self.threshold:
+            return self.pack(fmt, payload, retrys, retry_delay, meta)
+        key = self.store.key(payload)
+        if key not in self._stored:
+            self.store.put(key, payload)
+            self._stored.add(key)
+        return self.pack(self.RAW, b"", retrys, retry_delay, dict(meta, blob=key, blob_fmt=fmt, blob_store=self.store.url))
+
+# 解析任务中的blob引用，替换为实际数据
+def load_blob(job:Union[dict, str], client:Client = None):
+    if not isinstance(job, dict) or "blob" not in job:
+        return job
+    view = open_store(job["blob_store"], client).get(job["blob"])
+    fmt = int(job["blob_fmt"])
+    job["data"] = view if fmt==BinaryCodec.RAW else binary_codec.loads(fmt, view)
+    return job
@@ -10,11 +10,17 @@ client.py -- 访问保存任务主题、任务处理器和任务队列的消息
 """
 
 from abc import ABC, abstractmethod
-from typing import Type, Callable, List, Dict, Union, Any
-from urllib import parse
+from typing import Type, Callable, Iterable, List, Dict, Union
+from itertools import islice
 from redis import Redis, ConnectionPool
 import importlib
 import json
+import math
+import ast
+import time
+import os
+
+from .codec import serialize, unserialize
 
 def func2str(func:Union[Callable, Type]):
     if callable(func):
@@ -30,33 +36,105 @@ def str2func(s:str):
     module = importlib.import_module(m)
     return getattr(module, f)
 
-def serialize(data:Any, retrys:int = 1, retry_delay:float = 0.01):
-    d = dict(
-        data=data if isinstance(data, str) else json.dumps(data),
-        retrys=retrys,
-        retry_delay=retry_delay
-    )
-    return json.dumps(d)
-
-def unserialize(data:str):
-    s = str(data, encoding="utf8")
-    return json.loads(s) if s[0] in "{[" else s
+# 解析注册表中的处理器：JSON对象，兼容旧版本的元组字符串 "('handle', 'before', 'after')"，不使用eval
+def str2handlers(s:Union[str, bytes]):
+    s = to_str(s)
+    if s.startswith("{"):
+        return dict(dict(before="", after="", batch=False, teardown="", limits={}), **json.loads(s))
+    handlers = ast.literal_eval(s)
+    return dict(handle=handlers[0], before=handlers[1], after=handlers[2], batch="batch" in handlers[3:], teardown="", limits={})
+
+# 惰性地把任意可迭代对象切分成chunk
+def iter2chunk(items:Iterable, chunksize:int = 100):
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, max(chunksize, 1)))
+        if len(chunk)<1:
+            return
+        yield chunk
+
+def to_str(s:Union[str, bytes]):
+    return s if isinstance(s, str) else str(s, encoding="utf8")
 
 class Client(ABC):
 
     default_topics_header = "fasttq:topics"
     default_workers_header = "fasttq:workers"
     default_handlers_header = "fasttq:handlers"
+    default_handlers_version_header = "fasttq:handlers:version"
     default_jobs_header = "fasttq:jobs:%s"
+    default_active_header = "fasttq:active"
+    default_processing_header = "fasttq:processing:%s:%s"
+    default_leases_header = "fasttq:leases"
+    default_inflight_header = "fasttq:inflight"
+    default_metrics_header = "fasttq:metrics"
+    default_liveness_header = "fasttq:liveness"
+    default_results_header = "fasttq:results:%s"
+    default_delayed_header = "fasttq:delayed"
+    default_blobs_header = "fasttq:blobs:%s"
+    default_claims_header = "fasttq:claims"
+    default_affinity_header = "fasttq:affinity"
+    default_ratelimit_header = "fasttq:ratelimit:%s"
 
     conn_url:str = None
 
+    def jobs_key(self, topic:Union[str, bytes]):
+        return self.default_jobs_header % to_str(topic)
+
+    def key2topic(self, key:bytes):
+        return key[len(self.default_jobs_header)-2:]
+
+    def processing_key(self, worker:str, topic:Union[str, bytes]):
+        return self.default_processing_header % (worker, to_str(topic))
+
+    def results_key(self, reply:Union[str, bytes]):
+        return self.default_results_header % to_str(reply)
+
+    def blob_key(self, key:str):
+        return self.default_blobs_header % key
+
+    def ratelimit_key(self, topic:Union[str, bytes]):
+        return self.default_ratelimit_header % to_str(topic)
+
+    def handlers2str(self, handle:Callable, before:Callable, after:Callable, batch:bool = False, teardown:Callable = None, limits:dict = None):
+        handle_str = func2str(handle)
+        before_str = func2str(before) if before else ""
+        after_str = func2str(after) if after else ""
+        teardown_str = func2str(teardown) if teardown else ""
+        return json.dumps(dict(handle=handle_str, before=before_str, after=after_str, batch=batch, teardown=teardown_str, limits=limits or {}))
+
+    # topic注册时设置的背压水位 (high_watermark, low_watermark, watermark_timeout)，"topic#xxxx"取"topic"的；high_watermark为0时不限制
+    def get_watermarks(self, topic:Union[str, bytes]):
+        s = self.get_handlers(to_str(topic).partition("#")[0])
+        limits = {} if s is None else str2handlers(s)["limits"]
+        return limits.get("high_watermark", 0), limits.get("low_watermark", 0), limits.get("watermark_timeout", 60)
+
+    # 背压：等待topic的队列深度降到low以下，最长timeout秒（没有Worker消费时不会永久阻塞），
+    # 查询间隔从interval起倍增，最长max_interval秒；返回当前深度
+    def wait_depth(self, topic:Union[str, bytes], low:int, timeout:float = 60, interval:float = 0.05, max_interval:float = 1.0):
+        deadline = time.time()+timeout
+        while True:
+            depth = self.get_depths([topic])[topic]
+            if depth<=low or time.time()>=deadline:
+                return depth
+            time.sleep(max(min(interval, deadline-time.time()), 0))
+            interval = min(interval*2, max_interval)
+
+    # 重建活跃topic索引，不维护索引的客户端无需实现
+    def rebuild_active(self):
+        return 0
+
+    # 供AsyncWorker使用的异步客户端，默认在线程池中调用同步方法
+    def aio(self):
+        from .aio import AsyncClient
+        return AsyncClient(self)
+
     @abstractmethod
     def connect(self):
         pass
 
     @abstractmethod
-    def register(self, topic:str, handle:Callable, before:Callable, after:Callable, priority:int = 0):
+    def register(self, topic:str, handle:Callable, before:Callable, after:Callable, priority:int = 0, batch:bool = False, teardown:Callable = None, limits:dict = None):
         pass
 
     @abstractmethod
@@ -71,6 +149,10 @@ class Client(ABC):
     def push_topics(self, jobs:Dict[str, str], retrys:int = 1, retry_delay:float = 1.0):
         pass
 
+    @abstractmethod
+    def push_chunks(self, topic:str, chunks:Iterable[List[str]], window:int = 8, high_watermark:int = 0, low_watermark:int = 0, watermark_timeout:float = 60):
+        pass
+
     @abstractmethod
     def insert_topic(self, topic:str, jobs:List[str]):
         pass
@@ -87,6 +169,14 @@ class Client(ABC):
     def get_handlers(self, topic:str):
         pass
 
+    @abstractmethod
+    def get_registry(self):
+        pass
+
+    @abstractmethod
+    def get_handlers_version(self):
+        pass
+
     @abstractmethod
     def get_job(self, topic:str):
         pass
@@ -95,88 +185,700 @@ class Client(ABC):
     def get_jobs(self, topic:str, chunksize:int = 1):
         pass
 
+    @abstractmethod
+    def wait_jobs(self, topics:List[str], chunksize:int = 1, timeout:float = 1.0):
+        pass
+
+    @abstractmethod
+    def get_topics_registered(self):
+        pass
+
+    @abstractmethod
+    def report(self, topic:str, worker:str):
+        pass
+
+    @abstractmethod
+    def unreport(self, topic:str):
+        pass
+
+    @abstractmethod
+    def get_topics_reported(self):
+        pass
+
+    @abstractmethod
+    def claim(self, topic:str, worker:str, ttl:float = 60):
+        pass
+
+    @abstractmethod
+    def affinity(self, worker:str, topics:List[str], ttl:float = 30):
+        pass
+
+    @abstractmethod
+    def get_depths(self, topics:List[str]):
+        pass
+
+    @abstractmethod
+    def acquire_tokens(self, buckets:Dict[str, tuple]):
+        pass
+
+    @abstractmethod
+    def report_metrics(self, worker:str, metrics:str, liveness:str):
+        pass
+
+    @abstractmethod
+    def get_metrics(self, max_age:float = 600):
+        pass
+
+    @abstractmethod
+    def delete_metrics(self, worker:str):
+        pass
+
+    @abstractmethod
+    def reserve_jobs(self, topic:str, chunksize:int, worker:str, visibility_timeout:float = 300):
+        pass
+
+    @abstractmethod
+    def wait_reserve(self, topic:str, chunksize:int, timeout:float, worker:str, visibility_timeout:float = 300):
+        pass
+
+    @abstractmethod
+    def ack_jobs(self, topic:str, jobs:List[bytes], worker:str, visibility_timeout:float = 300):
+        pass
+
+    @abstractmethod
+    def touch_jobs(self, topic:str, worker:str, visibility_timeout:float = 300):
+        pass
+
+    @abstractmethod
+    def requeue_expired(self, limit:int = 100):
+        pass
+
+    @abstractmethod
+    def push_results(self, reply:str, results:List[bytes], ttl:float = 3600):
+        pass
+
+    @abstractmethod
+    def push_delayed(self, topic:str, jobs:List[bytes], due:Union[float, List[float]]):
+        pass
+
+    @abstractmethod
+    def promote_delayed(self, limit:int = 1000):
+        pass
+
+    @abstractmethod
+    def count_delayed(self):
+        pass
+
+    @abstractmethod
+    def wait_results(self, reply:str, count:int = 100, timeout:float = 1.0):
+        pass
+
+    @abstractmethod
+    def set_blob(self, key:str, payload:bytes, ttl:float = 86400):
+        pass
+
+    @abstractmethod
+    def get_blob(self, key:str):
+        pass
+
+    @abstractmethod
+    def delete_blob(self, key:str):
+        pass
+
+# 原子地从队尾取出最多ARGV[1]个任务，队列取空时从活跃topic索引中移除
+POP_SCRIPT = """
+local n = tonumber(ARGV[1])
+local jobs = redis.call('LRANGE', KEYS[1], -n, -1)
+if #jobs > 0 then
+    redis.call('LTRIM', KEYS[1], 0, -n-1)
+end
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+local rs = {}
+for i = #jobs, 1, -1 do
+    rs[#rs+1] = jobs[i]
+end
+return rs
+"""
+
+# 可靠出队：原子地把最多ARGV[1]个任务从任务队列移入worker的处理中列表，并登记可见性超时
+RESERVE_SCRIPT = """
+local n = tonumber(ARGV[1])
+local jobs = redis.call('LRANGE', KEYS[1], -n, -1)
+if #jobs > 0 then
+    redis.call('LTRIM', KEYS[1], 0, -n-1)
+    for i = 1, #jobs, 1000 do
+        redis.call('RPUSH', KEYS[3], unpack(jobs, i, math.min(i+999, #jobs)))
+    end
+    redis.call('ZADD', KEYS[4], ARGV[3], KEYS[3])
+    redis.call('HSET', KEYS[5], KEYS[3], ARGV[2])
+end
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+end
+local rs = {}
+for i = #jobs, 1, -1 do
+    rs[#rs+1] = jobs[i]
+end
+return rs
+"""
+
+# 批量确认：从处理中列表删除已处理的任务，全部确认后注销租约，否则续租
+ACK_SCRIPT = """
+local n = 0
+if redis.call('LLEN', KEYS[1]) <= #ARGV-1 then
+    n = redis.call('LLEN', KEYS[1])
+    redis.call('DEL', KEYS[1])
+else
+    for i = 2, #ARGV do
+        n = n + redis.call('LREM', KEYS[1], 1, ARGV[i])
+    end
+end
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], KEYS[1])
+    redis.call('HDEL', KEYS[3], KEYS[1])
+else
+    redis.call('ZADD', KEYS[2], ARGV[1], KEYS[1])
+end
+return n
+"""
+
+# 回收租约过期的处理中列表，按原顺序放回任务队列的出队端
+REAP_SCRIPT = """
+local keys = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+local n = 0
+for _, key in ipairs(keys) do
+    local topic = redis.call('HGET', KEYS[2], key)
+    if topic then
+        local jobs = redis.call('LRANGE', key, 0, -1)
+        if #jobs > 0 then
+            local jobs_key = ARGV[2] .. topic
+            for i = 1, #jobs, 1000 do
+                redis.call('RPUSH', jobs_key, unpack(jobs, i, math.min(i+999, #jobs)))
+            end
+            local priority = redis.call('ZSCORE', KEYS[4], string.match(topic, '^[^#]*')) or 0
+            redis.call('ZADD', KEYS[3], priority, topic)
+            n = n + #jobs
+        end
+    end
+    redis.call('DEL', key)
+    redis.call('ZREM', KEYS[1], key)
+    redis.call('HDEL', KEYS[2], key)
+end
+return n
+"""
+
+# 把到期的延迟任务批量移入各自的任务队列，成员为 topic + \0 + 8字节随机数 + 任务报文；返回 {移入数, 下一个到期时间}
+PROMOTE_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+for _, member in ipairs(members) do
+    local i = string.find(member, string.char(0), 1, true)
+    local topic = string.sub(member, 1, i-1)
+    redis.call('LPUSH', ARGV[2] .. topic, string.sub(member, i+9))
+    local priority = redis.call('ZSCORE', KEYS[3], string.match(topic, '^[^#]*')) or 0
+    redis.call('ZADD', KEYS[2], priority, topic)
+end
+if #members > 0 then
+    redis.call('ZREM', KEYS[1], unpack(members))
+end
+local nxt = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return {#members, nxt[2] or false}
+"""
+
+# 独占topic的租约：清理过期的租约，topic未被其他worker持有时登记/续约 ARGV[2]，租约ARGV[4]秒后过期；返回是否取得
+CLAIM_SCRIPT = """
+local now = tonumber(ARGV[3])
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, 100)
+for _, topic in ipairs(stale) do
+    redis.call('ZREM', KEYS[1], topic)
+    redis.call('HDEL', KEYS[2], topic)
+end
+local owner = redis.call('HGET', KEYS[2], ARGV[1])
+if owner and owner ~= ARGV[2] and redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[4]), ARGV[1])
+return 1
+"""
+
+# 批量令牌桶：KEYS为各topic的桶，ARGV[1]为当前时间，之后每个桶依次为 速率、容量、申请数（负数为归还）；
+# 返回每个桶 {取得的令牌数, 下一个令牌还需等待的秒数}
+TOKEN_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rs = {}
+for i, key in ipairs(KEYS) do
+    local rate, burst, n = tonumber(ARGV[i*3-1]), tonumber(ARGV[i*3]), tonumber(ARGV[i*3+1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+    local granted = n
+    if n > 0 then
+        granted = math.min(n, math.floor(tokens))
+    end
+    tokens = math.min(burst, tokens - granted)
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+    rs[#rs+1] = granted
+    rs[#rs+1] = tostring(math.max(1 - tokens, 0) / rate)
+end
+return rs
+"""
+
+# 解析亲和关系 {topic: "过期时间 worker"}，返回未过期的 {topic: worker} 和已过期的topic
+def parse_affinity(items:dict, now:float):
+    owners, stale = {}, []
+    for topic, value in items.items():
+        expire, _, worker = to_str(value).partition(" ")
+        if float(expire)>now:
+            owners[topic] = worker
+        else:
+            stale.append(topic)
+    return owners, stale
+
+# 解析指标快照或存活状态 {worker: json}，返回max_age秒内上报过的 {worker: json} 和已过期（worker崩溃未能删除）的worker
+def parse_metrics(items:dict, now:float, max_age:float):
+    fresh, stale = {}, []
+    for worker, metrics in items.items():
+        if now-json.loads(metrics).get("ts", now)<=max_age:
+            fresh[worker] = metrics
+        else:
+            stale.append(worker)
+    return fresh, stale
+
 class RedisClient(Client):
 
     def __init__(self, conn_url:str):
         self.conn_url = conn_url
         self.pool = ConnectionPool.from_url(conn_url)
+        self._versions = {}
+        self._priorities = {}
+        conn = self.connect()
+        self._pop_script = conn.register_script(POP_SCRIPT)
+        self._reserve_script = conn.register_script(RESERVE_SCRIPT)
+        self._ack_script = conn.register_script(ACK_SCRIPT)
+        self._reap_script = conn.register_script(REAP_SCRIPT)
+        self._promote_script = conn.register_script(PROMOTE_SCRIPT)
+        self._claim_script = conn.register_script(CLAIM_SCRIPT)
+        self._token_script = conn.register_script(TOKEN_SCRIPT)
 
     def connect(self):
         return Redis(connection_pool=self.pool)
 
+    def aio(self):
+        from .aio import AsyncRedisClient
+        return AsyncRedisClient(self)
+
+    # 存放topic任务队列（或结果、blob等按键分布的数据）的连接，分片客户端按一致性哈希选择
+    def shard(self, topic:Union[str, bytes]):
+        return self.connect()
+
+    # 所有存放任务队列的连接，回收租约、移入延迟任务等需要逐个执行
+    def shards(self):
+        return [self.connect()]
+
+    # 服务端版本号，如 (7, 0)，按连接池缓存
+    def server_version(self, conn:Redis):
+        pool = conn.connection_pool
+        if pool not in self._versions:
+            version = conn.info("server").get("redis_version", "0")
+            self._versions[pool] = tuple(int(v) for v in str(version).split(".")[:2])
+        return self._versions[pool]
+
+    # topic的优先级，"topic#xxxx"取"topic"注册时的优先级，进程内缓存
+    def priority(self, conn:Redis, topic:str):
+        topic = to_str(topic).partition("#")[0]
+        if topic not in self._priorities:
+            self._priorities[topic] = conn.zscore(self.default_topics_header, topic) or 0
+        return self._priorities[topic]
+
+    # 推入任务并原子地更新活跃topic索引
+    def _push(self, conn:Redis, topic:str, jobs:List[str], left:bool = True):
+        if len(jobs)<1:
+            return 0
+        priority = self.priority(conn, topic)
+        with conn.pipeline(transaction=True) as pipe:
+            key = self.jobs_key(topic)
+            pipe.lpush(key, *jobs) if left else pipe.rpush(key, *jobs)
+            pipe.zadd(self.default_active_header, {to_str(topic):priority})
+            return pipe.execute()[0]
+
+    # 用SCAN重建活跃topic索引，兼容索引上线前已经存在的任务队列
+    def rebuild_active(self):
+        n = 0
+        for conn in self.shards():
+            with conn:
+                topics = {to_str(self.key2topic(key)) for key in conn.scan_iter(match=self.jobs_key("*"), count=1000)}
+                if len(topics)>0:
+                    conn.zadd(self.default_active_header, {topic:self.priority(conn, topic) for topic in topics})
+                n += len(topics)
+        return n
+
     # 注册Topic以及处理器
-    def register(self, topic:str, handle:Callable, before:Callable, after:Callable, priority:int = 0):
+    def register(self, topic:str, handle:Callable, before:Callable, after:Callable, priority:int = 0, batch:bool = False, teardown:Callable = None, limits:dict = None):
         with self.connect() as conn:
-            t = conn.zadd(self.default_topics_header, {topic:priority,})
-            handle_str = func2str(handle)
-            before_str = func2str(before) if before else ""
-            after_str = func2str(after) if after else ""
-            h = conn.hset(self.default_handlers_header, key=topic, value=f"('{handle_str}', '{before_str}', '{after_str}')")
+            self._priorities[topic] = priority
+            with conn.pipeline(transaction=True) as pipe:
+                pipe.zadd(self.default_topics_header, {topic:priority,})
+                pipe.hset(self.default_handlers_header, key=topic, value=self.handlers2str(handle, before, after, batch, teardown, limits))
+                pipe.incr(self.default_handlers_version_header)
+                t, h, _ = pipe.execute()
             return t,h
 
     # 注销Topic以及处理器
     def unregister(self, topic:str):
         with self.connect() as conn:
-            w = conn.zrem(self.default_workers_header, topic)
+            w = conn.hdel(self.default_workers_header, topic)
+            conn.zrem(self.default_claims_header, topic)
             t = conn.zrem(self.default_topics_header, topic)
             h = conn.hdel(self.default_handlers_header, topic)
-            j = conn.delete(self.default_jobs_header % topic)
-            return w,t,h,j
+            conn.incr(self.default_handlers_version_header)
+        with self.shard(topic) as conn:
+            conn.zrem(self.default_active_header, topic)
+            j = conn.delete(self.jobs_key(topic))
+        self._priorities.pop(topic, None)
+        return w,t,h,j
 
     # 推入某个topic的任务
     def push_topic(self, topic:str, jobs:List[str]):
-        with self.connect() as conn:
-            return conn.lpush(self.default_jobs_header % topic, *jobs)
+        with self.shard(topic) as conn:
+            return self._push(conn, topic, jobs)
 
     # 推入多个topic的任务
     def push_topics(self, jobs:Dict[str, List], retrys:int = 1, retry_delay:float = 1.0):
         with self.connect() as conn:
-            return {topic:conn.lpush(self.default_jobs_header % topic, *_jobs) for topic,_jobs in jobs.items()}
+            return {topic:self._push(conn, topic, _jobs) for topic,_jobs in jobs.items()}
+
+    # 流式推入某个topic的任务：每window个chunk合并为一次事务管道往返，内存中最多保留window个chunk；
+    # high_watermark>0时，LPUSH返回的队列长度超过high_watermark后阻塞，直到Worker把队列消费到low_watermark以下，最长watermark_timeout秒
+    def push_chunks(self, topic:str, chunks:Iterable[List[str]], window:int = 8, high_watermark:int = 0, low_watermark:int = 0, watermark_timeout:float = 60):
+        total = 0
+        with self.shard(topic) as conn:
+            priority = self.priority(conn, topic)
+            key = self.jobs_key(topic)
+            for _chunks in iter2chunk(chunks, window):
+                with conn.pipeline(transaction=True) as pipe:
+                    for chunk in _chunks:
+                        if len(chunk)>0:
+                            pipe.lpush(key, *chunk)
+                            total += len(chunk)
+                    pipe.zadd(self.default_active_header, {to_str(topic):priority})
+                    depths = pipe.execute()[:-1]
+                if high_watermark>0 and len(depths)>0 and depths[-1]>high_watermark:
+                    self.wait_depth(topic, low_watermark, watermark_timeout)
+        return total
 
     # 优先插入某个topic的任务
     def insert_topic(self, topic:str, jobs:List[str]):
-        with self.connect() as conn:
-            return conn.rpush(self.default_jobs_header % topic, *jobs)
+        with self.shard(topic) as conn:
+            return self._push(conn, topic, jobs, left=False)
 
     # 优先插入多个topic的任务
     def insert_topics(self, jobs:Dict[str, str]):
         with self.connect() as conn:
-            return {topic:conn.rpush(self.default_jobs_header % topic, *_jobs) for topic,_jobs in jobs.items()}
+            return {topic:self._push(conn, topic, _jobs, left=False) for topic,_jobs in jobs.items()}
             
-    # 获取所有活跃的topic
-    def get_topics(self):
+    # 获取所有活跃（非空）的topic，按优先级从高到低；复杂度O(活跃topic数)
+    def get_topics(self, withscores:bool = False):
         with self.connect() as conn:
-            return (key[len(self.default_jobs_header)-2:] for key in conn.keys(pattern=self.default_jobs_header % "*"))
-            # count = conn.zcard(self.default_topics_header)
-            # return conn.zrange(self.default_topics_header, 0 , count, withscores=True).extend(topics)
+            return conn.zrevrange(self.default_active_header, 0, -1, withscores=withscores)
 
     # 获取某个topic的处理器
     def get_handlers(self, topic:str):
         with self.connect() as conn:
             return conn.hget(self.default_handlers_header, topic)
 
-    # 获取某个topic的待处理任务
-    def get_job(self, topic:str):
+    # 一次往返获取注册表版本号和全部处理器 (version, {topic: handlers})
+    def get_registry(self):
         with self.connect() as conn:
-            return conn.rpop(self.default_jobs_header % unserialize(topic))
+            with conn.pipeline(transaction=True) as pipe:
+                pipe.get(self.default_handlers_version_header)
+                pipe.hgetall(self.default_handlers_header)
+                version, handlers = pipe.execute()
+            return int(version or 0), handlers
+
+    # 注册表版本号，每次register/unregister加一
+    def get_handlers_version(self):
+        with self.connect() as conn:
+            return int(conn.get(self.default_handlers_version_header) or 0)
 
     # 获取某个topic的待处理任务
+    def get_job(self, topic:str):
+        jobs = self.get_jobs(topic, 1)
+        return jobs[0] if len(jobs)>0 else None
+
+    # 批量获取某个topic的待处理任务：一次网络往返（Lua脚本），只返回实际取到的任务，len即为取到的数量
     def get_jobs(self, topic:str, chunksize:int = 10):
+        with self.shard(topic) as conn:
+            return self._pop_script(
+                keys=[self.jobs_key(topic), self.default_active_header],
+                args=[max(chunksize, 1), to_str(topic)],
+                client=conn)
+
+    # 阻塞等待多个topic中任意一个出现任务（Redis>=7.0用BLMPOP，否则BRPOP），返回(topic, jobs)，超时返回(None, [])
+    # 阻塞出队不更新活跃topic索引，取空的topic会在下一次get_jobs时被移除
+    def wait_jobs(self, topics:List[str], chunksize:int = 1, timeout:float = 1.0):
+        keys = [self.jobs_key(topic) for topic in topics]
+        if len(keys)<1:
+            time.sleep(timeout)
+            return None, []
+
+        with self.shard(topics[0]) as conn:
+            version = self.server_version(conn)
+            # Redis<6.0的阻塞超时只支持整数秒
+            timeout = timeout if version >= (6, 0) else max(math.ceil(timeout), 1)
+            if version >= (7, 0):
+                rs = conn.execute_command("BLMPOP", timeout, len(keys), *keys, "RIGHT", "COUNT", max(chunksize, 1))
+                if rs is None:
+                    return None, []
+                key, jobs = rs
+                return self.key2topic(key), jobs
+
+            rs = conn.brpop(keys, timeout)
+            if rs is None:
+                return None, []
+            key, job = rs
+            topic = self.key2topic(key)
+        jobs = [job]
+        if chunksize>1:
+            jobs.extend(self.get_jobs(topic, chunksize-1))
+        return topic, jobs
+
+    # 可靠出队：任务原子地移入worker的处理中列表，visibility_timeout秒内未确认将被回收重新入队
+    def reserve_jobs(self, topic:str, chunksize:int, worker:str, visibility_timeout:float = 300):
+        processing = self.processing_key(worker, topic)
+        with self.shard(topic) as conn:
+            return self._reserve_script(
+                keys=[self.jobs_key(topic), self.default_active_header, processing, self.default_leases_header, self.default_inflight_header],
+                args=[max(chunksize, 1), to_str(topic), time.time()+visibility_timeout],
+                client=conn)
+
+    # 可靠模式下阻塞等待单个topic：先登记租约再BLMOVE（Redis<6.2用BRPOPLPUSH），其余任务再批量移入
+    def wait_reserve(self, topic:str, chunksize:int, timeout:float, worker:str, visibility_timeout:float = 300):
+        processing = self.processing_key(worker, topic)
+        with self.shard(topic) as conn:
+            with conn.pipeline(transaction=True) as pipe:
+                pipe.zadd(self.default_leases_header, {processing:time.time()+timeout+visibility_timeout})
+                pipe.hset(self.default_inflight_header, processing, to_str(topic))
+                pipe.execute()
+            version = self.server_version(conn)
+            if version >= (6, 2):
+                job = conn.blmove(self.jobs_key(topic), processing, timeout, "RIGHT", "LEFT")
+            else:
+                job = conn.brpoplpush(self.jobs_key(topic), processing, timeout if version >= (6, 0) else max(math.ceil(timeout), 1))
+        if job is None:
+            # 超时未取到任务，注销空的处理中列表的租约
+            with self.shard(topic) as conn:
+                self._ack_script(
+                    keys=[processing, self.default_leases_header, self.default_inflight_header],
+                    args=[time.time()+visibility_timeout],
+                    client=conn)
+            return []
+        jobs = [job]
+        if chunksize>1:
+            jobs.extend(self.reserve_jobs(topic, chunksize-1, worker, visibility_timeout))
+        return jobs
+
+    # 批量确认已处理的任务
+    def ack_jobs(self, topic:str, jobs:List[bytes], worker:str, visibility_timeout:float = 300):
+        if len(jobs)<1:
+            return 0
+        processing = self.processing_key(worker, topic)
+        with self.shard(topic) as conn:
+            return self._ack_script(
+                keys=[processing, self.default_leases_header, self.default_inflight_header],
+                args=[time.time()+visibility_timeout, *jobs],
+                client=conn)
+
+    # 处理耗时较长时续租
+    def touch_jobs(self, topic:str, worker:str, visibility_timeout:float = 300):
+        with self.shard(topic) as conn:
+            return conn.zadd(self.default_leases_header, {self.processing_key(worker, topic):time.time()+visibility_timeout}, xx=True)
+
+    # 把租约过期（worker崩溃或被杀）的任务放回任务队列，返回回收的任务数
+    def requeue_expired(self, limit:int = 100):
+        n = 0
+        for conn in self.shards():
+            with conn:
+                n += self._reap_script(
+                    keys=[self.default_leases_header, self.default_inflight_header, self.default_active_header, self.default_topics_header],
+                    args=[time.time(), self.jobs_key(""), limit],
+                    client=conn)
+        return n
+
+    # 获取所有注册的topic，按优先级从高到低
+    def get_topics_registered(self):
         with self.connect() as conn:
-            header = self.default_jobs_header % unserialize(topic)
-            return [conn.rpop(header) for _ in range(chunksize)]
+            return conn.zrevrange(self.default_topics_header, 0, -1)
 
-    # worker报到
+    # worker报到，即取得默认租期的独占租约
     def report(self, topic:str, worker:str):
-        with self.connect() as conn:
-            return conn.hset(self.default_workers_header, key=topic, value=worker)
+        return int(self.claim(topic, worker))
 
-    # worker告退
+    # worker告退，同时释放租约
     def unreport(self, topic:str):
         with self.connect() as conn:
-            return conn.hdel(self.default_workers_header, key=topic)
+            with conn.pipeline(transaction=True) as pipe:
+                pipe.hdel(self.default_workers_header, topic)
+                pipe.zrem(self.default_claims_header, topic)
+                return pipe.execute()[0]
 
-    # 获取有报到的所有topic
+    # 获取租约未过期的所有topic，持有租约的worker退出或崩溃后租约自动过期
     def get_topics_reported(self):
         with self.connect() as conn:
-            return conn.hkeys(self.default_workers_header)
+            return conn.zrangebyscore(self.default_claims_header, time.time(), "+inf")
+
+    # 取得或续约topic的独占租约，其他worker持有未过期的租约时返回False
+    def claim(self, topic:str, worker:str, ttl:float = 60):
+        with self.connect() as conn:
+            return bool(self._claim_script(
+                keys=[self.default_claims_header, self.default_workers_header],
+                args=[to_str(topic), worker, time.time(), ttl],
+                client=conn))
+
+    # 软亲和：登记worker最近服务过的topic（ttl秒后过期，ttl<=0为释放），一次往返取回所有未过期的 {topic: worker}
+    def affinity(self, worker:str, topics:List[str], ttl:float = 30):
+        now = time.time()
+        with self.connect() as conn:
+            with conn.pipeline(transaction=False) as pipe:
+                if len(topics)>0:
+                    pipe.hset(self.default_affinity_header, mapping={to_str(topic):f"{now+ttl} {worker}" for topic in topics})
+                pipe.hgetall(self.default_affinity_header)
+                owners, stale = parse_affinity(pipe.execute()[-1], now)
+            if len(stale)>0:
+                conn.hdel(self.default_affinity_header, *stale)
+            return owners
+
+    # 一次管道往返获取多个topic的队列深度
+    def get_depths(self, topics:List[str]):
+        with self.connect() as conn:
+            with conn.pipeline(transaction=False) as pipe:
+                for topic in topics:
+                    pipe.llen(self.jobs_key(topic))
+                return dict(zip(topics, pipe.execute()))
+
+    # 一次往返批量申请令牌 {topic: (速率, 容量, 申请数)}，返回 {topic: (取得的令牌数, 下一个令牌还需等待的秒数)}
+    def acquire_tokens(self, buckets:Dict[str, tuple]):
+        if len(buckets)<1:
+            return {}
+        topics = list(buckets)
+        with self.connect() as conn:
+            rs = self._token_script(
+                keys=[self.ratelimit_key(topic) for topic in topics],
+                args=[time.time(), *(v for topic in topics for v in buckets[topic])],
+                client=conn)
+        return {topic:(int(rs[i*2]), float(rs[i*2+1])) for i, topic in enumerate(topics)}
+
+    # 上报worker的指标快照，并在fasttq:liveness中登记存活状态
+    def report_metrics(self, worker:str, metrics:str, liveness:str):
+        with self.connect() as conn:
+            with conn.pipeline(transaction=False) as pipe:
+                pipe.hset(self.default_metrics_header, worker, metrics)
+                pipe.hset(self.default_liveness_header, worker, liveness)
+                return pipe.execute()
+
+    # 获取所有worker最近一次上报的指标，同时删除max_age秒内没有再上报的指标和存活状态
+    def get_metrics(self, max_age:float = 600):
+        with self.connect() as conn:
+            with conn.pipeline(transaction=False) as pipe:
+                pipe.hgetall(self.default_metrics_header)
+                pipe.hgetall(self.default_liveness_header)
+                items, liveness = pipe.execute()
+            now = time.time()
+            metrics, stale = parse_metrics(items, now, max_age)
+            _, dead = parse_metrics(liveness, now, max_age)
+            with conn.pipeline(transaction=False) as pipe:
+                if len(stale)>0:
+                    pipe.hdel(self.default_metrics_header, *stale)
+                if len(dead)>0:
+                    pipe.hdel(self.default_liveness_header, *dead)
+                pipe.execute()
+            return metrics
+
+    # worker退出时删除它的指标和存活状态
+    def delete_metrics(self, worker:str):
+        with self.connect() as conn:
+            with conn.pipeline(transaction=False) as pipe:
+                pipe.hdel(self.default_metrics_header, worker)
+                pipe.hdel(self.default_liveness_header, worker)
+                return pipe.execute()[0]
+
+    # 批量写入一次提交的任务结果，结果列表ttl秒后过期
+    def push_results(self, reply:str, results:List[bytes], ttl:float = 3600):
+        if len(results)<1:
+            return 0
+        key = self.results_key(reply)
+        with self.shard(key) as conn:
+            with conn.pipeline(transaction=True) as pipe:
+                pipe.rpush(key, *results)
+                pipe.expire(key, max(math.ceil(ttl), 1))
+                return pipe.execute()[0]
+
+    # 延迟任务写入 fasttq:delayed 有序集合，分数为到期时间；due可以是统一的到期时间或每个任务各自的到期时间
+    def push_delayed(self, topic:str, jobs:List[bytes], due:Union[float, List[float]]):
+        if len(jobs)<1:
+            return 0
+        dues = due if isinstance(due, list) else [due]*len(jobs)
+        prefix = to_str(topic).encode("utf8")+b"\0"
+        with self.shard(topic) as conn:
+            return conn.zadd(self.default_delayed_header, {prefix+os.urandom(8)+job:d for job, d in zip(jobs, dues)})
+
+    # 把到期的延迟任务移入任务队列，返回(移入数, 下一个到期时间或None)
+    def promote_delayed(self, limit:int = 1000):
+        total, dues = 0, []
+        for conn in self.shards():
+            with conn:
+                n, nxt = self._promote_script(
+                    keys=[self.default_delayed_header, self.default_active_header, self.default_topics_header],
+                    args=[time.time(), self.jobs_key(""), limit],
+                    client=conn)
+            total += n
+            if nxt:
+                dues.append(float(nxt))
+        return total, min(dues, default=None)
+
+    def count_delayed(self):
+        n = 0
+        for conn in self.shards():
+            with conn:
+                n += conn.zcard(self.default_delayed_header)
+        return n
+
+    # 写入大任务数据，已存在时只刷新过期时间；返回是否新写入
+    def set_blob(self, key:str, payload:bytes, ttl:float = 86400):
+        with self.shard(self.blob_key(key)) as conn:
+            with conn.pipeline(transaction=False) as pipe:
+                pipe.set(self.blob_key(key), payload, ex=math.ceil(ttl), nx=True)
+                pipe.expire(self.blob_key(key), math.ceil(ttl))
+                return bool(pipe.execute()[0])
+
+    def get_blob(self, key:str):
+        with self.shard(self.blob_key(key)) as conn:
+            return conn.get(self.blob_key(key))
+
+    def delete_blob(self, key:str):
+        with self.shard(self.blob_key(key)) as conn:
+            return conn.delete(self.blob_key(key))
+
+    # 阻塞等待结果，一次往返取出已到达的最多count个
+    def wait_results(self, reply:str, count:int = 100, timeout:float = 1.0):
+        key = self.results_key(reply)
+        with self.shard(key) as conn:
+            version = self.server_version(conn)
+            timeout = timeout if version >= (6, 0) else max(math.ceil(timeout), 1)
+            if version >= (7, 0):
+                rs = conn.execute_command("BLMPOP", timeout, 1, key, "LEFT", "COUNT", max(count, 1))
+                return [] if rs is None else rs[1]
+
+            rs = conn.blpop([key], timeout)
+            if rs is None:
+                return []
+            results = [rs[1]]
+            if count>1:
+                with conn.pipeline(transaction=True) as pipe:
+                    pipe.lrange(key, 0, count-2)
+                    pipe.ltrim(key, count-1, -1)
+                    results.extend(pipe.execute()[0])
+            return results
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/06/10 10:21:45
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+codec.py -- 任务信封的编解码：紧凑二进制信封（默认）以及兼容旧版本的JSON信封
+"""
+
+from abc import ABC, abstractmethod
+from typing import Any, Union
+import struct
+import json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class Codec(ABC):
+
+    @abstractmethod
+    def encode(self, data:Any, retrys:int = 1, retry_delay:float = 0.01, **meta) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, raw:Union[bytes, memoryview]) -> dict:
+        pass
+
+class JsonCodec(Codec):
+    """JSON信封，data直接内嵌在信封中只序列化一次"""
+
+    def encode(self, data:Any, retrys:int = 1, retry_delay:float = 0.01, **meta) -> bytes:
+        return json.dumps(dict(data=data, retrys=retrys, retry_delay=retry_delay, **meta)).encode("utf8")
+
+    def decode(self, raw:Union[bytes, memoryview]) -> dict:
+        return json.loads(bytes(raw))
+
+class BinaryCodec(Codec):
+    """
+    二进制信封：定长头部(magic, payload格式, retrys, retry_delay, meta长度) + meta(JSON) + payload。
+    payload默认用JSON，use_msgpack=True时用msgpack（pip install fasttq[msgpack]），编码格式不随运行环境是否安装msgpack而变化。
+    """
+
+    MAGIC = 0xF7 # 不是合法的UTF8首字节，可以和JSON信封、纯文本区分
+    RAW, TEXT, JSON, MSGPACK = 0, 1, 2, 3
+    HEADER = struct.Struct("!BBHdH")
+
+    def __init__(self, use_msgpack:bool = False):
+        if use_msgpack and msgpack is None:
+            raise ImportError("use_msgpack requires msgpack, pip install fasttq[msgpack]")
+        self.use_msgpack = use_msgpack
+
+    def dumps(self, data:Any):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return self.RAW, bytes(data)
+        if isinstance(data, str):
+            return self.TEXT, data.encode("utf8")
+        if self.use_msgpack:
+            return self.MSGPACK, msgpack.packb(data, use_bin_type=True)
+        return self.JSON, json.dumps(data).encode("utf8")
+
+    def loads(self, fmt:int, payload:memoryview):
+        if fmt==self.RAW:
+            return bytes(payload)
+        if fmt==self.TEXT:
+            return str(payload, encoding="utf8")
+        if fmt==self.MSGPACK:
+            if msgpack is None:
+                raise ImportError("job payload is encoded with msgpack but msgpack is not installed, pip install fasttq[msgpack]")
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        return json.loads(bytes(payload))
+
+    def pack(self, fmt:int, payload:bytes, retrys:int, retry_delay:float, meta:dict):
+        _meta = json.dumps(meta).encode("utf8") if meta else b""
+        return b"".join((self.HEADER.pack(self.MAGIC, fmt, retrys, retry_delay, len(_meta)), _meta, payload))
+
+    def encode(self, data:Any, retrys:int = 1, retry_delay:float = 0.01, **meta) -> bytes:
+        fmt, payload = self.dumps(data)
+        return self.pack(fmt, payload, retrys, retry_delay, meta)
+
+    def decode(self, raw:Union[bytes, memoryview]) -> dict:
+        view = memoryview(raw)
+        _, fmt, retrys, retry_delay, meta_len = self.HEADER.unpack_from(view)
+        offset = self.HEADER.size + meta_len
+        job = json.loads(bytes(view[self.HEADER.size:offset])) if meta_len>0 else {}
+        job.update(data=self.loads(fmt, view[offset:]), retrys=retrys, retry_delay=retry_delay)
+        return job
+
+json_codec = JsonCodec()
+binary_codec = BinaryCodec()
+default_codec:Codec = binary_codec
+
+# 设置默认的任务编码器，Worker按信封首字节自动识别，无需同步设置
+def set_codec(codec:Codec):
+    global default_codec
+    default_codec = codec
+
+def serialize(data:Any, retrys:int = 1, retry_delay:float = 0.01, codec:Codec = None, **meta):
+    return (codec or default_codec).encode(data, retrys, retry_delay, **meta)
+
+def unserialize(data:Union[bytes, str]):
+    if isinstance(data, str):
+        data = data.encode("utf8")
+    if len(data)<1:
+        return ""
+    if data[0]==BinaryCodec.MAGIC:
+        return binary_codec.decode(data)
+    s = str(data, encoding="utf8")
+    return json.loads(s) if s[0] in "{[" else s
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/08/06 09:52:40
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+context.py -- Worker内按topic缓存before构建的context，跨chunk复用，淘汰和退出时调用teardown
+"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Union
+import threading
+import time
+
+class CachedContext:
+    """缓存的context及其使用计数：淘汰时仍有chunk在使用的，等最后一个chunk release后才teardown"""
+
+    __slots__ = ("context", "created_at", "teardown", "refs", "evicted")
+
+    def __init__(self, context:dict, teardown:Callable = None):
+        self.context = context
+        self.created_at = time.time()
+        self.teardown = teardown
+        self.refs = 0
+        self.evicted = False
+
+class ContextCache:
+    """
+    以完整topic（含#后缀）为键的LRU缓存，最多maxsize个，创建超过ttl秒（0为不过期）后重新调用before构建。
+    每个chunk拿到的是缓存context的浅拷贝：before放入的数据共享，"_result"和"topics"换成新的容器，chunk之间互不影响。
+    acquire和release成对调用，被淘汰（LRU、过期、clear）的context在所有使用它的chunk release之后才teardown。
+    maxsize=0时不缓存，每个chunk各自调用before，处理完立即teardown。
+    AsyncWorker在事件循环和线程池中同时访问，所有操作持有锁。
+    """
+
+    def __init__(self, maxsize:int = 16, ttl:float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items:Dict[Union[str, bytes], CachedContext] = OrderedDict()
+        # 正在使用的context拷贝 id -> 缓存项
+        self._leases:Dict[int, CachedContext] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def expired(self, created_at:float):
+        return self.ttl>0 and time.time()-created_at>=self.ttl
+
+    # 取出topic的context，不存在或已过期时调用before构建
+    def acquire(self, topic:Union[str, bytes], before:Callable, teardown:Callable = None):
+        if self.maxsize<1:
+            return before(topic)
+        with self._lock:
+            for key in [key for key, item in self._items.items() if self.expired(item.created_at)]:
+                self.evict(key)
+            if topic in self._items:
+                self._items.move_to_end(topic)
+            else:
+                self._items[topic] = CachedContext(before(topic), teardown)
+                while len(self._items)>self.maxsize:
+                    self.evict(next(iter(self._items)))
+            item = self._items[topic]
+            context = dict(item.context)
+            context["_result"] = list(context.get("_result", []))
+            if "topics" in context:
+                context["topics"] = {t:list(jobs) for t, jobs in context["topics"].items()}
+            item.refs += 1
+            self._leases[id(context)] = item
+            return context
+
+    # chunk处理完毕：不缓存时立即teardown，已被淘汰且没有其他chunk在使用时teardown
+    def release(self, topic:Union[str, bytes], context:dict, teardown:Callable = None):
+        if self.maxsize<1:
+            if teardown is not None:
+                teardown(topic, context)
+            return
+        with self._lock:
+            item = self._leases.pop(id(context), None)
+            if item is None:
+                return
+            item.refs -= 1
+            if item.evicted and item.refs<1:
+                self.close(topic, item)
+
+    def evict(self, topic:Union[str, bytes]):
+        with self._lock:
+            item = self._items.pop(topic)
+            item.evicted = True
+            if item.refs<1:
+                self.close(topic, item)
+
+    @staticmethod
+    def close(topic:Union[str, bytes], item:CachedContext):
+        if item.teardown is not None:
+            item.teardown(topic, item.context)
+
+    # 淘汰所有缓存的context（重新注册或Worker退出时），个别teardown出错不影响其他的
+    def clear(self):
+        error = None
+        with self._lock:
+            while len(self._items)>0:
+                try:
+                    self.evict(next(iter(self._items)))
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            raise error
@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/06/24 14:08:51
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+local.py -- 单机本地客户端：任务队列保存在本机的存储进程中，生产者和Worker通过本地IPC访问，无需Redis
+"""
+
+from typing import Callable, Iterable, List, Dict, Union
+from collections import defaultdict, deque
+import heapq
+import itertools
+import math
+from multiprocessing import AuthenticationError
+from multiprocessing.managers import BaseManager
+from urllib import parse
+import threading
+import secrets
+import time
+
+from .client import Client, iter2chunk, to_str, parse_affinity, parse_metrics
+
+class LocalStore:
+    """
+    本地存储：列表、有序集合和哈希的最小实现。
+    每个方法对应客户端的一次操作，在锁内原子执行，保证一次调用只有一次IPC往返。
+    """
+
+    def __init__(self):
+        self.keys = Client
+        self.cond = threading.Condition()
+        self.lists = defaultdict(deque)
+        self.zsets = defaultdict(dict)
+        self.hashes = defaultdict(dict)
+        self.counters = defaultdict(int)
+        self.expires = {}
+        # 延迟任务最小堆：(到期时间, 序号, topic, 任务报文)
+        self.delayed = []
+        self.seq = itertools.count()
+
+    def _key(self, topic:str):
+        return self.keys.default_jobs_header % topic
+
+    def _priority(self, topic:str):
+        return self.zsets[self.keys.default_topics_header].get(topic.partition("#")[0], 0)
+
+    def _push(self, topic:str, jobs:list, left:bool = True):
+        q = self.lists[self._key(topic)]
+        if left:
+            q.extendleft(jobs)
+        else:
+            q.extend(jobs)
+        if len(q)>0:
+            self.zsets[self.keys.default_active_header][topic] = self._priority(topic)
+        return len(q)
+
+    def _pop(self, topic:str, chunksize:int):
+        key = self._key(topic)
+        q = self.lists[key]
+        jobs = [q.pop() for _ in range(min(max(chunksize, 1), len(q)))]
+        if len(q)<1:
+            self.lists.pop(key, None)
+            self.zsets[self.keys.default_active_header].pop(topic, None)
+        return jobs
+
+    def _reserve(self, topic:str, chunksize:int, processing:str, deadline:float):
+        jobs = self._pop(topic, chunksize)
+        if len(jobs)>0:
+            self.lists[processing].extend(jobs)
+            self.zsets[self.keys.default_leases_header][processing] = deadline
+            self.hashes[self.keys.default_inflight_header][processing] = topic
+        return jobs
+
+    def _ready(self, topics:List[str]):
+        for topic in topics:
+            if len(self.lists.get(self._key(topic), ()))>0:
+                return topic
+        return None
+
+    def push(self, items:List[tuple]):
+        with self.cond:
+            rs = [self._push(topic, jobs, left) for topic, jobs, left in items]
+            self.cond.notify_all()
+            return rs
+
+    def pop(self, topic:str, chunksize:int):
+        with self.cond:
+            return self._pop(topic, chunksize)
+
+    def wait(self, topics:List[str], chunksize:int, timeout:float):
+        with self.cond:
+            topic = None
+            if self.cond.wait_for(lambda:self._ready(topics) is not None, timeout):
+                topic = self._ready(topics)
+            return (topic, self._pop(topic, chunksize)) if topic else (None, [])
+
+    def reserve(self, topic:str, chunksize:int, processing:str, deadline:float):
+        with self.cond:
+            return self._reserve(topic, chunksize, processing, deadline)
+
+    def wait_reserve(self, topic:str, chunksize:int, processing:str, deadline:float, timeout:float):
+        with self.cond:
+            if not self.cond.wait_for(lambda:self._ready([topic]) is not None, timeout):
+                return []
+            return self._reserve(topic, chunksize, processing, deadline)
+
+    def ack(self, processing:str, jobs:list, deadline:float):
+        with self.cond:
+            q = self.lists.get(processing, deque())
+            n = 0
+            if len(q)<=len(jobs):
+                n = len(q)
+                q.clear()
+            else:
+                for job in jobs:
+                    try:
+                        q.remove(job)
+                        n += 1
+                    except ValueError:
+                        pass
+            if len(q)<1:
+                self.lists.pop(processing, None)
+                self.zsets[self.keys.default_leases_header].pop(processing, None)
+                self.hashes[self.keys.default_inflight_header].pop(processing, None)
+            else:
+                self.zsets[self.keys.default_leases_header][processing] = deadline
+            return n
+
+    def touch(self, processing:str, deadline:float):
+        with self.cond:
+            leases = self.zsets[self.keys.default_leases_header]
+            if processing in leases:
+                leases[processing] = deadline
+                return 1
+            return 0
+
+    def requeue_expired(self, now:float, limit:int):
+        with self.cond:
+            leases = self.zsets[self.keys.default_leases_header]
+            inflight = self.hashes[self.keys.default_inflight_header]
+            n = 0
+            for processing in sorted((k for k, v in leases.items() if v<=now), key=leases.get)[:limit]:
+                jobs = self.lists.pop(processing, ())
+                topic = inflight.pop(processing, None)
+                leases.pop(processing, None)
+                if topic is not None and len(jobs)>0:
+                    # 按出队的逆序放回出队端，保持原来的出队顺序
+                    self._push(topic, list(reversed(jobs)), left=False)
+                    n += len(jobs)
+            self.cond.notify_all()
+            return n
+
+    def llen(self, key:str):
+        with self.cond:
+            return len(self.lists.get(key, ()))
+
+    def delete(self, key:str):
+        with self.cond:
+            return int(self.lists.pop(key, None) is not None)
+
+    def zadd(self, name:str, mapping:dict):
+        with self.cond:
+            zset = self.zsets[name]
+            n = len([k for k in mapping if k not in zset])
+            zset.update(mapping)
+            return n
+
+    def zrem(self, name:str, member:str):
+        with self.cond:
+            return int(self.zsets[name].pop(member, None) is not None)
+
+    def zscore(self, name:str, member:str):
+        with self.cond:
+            return self.zsets[name].get(member)
+
+    def zrevrange(self, name:str, withscores:bool = False):
+        with self.cond:
+            items = sorted(self.zsets[name].items(), key=lambda item:item[1], reverse=True)
+            return items if withscores else [k for k, _ in items]
+
+    def hset(self, name:str, key:str, value):
+        with self.cond:
+            n = int(key not in self.hashes[name])
+            self.hashes[name][key] = value
+            return n
+
+    def hget(self, name:str, key:str):
+        with self.cond:
+            return self.hashes[name].get(key)
+
+    def hdel(self, name:str, key:str):
+        with self.cond:
+            return int(self.hashes[name].pop(key, None) is not None)
+
+    def hkeys(self, name:str):
+        with self.cond:
+            return list(self.hashes[name].keys())
+
+    def hgetall(self, name:str):
+        with self.cond:
+            return dict(self.hashes[name])
+
+    def incr(self, key:str):
+        with self.cond:
+            self.counters[key] += 1
+            return self.counters[key]
+
+    def counter(self, key:str):
+        with self.cond:
+            return self.counters[key]
+
+    def registry(self, version_key:str, name:str):
+        with self.cond:
+            return self.counters[version_key], dict(self.hashes[name])
+
+    def claim(self, topic:str, worker:str, now:float, ttl:float):
+        with self.cond:
+            claims, workers = self.zsets[self.keys.default_claims_header], self.hashes[self.keys.default_workers_header]
+            for stale in [t for t, expire in claims.items() if expire<=now]:
+                claims.pop(stale)
+                workers.pop(stale, None)
+            if workers.get(topic, worker)!=worker and topic in claims:
+                return False
+            workers[topic] = worker
+            claims[topic] = now+ttl
+            return True
+
+    def unclaim(self, topic:str):
+        with self.cond:
+            self.zsets[self.keys.default_claims_header].pop(topic, None)
+            return int(self.hashes[self.keys.default_workers_header].pop(topic, None) is not None)
+
+    def claimed(self, now:float):
+        with self.cond:
+            return [topic for topic, expire in self.zsets[self.keys.default_claims_header].items() if expire>now]
+
+    # 令牌桶，与RedisClient的TOKEN_SCRIPT相同：items为 (key, 速率, 容量, 申请数)，返回 [(取得的令牌数, 下一个令牌还需等待的秒数)]
+    def take_tokens(self, items:List[tuple], now:float):
+        with self.cond:
+            rs = []
+            for key, rate, burst, n in items:
+                bucket = self.hashes[key]
+                tokens = min(burst, bucket.get("tokens", burst)+max(now-bucket.get("ts", now), 0)*rate)
+                granted = min(n, math.floor(tokens)) if n>0 else n
+                bucket["tokens"], bucket["ts"] = min(burst, tokens-granted), now
+                rs.append((granted, max(1-bucket["tokens"], 0)/rate))
+            return rs
+
+    def hmset(self, items:List[tuple]):
+        with self.cond:
+            for name, key, value in items:
+                self.hashes[name][key] = value
+            return len(items)
+
+    def llens(self, keys:List[str]):
+        with self.cond:
+            return [len(self.lists.get(key, ())) for key in keys]
+
+    def push_delayed(self, topic:str, jobs:list, dues:list):
+        with self.cond:
+            for job, due in zip(jobs, dues):
+                heapq.heappush(self.delayed, (due, next(self.seq), topic, job))
+            return len(jobs)
+
+    def promote_delayed(self, now:float, limit:int):
+        with self.cond:
+            n = 0
+            while n<limit and len(self.delayed)>0 and self.delayed[0][0]<=now:
+                _, _, topic, job = heapq.heappop(self.delayed)
+                self._push(topic, [job])
+                n += 1
+            if n>0:
+                self.cond.notify_all()
+            return n, (self.delayed[0][0] if len(self.delayed)>0 else None)
+
+    def count_delayed(self):
+        with self.cond:
+            return len(self.delayed)
+
+    def push_results(self, key:str, results:list, ttl:float):
+        with self.cond:
+            now = time.time()
+            # 顺带清理过期的结果列表
+            for k in [k for k, expire in self.expires.items() if expire<=now]:
+                self.expires.pop(k)
+                self.lists.pop(k, None)
+            q = self.lists[key]
+            q.extend(results)
+            self.expires[key] = now+ttl
+            self.cond.notify_all()
+            return len(q)
+
+    def wait_results(self, key:str, count:int, timeout:float):
+        with self.cond:
+            if not self.cond.wait_for(lambda:len(self.lists.get(key, ()))>0, timeout):
+                return []
+            q = self.lists[key]
+            results = [q.popleft() for _ in range(min(max(count, 1), len(q)))]
+            if len(q)<1:
+                self.lists.pop(key, None)
+                self.expires.pop(key, None)
+            return results
+
+_store:LocalStore = None
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = LocalStore()
+    return _store
+
+class LocalManager(BaseManager):
+    pass
+
+LocalManager.register("store", callable=get_store)
+
+class LocalClient(Client):
+    """
+    conn_url形如 local://:authkey@127.0.0.1:6399 ，第一个连接的进程（通常是FastQueue所在的主进程）负责启动存储进程，
+    Worker子进程通过 str2func(client_str)(conn_url) 连接同一个存储进程。
+    存储进程与客户端之间用pickle传递数据，authkey是唯一的访问控制：conn_url中没有authkey时随机生成一个并写回conn_url，
+    只有经由该conn_url启动的Worker子进程能够连接；其他独立启动的进程需要在conn_url中指定相同的authkey。
+    """
+
+    def __init__(self, conn_url:str):
+        url = parse.urlparse(conn_url)
+        self.address = (url.hostname or "127.0.0.1", url.port or 6399)
+        if url.password is None:
+            user = f"{url.username}:" if url.username else ":"
+            url = url._replace(netloc=f"{user}{secrets.token_hex(16)}@{self.address[0]}:{self.address[1]}")
+        self.conn_url = url.geturl()
+        self.authkey = parse.unquote(url.password).encode("utf8")
+        self.manager = None
+        self.store = self.connect()
+
+    def connect(self):
+        manager = LocalManager(address=self.address, authkey=self.authkey)
+        try:
+            manager.connect()
+        except AuthenticationError:
+            raise AuthenticationError(f"authkey does not match the local store at {self.address[0]}:{self.address[1]}, use local://:authkey@host:port with the authkey it was started with") from None
+        except (ConnectionRefusedError, FileNotFoundError):
+            # 存储进程的生命周期跟随创建它的客户端
+            self.manager = manager
+            manager.start()
+        return manager.store()
+
+    def encode(self, topics:Iterable):
+        return [topic.encode("utf8") if isinstance(topic, str) else topic for topic in topics]
+
+    def register(self, topic:str, handle:Callable, before:Callable, after:Callable, priority:int = 0, batch:bool = False, teardown:Callable = None, limits:dict = None):
+        t = self.store.zadd(self.default_topics_header, {topic:priority})
+        h = self.store.hset(self.default_handlers_header, topic, self.handlers2str(handle, before, after, batch, teardown, limits))
+        self.store.incr(self.default_handlers_version_header)
+        return t,h
+
+    def unregister(self, topic:str):
+        w = self.store.unclaim(topic)
+        t = self.store.zrem(self.default_topics_header, topic)
+        h = self.store.hdel(self.default_handlers_header, topic)
+        self.store.incr(self.default_handlers_version_header)
+        self.store.zrem(self.default_active_header, topic)
+        j = self.store.delete(self.jobs_key(topic))
+        return w,t,h,j
+
+    def push_topic(self, topic:str, jobs:List[str]):
+        return self.store.push([(to_str(topic), list(jobs), True)])[0]
+
+    def push_topics(self, jobs:Dict[str, List], retrys:int = 1, retry_delay:float = 1.0):
+        topics = list(jobs.keys())
+        return dict(zip(topics, self.store.push([(to_str(topic), list(jobs[topic]), True) for topic in topics])))
+
+    def push_chunks(self, topic:str, chunks:Iterable[List[str]], window:int = 8, high_watermark:int = 0, low_watermark:int = 0, watermark_timeout:float = 60):
+        total = 0
+        for _chunks in iter2chunk(chunks, window):
+            depths = self.store.push([(to_str(topic), chunk, True) for chunk in _chunks])
+            total += sum(len(chunk) for chunk in _chunks)
+            if high_watermark>0 and len(depths)>0 and depths[-1]>high_watermark:
+                self.wait_depth(topic, low_watermark, watermark_timeout)
+        return total
+
+    def insert_topic(self, topic:str, jobs:List[str]):
+        return self.store.push([(to_str(topic), list(jobs), False)])[0]
+
+    def insert_topics(self, jobs:Dict[str, str]):
+        topics = list(jobs.keys())
+        return dict(zip(topics, self.store.push([(to_str(topic), list(jobs[topic]), False) for topic in topics])))
+
+    def get_topics(self, withscores:bool = False):
+        topics = self.store.zrevrange(self.default_active_header, withscores)
+        if withscores:
+            return [(topic.encode("utf8"), score) for topic, score in topics]
+        return self.encode(topics)
+
+    def get_topics_registered(self):
+        return self.encode(self.store.zrevrange(self.default_topics_header))
+
+    def get_handlers(self, topic:str):
+        return self.store.hget(self.default_handlers_header, to_str(topic))
+
+    def get_registry(self):
+        return self.store.registry(self.default_handlers_version_header, self.default_handlers_header)
+
+    def get_handlers_version(self):
+        return self.store.counter(self.default_handlers_version_header)
+
+    def get_job(self, topic:str):
+        jobs = self.get_jobs(topic, 1)
+        return jobs[0] if len(jobs)>0 else None
+
+    def get_jobs(self, topic:str, chunksize:int = 10):
+        return self.store.pop(to_str(topic), chunksize)
+
+    def wait_jobs(self, topics:List[str], chunksize:int = 1, timeout:float = 1.0):
+        topic, jobs = self.store.wait([to_str(topic) for topic in topics], chunksize, timeout)
+        return (topic.encode("utf8") if topic else None), jobs
+
+    def reserve_jobs(self, topic:str, chunksize:int, worker:str, visibility_timeout:float = 300):
+        return self.store.reserve(to_str(topic), chunksize, self.processing_key(worker, topic), time.time()+visibility_timeout)
+
+    def wait_reserve(self, topic:str, chunksize:int, timeout:float, worker:str, visibility_timeout:float = 300):
+        return self.store.wait_reserve(to_str(topic), chunksize, self.processing_key(worker, topic), time.time()+timeout+visibility_timeout, timeout)
+
+    def ack_jobs(self, topic:str, jobs:List[bytes], worker:str, visibility_timeout:float = 300):
+        if len(jobs)<1:
+            return 0
+        return self.store.ack(self.processing_key(worker, topic), list(jobs), time.time()+visibility_timeout)
+
+    def touch_jobs(self, topic:str, worker:str, visibility_timeout:float = 300):
+        return self.store.touch(self.processing_key(worker, topic), time.time()+visibility_timeout)
+
+    def requeue_expired(self, limit:int = 100):
+        return self.store.requeue_expired(time.time(), limit)
+
+    def report(self, topic:str, worker:str):
+        return int(self.claim(topic, worker))
+
+    def unreport(self, topic:str):
+        return self.store.unclaim(to_str(topic))
+
+    def get_topics_reported(self):
+        return self.encode(self.store.claimed(time.time()))
+
+    def claim(self, topic:str, worker:str, ttl:float = 60):
+        return self.store.claim(to_str(topic), worker, time.time(), ttl)
+
+    def affinity(self, worker:str, topics:List[str], ttl:float = 30):
+        now = time.time()
+        if len(topics)>0:
+            self.store.hmset([(self.default_affinity_header, to_str(topic), f"{now+ttl} {worker}") for topic in topics])
+        owners, stale = parse_affinity(self.store.hgetall(self.default_affinity_header), now)
+        for topic in stale:
+            self.store.hdel(self.default_affinity_header, topic)
+        return {topic.encode("utf8"):worker for topic, worker in owners.items()}
+
+    def get_depths(self, topics:List[str]):
+        return dict(zip(topics, self.store.llens([self.jobs_key(topic) for topic in topics])))
+
+    def acquire_tokens(self, buckets:Dict[str, tuple]):
+        if len(buckets)<1:
+            return {}
+        topics = list(buckets)
+        rs = self.store.take_tokens([(self.ratelimit_key(topic), *buckets[topic]) for topic in topics], time.time())
+        return dict(zip(topics, (tuple(r) for r in rs)))
+
+    def report_metrics(self, worker:str, metrics:str, liveness:str):
+        return self.store.hmset([(self.default_metrics_header, worker, metrics), (self.default_liveness_header, worker, liveness)])
+
+    def get_metrics(self, max_age:float = 600):
+        now = time.time()
+        metrics, stale = parse_metrics(self.store.hgetall(self.default_metrics_header), now, max_age)
+        _, dead = parse_metrics(self.store.hgetall(self.default_liveness_header), now, max_age)
+        for worker in stale:
+            self.store.hdel(self.default_metrics_header, worker)
+        for worker in dead:
+            self.store.hdel(self.default_liveness_header, worker)
+        return metrics
+
+    def delete_metrics(self, worker:str):
+        self.store.hdel(self.default_liveness_header, worker)
+        return self.store.hdel(self.default_metrics_header, worker)
+
+    def push_results(self, reply:str, results:List[bytes], ttl:float = 3600):
+        if len(results)<1:
+            return 0
+        return self.store.push_results(self.results_key(reply), list(results), ttl)
+
+    def wait_results(self, reply:str, count:int = 100, timeout:float = 1.0):
+        return self.store.wait_results(self.results_key(reply), count, timeout)
+
+    def push_delayed(self, topic:str, jobs:List[bytes], due:Union[float, List[float]]):
+        if len(jobs)<1:
+            return 0
+        return self.store.push_delayed(to_str(topic), list(jobs), due if isinstance(due, list) else [due]*len(jobs))
+
+    def promote_delayed(self, limit:int = 1000):
+        return tuple(self.store.promote_delayed(time.time(), limit))
+
+    def count_delayed(self):
+        return self.store.count_delayed()
+
+    # 本地存储中的blob不过期，由调用方delete_blob删除
+    def set_blob(self, key:str, payload:bytes, ttl:float = 86400):
+        return bool(self.store.hset(self.default_blobs_header % "", key, payload))
+
+    def get_blob(self, key:str):
+        return self.store.hget(self.default_blobs_header % "", key)
+
+    def delete_blob(self, key:str):
+        return self.store.hdel(self.default_blobs_header % "", key)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/07/02 20:31:07
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+metrics.py -- Worker运行指标：按topic统计的计数器、耗时直方图和队列深度，定期输出到可插拔的Sink
+"""
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import defaultdict
+from typing import List, Union
+import threading
+import socket
+import json
+import time
+import os
+
+from .client import Client, to_str
+
+# 直方图的桶上限（秒）
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0]*len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def dump(self):
+        return dict(counts=list(self.counts), sum=self.sum, count=self.count)
+
+class Sink(ABC):
+
+    @abstractmethod
+    def emit(self, snapshot:dict):
+        pass
+
+class MemorySink(Sink):
+    """保存最近一次快照，供进程内读取"""
+
+    def __init__(self):
+        self.snapshot = None
+
+    def emit(self, snapshot:dict):
+        self.snapshot = snapshot
+
+class ClientSink(Sink):
+    """把快照写入 fasttq:metrics 哈希，同时在 fasttq:liveness 哈希中登记worker存活状态"""
+
+    def __init__(self, client:Client):
+        self.client = client
+
+    def emit(self, snapshot:dict):
+        liveness = dict(host=snapshot["host"], pid=snapshot["pid"], ts=snapshot["ts"])
+        self.client.report_metrics(snapshot["worker"], json.dumps(snapshot), json.dumps(liveness))
+
+class TextSink(Sink):
+    """以Prometheus文本格式写入文件，可配合node_exporter的textfile采集"""
+
+    def __init__(self, path:str):
+        self.path = path
+
+    def emit(self, snapshot:dict):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf8") as f:
+            f.write(format_text(snapshot))
+        os.replace(tmp, self.path)
+
+def format_text(snapshot:dict):
+    worker = snapshot["worker"]
+    lines = []
+    for name, topics in snapshot["counters"].items():
+        lines.append(f"# TYPE fasttq_{name}_total counter")
+        lines.extend(f'fasttq_{name}_total{{worker="{worker}",topic="{topic}"}} {value}' for topic, value in topics.items())
+    for name, topics in snapshot["gauges"].items():
+        lines.append(f"# TYPE fasttq_{name} gauge")
+        lines.extend(f'fasttq_{name}{{worker="{worker}",topic="{topic}"}} {value}' for topic, value in topics.items())
+    for name, topics in snapshot["histograms"].items():
+        lines.append(f"# TYPE fasttq_{name} histogram")
+        for topic, h in topics.items():
+            total = 0
+            for le, n in zip(BUCKETS, h["counts"]):
+                total += n
+                le = "+Inf" if le==float("inf") else le
+                lines.append(f'fasttq_{name}_bucket{{worker="{worker}",topic="{topic}",le="{le}"}} {total}')
+            lines.append(f'fasttq_{name}_sum{{worker="{worker}",topic="{topic}"}} {h["sum"]}')
+            lines.append(f'fasttq_{name}_count{{worker="{worker}",topic="{topic}"}} {h["count"]}')
+    return "\n".join(lines)+"\n"
+
+class Metrics:
+    """
+    进程内指标，计数和直方图的更新只有一次加锁的字典操作，可以常开。
+    flush按interval节流，把快照输出到所有sink。
+    """
+
+    def __init__(self, worker:str = None, sinks:List[Sink] = None, interval:float = 10.0):
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        self.sinks = sinks or []
+        self.interval = interval
+        self.counters = defaultdict(lambda:defaultdict(int))
+        self.gauges = defaultdict(dict)
+        self.histograms = defaultdict(lambda:defaultdict(Histogram))
+        self.lock = threading.Lock()
+        self.flushed_at = time.time()
+
+    def incr(self, name:str, topic:Union[str, bytes], n:int = 1):
+        with self.lock:
+            self.counters[name][to_str(topic)] += n
+
+    def observe(self, name:str, topic:Union[str, bytes], seconds:float):
+        with self.lock:
+            self.histograms[name][to_str(topic)].observe(seconds)
+
+    def gauge(self, name:str, topic:Union[str, bytes], value:float):
+        with self.lock:
+            self.gauges[name][to_str(topic)] = value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                worker=self.worker,
+                host=socket.gethostname(),
+                pid=os.getpid(),
+                ts=time.time(),
+                counters={name:dict(topics) for name, topics in self.counters.items()},
+                gauges={name:dict(topics) for name, topics in self.gauges.items()},
+                histograms={name:{topic:h.dump() for topic, h in topics.items()} for name, topics in self.histograms.items()},
+            )
+
+    def due(self):
+        return len(self.sinks)>0 and time.time()-self.flushed_at>=self.interval
+
+    def flush(self, force:bool = False):
+        if not force and not self.due():
+            return None
+        self.flushed_at = time.time()
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            try:
+                sink.emit(snapshot)
+            except Exception:
+                pass
+        return snapshot
@@ -9,23 +9,23 @@
 queue.py -- 任务处理器注册和任务注册的装饰器，以及启动任意多个Worker子进程
 """
 
-from typing import Callable, Dict, List, Union
-from multiprocessing import Process, Pool, cpu_count
-from urllib import parse
+from typing import Callable, Dict, Iterable, List, Union
+from multiprocessing import Process, Queue, cpu_count, get_context, get_all_start_methods
+from queue import Empty, Full
 from functools import partial
-import psutil
-import os
-import signal
-import platform
-if platform.system()=='Windows':
-    def oskill(pid:int, signal:signal):
-        os.popen(f"taskkill /pid:{pid}")
-else:
-    def oskill(pid:int, signal:signal):
-        os.kill(pid, signal)
-
-from .client import Client, serialize, func2str
-from .worker import Pusher, Worker, Assignor
+import itertools
+import inspect
+import json
+import time
+import uuid
+import sys
+
+from .client import Client, serialize, func2str, str2handlers, iter2chunk, to_str
+from .codec import Codec
+from .worker import Pusher, Worker, Assignor, EXIT_RECYCLE
+from .aio import AsyncWorker
+from .results import ResultHandle
+from .supervisor import Supervisor
 
 def items2chunk(items:list, chunksize:int = 100):
     return (items[i*chunksize:(i+1)*chunksize] for i in range(len(items)//chunksize+1))
@@ -36,29 +36,72 @@ def items2dict(items:list):
 def dict2chunk(d:dict, chunksize:int = 100):
     return [items2dict(items) for items in items2chunk(list(d.items()), chunksize)]
 
-def start_worker(client_str:str, conn_url:str, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 0, retrys:int = 10, retry_delay:int = 1):
-    worker = Worker(client_str, conn_url, assignor, chunksize, retrys, retry_delay)
+# options中指定concurrency时启动AsyncWorker
+def start_worker(client_str:str, conn_url:str, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 0, retrys:int = 10, retry_delay:int = 1, **options):
+    worker_class = AsyncWorker if "concurrency" in options else Worker
+    worker = worker_class(client_str, conn_url, assignor, chunksize, retrys, retry_delay, **options)
     worker.work()
+    if worker.recycled:
+        sys.exit(EXIT_RECYCLE)
+
+# 任务生成函数是否支持分片参数 shard/shards，支持则由各推送进程各自生成自己的分片
+def accepts_shard(func:Callable):
+    try:
+        params = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    return "shard" in params and "shards" in params
+
+def topic2datas(topic:str, source:Union[Iterable, Dict]):
+    return source.items() if topic is None else ((topic, source),)
 
-def start_pusher(client_str:str, conn_url:str, topic:str = None, jobs:Union[List, Dict] = None):
-    pusher = Pusher(client_str, conn_url)
-    if topic is None:
-        pusher.push_topics(jobs)
-    else:
-        pusher.push_topic(topic, jobs)
+# 常驻推送进程：分片任务自己生成，其余任务从inbox领取原始数据chunk，序列化后用自己的连接池推入
+def start_pusher(client_str:str, conn_url:str, shard:int, shards:int, getJobs:list, inbox:Queue, outbox:Queue, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, window:int = 8, codec:Codec = None, kwargs:dict = None, backpressure:bool = True):
+    pusher = Pusher(client_str, conn_url, codec, backpressure)
+    total, start = 0, time.perf_counter()
+    for getJob in getJobs:
+        if accepts_shard(getJob):
+            for topic, datas in topic2datas(getJob.args[0], getJob(shard=shard, shards=shards, **(kwargs or {}))):
+                total += pusher.push(topic, datas, retrys, retry_delay, chunksize, window)
+        else:
+            for topic, chunks in iter(inbox.get, None):
+                total += pusher.push_chunks(topic, chunks, retrys, retry_delay, window)
+    seconds = time.perf_counter() - start
+    outbox.put(dict(shard=shard, jobs=total, seconds=seconds, rate=total/seconds if seconds>0 else 0.0))
+
+# 推送进程全部退出后inbox不再被消费，按timeout秒等待并检查推送进程是否存活；没有存活的推送进程时返回False
+def put_alive(inbox:Queue, item, pushers:List[Process], timeout:float = 1.0):
+    while True:
+        try:
+            inbox.put(item, timeout=timeout)
+            return True
+        except Full:
+            if not any(process.is_alive() for process in pushers):
+                return False
 
 class FastQueue:
 
     _workers:Dict[str, Process] = {}
 
-    def __init__(self, client:Client):
+    def __init__(self, client:Client, codec:Codec = None):
         self.client = client
-        self._stop = False
+        self.codec = codec
         self.getJobs = []
+        self._supervisor:Supervisor = None
+        self._context = get_context()
 
-    def register(self, topic:str, before:Callable = None, after:Callable = None):
+    # priority越大越优先；batch=True时处理器一次接收整个chunk的任务数据列表，返回等长的结果列表；
+    # teardown(topic, context)在before构建的context被Worker淘汰或Worker退出时调用；
+    # high_watermark>0时，推送使队列深度超过high_watermark后阻塞，直到降到low_watermark（默认一半）以下，最长watermark_timeout秒；
+    # rate_limit>0时，所有Worker合计每秒最多从该topic（含topic#xxxx）出队rate_limit个，允许突发rate_burst个（默认1秒的量）
+    def register(self, topic:str, before:Callable = None, after:Callable = None, priority:int = 0, batch:bool = False, teardown:Callable = None, high_watermark:int = 0, low_watermark:int = None, watermark_timeout:float = 60, rate_limit:float = 0, rate_burst:int = None):
+        limits = {}
+        if high_watermark>0:
+            limits.update(high_watermark=high_watermark, low_watermark=high_watermark//2 if low_watermark is None else low_watermark, watermark_timeout=watermark_timeout)
+        if rate_limit>0:
+            limits.update(rate_limit=rate_limit, rate_burst=rate_burst or max(int(rate_limit), 1))
         def decorator(handle:Callable):
-            self.client.register(topic, handle, before, after)
+            self.client.register(topic, handle, before, after, priority, batch, teardown, limits)
             return handle
         return decorator        
 
@@ -68,38 +111,84 @@ class FastQueue:
             return self.getJobs
         return decorator        
 
-    def pending(self, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, **kwargs):
+    # 延迟任务的到期时间：eta为时间戳或datetime，countdown为从现在起的秒数
+    def due(self, eta = None, countdown:float = None):
+        if eta is not None:
+            return eta.timestamp() if hasattr(eta, "timestamp") else float(eta)
+        if countdown is not None:
+            return time.time()+countdown
+        return None
+
+    # 按chunk推入，队列深度超过注册的背压水位时阻塞（backpressure=False时不限制）；指定了到期时间时写入延迟队列，到期后由Worker移入任务队列
+    def push_chunks(self, topic:str, chunks:Iterable[List[bytes]], window:int = 8, due:float = None, backpressure:bool = True):
+        if due is None:
+            return self.client.push_chunks(topic, chunks, window, *(self.client.get_watermarks(topic) if backpressure else ()))
+        return sum(self.client.push_delayed(topic, chunk, due) for chunk in chunks)
+
+    # 流式推送：惰性拉取任务数据，逐chunk序列化，每window个chunk一次管道推入，内存占用与任务总数无关
+    def push(self, topic:str, datas:Iterable, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, window:int = 8, eta = None, countdown:float = None, backpressure:bool = True):
+        chunks = ([serialize(data, retrys, retry_delay, self.codec) for data in chunk] for chunk in iter2chunk(datas, chunksize))
+        return self.push_chunks(topic, chunks, window, self.due(eta, countdown), backpressure)
+
+    # 提交任务并返回结果句柄：任务信封带上提交批次reply和批内序号id，Worker处理后把结果批量写回，ttl秒后过期
+    def submit(self, topic:str, datas:Iterable, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, window:int = 8, ttl:float = 3600, eta = None, countdown:float = None):
+        reply, ids = uuid.uuid4().hex, itertools.count()
+        chunks = ([serialize(data, retrys, retry_delay, self.codec, id=next(ids), reply=reply, ttl=ttl) for data in chunk] for chunk in iter2chunk(datas, chunksize))
+        count = self.push_chunks(topic, chunks, window, self.due(eta, countdown))
+        return ResultHandle(self.client, reply, count, ttl)
+
+    def pending(self, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, window:int = 8, backpressure:bool = True, **kwargs):
         for getJob in self.getJobs:
             topic = getJob.args[0]
             if topic is None:
-                for chunk in dict2chunk(jobs, chunksize):
-                    for topic, data in chunk.items():
-                        jobs = [serialize(d, retrys, retry_delay) for d in data]
-                        self.client.push_topic(topic, jobs)
+                for topic, datas in getJob(**kwargs).items():
+                    self.push(topic, datas, retrys, retry_delay, chunksize, window, backpressure=backpressure)
             else:
-                jobs = [serialize(data, retrys, retry_delay) for data in getJob(**kwargs)]
-                for chunk in items2chunk(jobs, chunksize):
-                    self.client.push_topic(topic, chunk)
+                self.push(topic, getJob(**kwargs), retrys, retry_delay, chunksize, window, backpressure=backpressure)
 
     #########################################################################################
-    # 方案3.0，替换成Pool模式
-    def pending_mp(self, client_str:str, conn_url:str, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, **kwargs):
-        for getJob in self.getJobs:
-            topic = getJob.args[0]
-            if topic is None:
-                jobs = {topic:serialize(data, retrys, retry_delay) for topic, data in getJob(**kwargs).items()}
-                chunks = dict2chunk(jobs, chunksize)
-            else:
-                jobs = [serialize(data, retrys, retry_delay) for data in getJob(**kwargs)]
-                chunks = items2chunk(jobs, chunksize)
-            with Pool(processes=cpu_count()) as pool:
-                for chunk in chunks:
-                    pool.apply_async(
-                        start_pusher,
-                        (client_str, conn_url, topic, chunk)
-                    )
-                pool.close()
-                pool.join()
+    # 方案4.0，常驻推送进程并行序列化和推送
+    # 任务生成函数声明了shard/shards参数时，每个推送进程只生成并推送自己的分片，父进程不经手任何任务；
+    # 否则父进程只负责迭代生成器，把原始数据按window个chunk一组经有界队列分发，序列化和推送在子进程完成。
+    # 返回每个分片的推送统计：[{"shard", "jobs", "seconds", "rate"}, ...]
+    def pending_mp(self, client_str:str, conn_url:str, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, processes:int = None, window:int = 8, backpressure:bool = True, **kwargs):
+        processes = processes or cpu_count()
+        inbox, outbox = Queue(maxsize=processes*2), Queue()
+        pushers = []
+        for shard in range(processes):
+            process = Process(
+                target=start_pusher,
+                args=(client_str, conn_url, shard, processes, self.getJobs, inbox, outbox, retrys, retry_delay, chunksize, window, self.codec, kwargs, backpressure))
+            process.daemon = True
+            process.start()
+            pushers.append(process)
+
+        def feed():
+            for getJob in self.getJobs:
+                if accepts_shard(getJob):
+                    continue
+                for topic, datas in topic2datas(getJob.args[0], getJob(**kwargs)):
+                    for chunks in iter2chunk(iter2chunk(datas, chunksize), window):
+                        yield topic, chunks
+                for _ in pushers:
+                    yield None
+        # 推送进程全部退出后停止分发
+        alive = all(put_alive(inbox, item, pushers) for item in feed())
+
+        stats = []
+        while len(stats)<len(pushers):
+            try:
+                stats.append(outbox.get(timeout=1))
+            except Empty:
+                if not any(process.is_alive() for process in pushers):
+                    break
+        for process in pushers:
+            process.join()
+        # 推送进程异常退出时有任务没有推送，不能当作推送完成
+        failed = {shard:process.exitcode for shard, process in enumerate(pushers) if process.exitcode!=0}
+        if len(failed)>0 or not alive:
+            raise RuntimeError(f"pushers exited abnormally {failed}, {sum(s['jobs'] for s in stats)} jobs pushed")
+        return sorted(stats, key=lambda s:s["shard"])
 
     #########################################################################################
     # 方案2.0，可以任务数据函数用装饰器注入self.getJobs
@@ -144,67 +233,79 @@ class FastQueue:
     #         process = self.start_pusher(client_str, conn_url, None, chunk, daemon=False)
     #         process.join()
 
-    def topic(self, topic:str, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100):
+    def topic(self, topic:str, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, window:int = 8):
         def decorator(func:Callable):
-            jobs = [serialize(data, retrys, retry_delay) for data in func()]
-            for chunk in items2chunk(jobs, chunksize):
-                self.client.push_topic(topic, chunk)
+            self.push(topic, func(), retrys, retry_delay, chunksize, window)
         return decorator
 
-    def topics(self, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100):
+    def topics(self, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, window:int = 8):
         def decorator(func:Callable):
-            for chunk in dict2chunk(func(), chunksize):
-                for topic, data in chunk.items():
-                    jobs = [serialize(d, retrys, retry_delay) for d in data]
-                    self.client.push_topic(topic, jobs)
+            for topic, datas in func().items():
+                self.push(topic, datas, retrys, retry_delay, chunksize, window)
         return decorator
 
+    # 汇总所有worker最近一次上报的指标（max_age秒内没有再上报的视为已退出），以及活跃topic当前的队列深度
+    def metrics(self, max_age:float = 600):
+        workers = {to_str(worker):json.loads(metrics) for worker, metrics in self.client.get_metrics(max_age).items()}
+        depths = self.client.get_depths(self.client.get_topics())
+        return dict(workers=workers, depths={to_str(topic):depth for topic, depth in depths.items()})
+
+    # 收集已退出的子进程，返回仍在运行的进程数
     def clear_worker(self):
-        # 收集死进程
-        _tobekill = []
-        for pid, process in self._workers.items():
-            if not process.is_alive():
-                _tobekill.append(pid)
-
-        if len(self._workers)==len(_tobekill):
-            self._stop = True
-
-        # 清理死进程
-        for pid in _tobekill:
-            self._workers.pop(pid)
-            # os.kill(pid, signal.CTRL_C_EVENT)
-            if psutil.pid_exists(pid):
-                # print(f"Workser({pid}): 销毁成功！", "#"*40)
-                oskill(pid, signal.SIGBREAK)
-        
-        return len(_tobekill) + len(self._workers)
+        for pid in [pid for pid, process in self._workers.items() if not process.is_alive()]:
+            self._workers.pop(pid).join()
+        return len(self._workers)
+
+    # 终止Supervisor及其管理的所有Worker
+    def stop(self):
+        if self._supervisor is not None:
+            self._supervisor.stop()
         
-    def start_worker(self, client_str:str, conn_url:str, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 100, retrys:int = 10, retry_delay:int = 1, daemon:bool = True):
-        process = Process(
+    # 预热的Worker模板：forkserver进程预先导入客户端模块和所有已注册处理器的模块，之后的Worker都从它fork，
+    # 共享已加载的模块（写时复制），重启一个Worker只需要fork而不是重新导入；不支持forkserver的平台沿用默认方式
+    def preload(self, client_str:str):
+        if "forkserver" not in get_all_start_methods():
+            return get_context()
+        modules = {"__main__", "fasttq", client_str.rpartition(".")[0]}
+        _, registry = self.client.get_registry()
+        for s in registry.values():
+            handlers = str2handlers(s)
+            modules.update(handlers[k].rpartition(".")[0] for k in ("handle", "before", "after", "teardown") if handlers[k])
+        context = get_context("forkserver")
+        # 模板进程启动后预加载列表不再生效，同一进程内只有第一次start_workers的注册表会被预加载
+        context.set_forkserver_preload(sorted(modules))
+        return context
+
+    # options透传给Worker，如 blocking=True；指定concurrency时使用AsyncWorker
+    def start_worker(self, client_str:str, conn_url:str, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 100, retrys:int = 10, retry_delay:int = 1, daemon:bool = True, **options):
+        process = self._context.Process(
             target=start_worker, 
-            args=(client_str, conn_url, assignor, chunksize, retrys, retry_delay))
+            args=(client_str, conn_url, assignor, chunksize, retrys, retry_delay),
+            kwargs=options)
         process.daemon = daemon
         process.start()
         return process
 
-    def start_workers(self, client_str:str, conn_url:str, workers:int = 1, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 100, retrys:int = 10, retry_delay:int = 1):
-        # 补充新进程
-        while not self._stop:
-            while(workers-1>len(self._workers)):
-                process = self.start_worker(client_str, conn_url, assignor, chunksize, retrys, retry_delay)
-                self._workers[process.pid] = process
-                # print(f"Workser({process.pid}): 创建成功({workers}/{len(self._workers)})！", "#"*40)
-            workers = self.clear_worker()
-        # for pid, process in self._workers.items():
-        #     process.close()
-        #     process.join()
-
-    def start(self, workers:int = 1, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 100, retrys:int = 10, retry_delay:int = 1, **kwargs):
+    # 由Supervisor管理workers个Worker进程，所有Worker空闲退出且队列为空时返回；
+    # 指定max_workers时按队列深度在[workers, max_workers]之间自动扩缩容，supervisor_options透传给Supervisor；
+    # preload=True时Worker从预热的模板进程fork
+    def start_workers(self, client_str:str, conn_url:str, workers:int = 1, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 100, retrys:int = 10, retry_delay:int = 1, max_workers:int = None, supervisor_options:dict = None, preload:bool = False, **options):
+        self._context = self.preload(client_str) if preload else get_context()
+        spawn = partial(self.start_worker, client_str, conn_url, assignor, chunksize, retrys, retry_delay, **options)
+        self._supervisor = Supervisor(spawn, self.client, workers, max_workers, **(supervisor_options or {}))
+        self._workers = self._supervisor.workers
+        self._supervisor.run()
+
+    # kwargs透传给任务生成函数，worker_options透传给Worker；
+    # 启动时先推送再启动Worker，此时还没有消费者，背压等待不到队列回落，所以启动推送不受背压水位限制
+    def start(self, workers:int = 1, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 100, retrys:int = 10, retry_delay:int = 1, worker_options:dict = None, max_workers:int = None, preload:bool = False, **kwargs):
         client_str = func2str(self.client)
-        self.pending(retrys, retry_delay, **kwargs)
-        self.start_workers(client_str, self.client.conn_url, workers, assignor, chunksize, retrys, retry_delay)
+        self.client.rebuild_active()
+        self.pending(retrys, retry_delay, backpressure=False, **kwargs)
+        self.start_workers(client_str, self.client.conn_url, workers, assignor, chunksize, retrys, retry_delay, max_workers, preload=preload, **(worker_options or {}))
         
-    def start_mp(self, workers:int = 1, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 100, retrys:int = 10, retry_delay:int = 1, **kwargs):
+    def start_mp(self, workers:int = 1, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 100, retrys:int = 10, retry_delay:int = 1, worker_options:dict = None, max_workers:int = None, preload:bool = False, **kwargs):
         client_str = func2str(self.client)
-        self.pending_mp(client_str, self.client.conn_url, retrys, retry_delay, chunksize, **kwargs)
-        self.start_workers(client_str, self.client.conn_url, workers, assignor, chunksize, retrys, retry_delay)
+        self.client.rebuild_active()
+        self.pending_mp(client_str, self.client.conn_url, retrys, retry_delay, chunksize, backpressure=False, **kwargs)
+        self.start_workers(client_str, self.client.conn_url, workers, assignor, chunksize, retrys, retry_delay, max_workers, preload=preload, **(worker_options or {}))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/08/20 09:17:45
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+ratelimit.py -- 分布式令牌桶：限制所有Worker合计从某个topic出队的速率，保护下游服务
+"""
+
+from collections import defaultdict
+from typing import Dict, List, Tuple, Union
+
+from .client import Client
+from .scheduler import Topics, base_topic
+
+class RateLimiter:
+    """
+    每个注册了rate_limit的topic一个令牌桶（topic#xxxx共用topic的桶），速率rate_limit个/秒，容量rate_burst个。
+    Worker出队前按本次出队额度，一次往返批量补足所有候选topic的令牌；没用完的令牌留在本地下次出队使用，退出时归还。
+    因此短时间内最多超出 每个Worker的chunksize 个。
+    """
+
+    def __init__(self, client:Client):
+        self.client = client
+        self.limits:Dict[str, Tuple[float, int]] = {}
+        self.tokens:Dict[str, int] = defaultdict(int)
+        # 所有受限topic都没有令牌时，下一个令牌还需等待的秒数
+        self.wait = 0.0
+
+    # 从注册表的流控参数配置各topic的速率 {topic: limits}
+    def configure(self, limits:Dict[str, dict]):
+        self.limits = {topic:(float(l["rate_limit"]), int(l["rate_burst"])) for topic, l in limits.items() if l.get("rate_limit", 0)>0}
+
+    def limited(self, topic:Union[str, bytes]):
+        return base_topic(topic) in self.limits
+
+    # 为候选topic补足budget个令牌，返回本轮可以出队的topic（不受限或持有令牌的）
+    def acquire(self, topics:Topics, budget:int):
+        if len(self.limits)<1 or budget<1:
+            return topics
+        bases = {base_topic(topic) for topic, _ in topics if self.limited(topic)}
+        wants = {base:(*self.limits[base], budget-self.tokens[base]) for base in bases if self.tokens[base]<budget}
+        waits = []
+        for base, (n, wait) in self.client.acquire_tokens(wants).items():
+            self.tokens[base] += n
+            if self.tokens[base]<1:
+                waits.append(wait)
+        self.wait = min(waits, default=0.0)
+        return [(topic, score) for topic, score in topics if not self.limited(topic) or self.tokens[base_topic(topic)]>0]
+
+    # 本次最多可以出队的任务数
+    def clamp(self, topic:Union[str, bytes], n:int):
+        return min(n, self.tokens[base_topic(topic)]) if self.limited(topic) else n
+
+    # 一组topic一次阻塞出队的上限
+    def clamp_all(self, topics:List[Union[str, bytes]], n:int):
+        return min([n]+[self.tokens[base_topic(topic)] for topic in topics if self.limited(topic)])
+
+    def consume(self, topic:Union[str, bytes], n:int):
+        if self.limited(topic):
+            self.tokens[base_topic(topic)] -= n
+
+    # 归还本地没用完的令牌
+    def release(self):
+        held = {base:(*self.limits[base], -n) for base, n in self.tokens.items() if n>0 and base in self.limits}
+        self.tokens.clear()
+        if len(held)>0:
+            self.client.acquire_tokens(held)
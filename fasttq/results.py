@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/07/09 10:12:45
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+results.py -- 任务结果的流式输出：处理器结果按批写出，不在内存中累积整个chunk；以及生产者等待任务结果的句柄
+"""
+
+from typing import Any, Callable, Iterable
+from functools import partial
+import time
+
+from .client import Client, unserialize
+
+class ResultSink(list):
+    """
+    结果缓冲，可以直接作为 context["_result"] 使用。
+    缓冲满 flush_size 个结果，或距上次输出超过 flush_interval 秒时，调用 output 一次写出缓冲的结果并清空。
+    仍然是list，after回调看到的是尚未输出的结果。
+    """
+
+    def __init__(self, output:Callable[[list], Any], flush_size:int = 100, flush_interval:float = 1.0):
+        super().__init__()
+        self.output = output
+        self.flush_size = max(flush_size, 1)
+        self.flush_interval = flush_interval
+        self.flushed_at = time.time()
+        self.total = 0
+
+    def append(self, rs:Any):
+        super().append(rs)
+        if len(self)>=self.flush_size or time.time()-self.flushed_at>=self.flush_interval:
+            self.flush()
+
+    def extend(self, results:Iterable):
+        for rs in results:
+            self.append(rs)
+
+    def flush(self):
+        self.flushed_at = time.time()
+        if len(self)<1:
+            return 0
+        results = list(self)
+        self.clear()
+        self.output(results)
+        self.total += len(results)
+        return len(results)
+
+class TopicSink(ResultSink):
+    """按批推入下游topic，每批一次事务管道"""
+
+    def __init__(self, client:Client, topic:str, flush_size:int = 100, flush_interval:float = 1.0):
+        super().__init__(partial(client.push_topic, topic), flush_size, flush_interval)
+        self.topic = topic
+
+class JobError(Exception):
+    """任务重试用尽后仍然失败，作为该任务的结果返回"""
+
+    def __init__(self, id:int, error:str):
+        super().__init__(f"job {id} failed: {error}")
+        self.id = id
+        self.error = error
+
+class ResultHandle:
+    """
+    FastQueue.submit返回的句柄，对应一次提交的count个任务。
+    Worker按chunk批量写回结果，句柄阻塞等待并一次取回已到达的一批，不需要逐个任务轮询。
+    结果取出后即从存储中删除，同一句柄只能消费一次。
+    """
+
+    def __init__(self, client:Client, reply:str, count:int, ttl:float = 3600):
+        self.client = client
+        self.reply = reply
+        self.count = count
+        self.ttl = ttl
+        self._seen = set()
+
+    def __len__(self):
+        return self.count
+
+    # 按完成顺序产出 (任务序号, 结果)，失败的任务结果为JobError；timeout秒内未全部完成抛出TimeoutError
+    def as_completed(self, timeout:float = None, chunksize:int = 100):
+        deadline = None if timeout is None else time.time()+timeout
+        while len(self._seen)<self.count:
+            wait = 1.0 if deadline is None else deadline-time.time()
+            if wait<=0:
+                raise TimeoutError(f"{self.count-len(self._seen)} of {self.count} jobs not completed")
+            for raw in self.client.wait_results(self.reply, min(chunksize, self.count-len(self._seen)), wait):
+                job = unserialize(raw)
+                # 可靠模式下任务可能被重复执行，按序号去重
+                if job["id"] in self._seen:
+                    continue
+                self._seen.add(job["id"])
+                yield job["id"], (job["data"] if job["ok"] else JobError(job["id"], job["data"]))
+
+    # 按提交顺序返回全部结果
+    def gather(self, timeout:float = None, chunksize:int = 100):
+        results = [None]*self.count
+        for id, rs in self.as_completed(timeout, chunksize):
+            results[id] = rs
+        return results
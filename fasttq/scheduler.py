@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/07/23 09:36:18
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+scheduler.py -- Worker在多个topic之间分配出队额度：严格优先级、轮询（每topic定额）和加权公平
+"""
+
+from abc import ABC, abstractmethod
+from itertools import groupby
+from typing import Dict, Generator, List, Tuple, Union
+import math
+
+from .client import to_str
+
+Topics = List[Tuple[Union[str, bytes], float]]
+
+def base_topic(topic:Union[str, bytes]):
+    return to_str(topic).partition("#")[0]
+
+class Scheduler(ABC):
+    """
+    plan是一个生成器：产出 (topic, 本次出队数)，调用方用send回传实际取到的任务数，
+    取到的少于请求数说明该topic已取空，本轮不再分配。topics为活跃topic及其优先级，按优先级从高到低。
+    quantum为每个topic每次出队的上限，小于1时每轮把剩余额度平分给仍有任务的topic（向上取整）。
+    """
+
+    def __init__(self, quantum:int = 1):
+        self.quantum = max(quantum, 0)
+
+    @abstractmethod
+    def plan(self, topics:Topics, budget:int) -> Generator[Tuple[bytes, int], int, None]:
+        pass
+
+    # 在一组topic中轮流分配，每次最多quantum个（或本轮的平分额度），直到额度用完或都取空
+    def rotate(self, topics:list, budget:int, quanta:Dict[str, int] = None):
+        live = list(topics)
+        while len(live)>0 and budget>0:
+            quantum = self.quantum or math.ceil(budget/len(live))
+            for topic in list(live):
+                n = min((quanta or {}).get(base_topic(topic), quantum), budget)
+                got = yield topic, n
+                budget -= got
+                if got<n:
+                    live.remove(topic)
+                if budget<1:
+                    break
+        return budget
+
+class StrictPriority(Scheduler):
+    """高优先级的topic取空之前不会从低优先级的topic出队，同一优先级内轮流"""
+
+    def plan(self, topics:Topics, budget:int):
+        for _, tier in groupby(topics, key=lambda item:item[1]):
+            budget = yield from self.rotate([topic for topic, _ in tier], budget)
+            if budget<1:
+                return
+
+class RoundRobin(Scheduler):
+    """忽略优先级，每轮从下一个topic开始轮流出队，每个topic每次最多quanta[topic]（默认quantum）个"""
+
+    def __init__(self, quantum:int = 1, quanta:Dict[str, int] = None):
+        super().__init__(quantum)
+        self.quanta = quanta or {}
+        self.turn = 0
+
+    def plan(self, topics:Topics, budget:int):
+        topics = [topic for topic, _ in topics]
+        if len(topics)<1:
+            return
+        self.turn = (self.turn+1)%len(topics)
+        yield from self.rotate(topics[self.turn:]+topics[:self.turn], budget, self.quanta)
+
+class WeightedFair(Scheduler):
+    """
+    加权公平（差额轮询）：每轮按权重 priority+1 把额度分给各topic，没用完的份额累积到下一轮，
+    长期看各topic的出队数与权重成正比，低优先级的topic不会被饿死。
+    """
+
+    def __init__(self, quantum:int = 1):
+        super().__init__(quantum)
+        self.deficits:Dict[bytes, float] = {}
+
+    def weight(self, priority:float):
+        return max(priority, 0)+1
+
+    def plan(self, topics:Topics, budget:int):
+        weights = {topic:self.weight(priority) for topic, priority in topics}
+        self.deficits = {topic:deficit for topic, deficit in self.deficits.items() if topic in weights}
+        live = list(weights)
+        while len(live)>0 and budget>0:
+            total = sum(weights[topic] for topic in live)
+            for topic in live:
+                self.deficits[topic] = self.deficits.get(topic, 0)+budget*weights[topic]/total
+            # 累积份额多的topic先出队，额度不够时欠下的份额留到下一轮
+            for topic in sorted(live, key=self.deficits.get, reverse=True):
+                n = min(int(self.deficits[topic]), budget)
+                if n<1:
+                    continue
+                got = yield topic, n
+                budget -= got
+                self.deficits[topic] -= got
+                if got<n:
+                    live.remove(topic)
+                    self.deficits[topic] = 0
+                if budget<1:
+                    return
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/08/13 10:21:37
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+sharded.py -- 多个Redis实例分片存放任务队列，按一致性哈希定位topic，吞吐随实例数水平扩展
+"""
+
+from typing import Dict, List, Union
+from redis import Redis, ConnectionPool
+import hashlib
+import bisect
+import random
+
+from .client import Client, RedisClient, iter2chunk, to_str
+
+class HashRing:
+    """一致性哈希环：每个节点replicas个虚拟节点，按节点url计算位置，增加一个节点只有约1/N的键改变归属"""
+
+    def __init__(self, nodes:List[str], replicas:int = 160):
+        points = sorted((self.hash(f"{node}#{i}"), index) for index, node in enumerate(nodes) for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [index for _, index in points]
+
+    @staticmethod
+    def hash(key:Union[str, bytes]):
+        return int.from_bytes(hashlib.md5(key if isinstance(key, bytes) else key.encode("utf8")).digest()[:8], "big")
+
+    # 键所在节点的序号
+    def get(self, key:Union[str, bytes]):
+        return self._nodes[bisect.bisect(self._hashes, self.hash(key))%len(self._hashes)]
+
+class ShardedRedisClient(RedisClient):
+    """
+    conn_url为逗号分隔的多个Redis地址，如 redis://10.0.0.1:6379/0,redis://10.0.0.2:6379/0 ，每个实例一个连接池。
+    - 任务队列 fasttq:jobs:<topic>（按完整topic，topic#xxxx分散到不同实例）连同该实例的活跃topic索引、延迟任务、
+      可靠模式的处理中列表和租约按一致性哈希存放在同一个实例上，出队、确认、回收的Lua脚本都在单个实例内原子执行
+    - 结果列表和blob按键分布；注册表、worker登记、独占租约、亲和关系和指标存放在第一个实例上
+    - topic优先级（fasttq:topics）复制到每个实例，供各实例上的脚本读取
+    - 多个topic的推送和队列深度按实例分组，每个实例一次管道往返；get_topics合并各实例的活跃topic，
+      同优先级的topic在各实例之间交错，每个客户端从不同的实例开始，多个Worker均衡地分布在各实例上
+    - 增加实例后只有约1/N的topic改变归属，rebuild_active（start/start_mp启动时执行）把归属改变的任务队列迁移到新的实例
+    """
+
+    def __init__(self, conn_url:str, replicas:int = 160):
+        self.urls = [url.strip() for url in conn_url.split(",") if len(url.strip())>0]
+        super().__init__(self.urls[0])
+        self.conn_url = conn_url
+        self.pools = [self.pool]+[ConnectionPool.from_url(url) for url in self.urls[1:]]
+        self.ring = HashRing(self.urls, replicas)
+        self._offset = random.randrange(len(self.pools))
+        self._waits = 0
+
+    # 通用异步适配，redis.asyncio客户端只连接单个实例
+    def aio(self):
+        return Client.aio(self)
+
+    def connect_shard(self, index:int):
+        return Redis(connection_pool=self.pools[index])
+
+    def shard_index(self, topic:Union[str, bytes]):
+        return self.ring.get(to_str(topic))
+
+    def shard(self, topic:Union[str, bytes]):
+        return self.connect_shard(self.shard_index(topic))
+
+    def shards(self):
+        return [self.connect_shard(index) for index in range(len(self.pools))]
+
+    # 按所在实例分组，保持topic原来的顺序
+    def group(self, topics:List[str]):
+        groups:Dict[int, List[str]] = {}
+        for topic in topics:
+            groups.setdefault(self.shard_index(topic), []).append(topic)
+        return groups
+
+    # 注册表写入第一个实例，优先级复制到其他实例
+    def register(self, topic:str, handle, before, after, priority:int = 0, batch:bool = False, teardown = None, limits:dict = None):
+        rs = super().register(topic, handle, before, after, priority, batch, teardown, limits)
+        for conn in self.shards()[1:]:
+            with conn:
+                conn.zadd(self.default_topics_header, {topic:priority})
+        return rs
+
+    def unregister(self, topic:str):
+        rs = super().unregister(topic)
+        for conn in self.shards()[1:]:
+            with conn:
+                conn.zrem(self.default_topics_header, topic)
+        return rs
+
+    # 同一实例上的多个topic合并为一次事务管道往返
+    def _push_topics(self, jobs:Dict[str, List], left:bool = True):
+        counts = {}
+        for index, topics in self.group([topic for topic, _jobs in jobs.items() if len(_jobs)>0]).items():
+            with self.connect_shard(index) as conn:
+                priorities = {to_str(topic):self.priority(conn, topic) for topic in topics}
+                with conn.pipeline(transaction=True) as pipe:
+                    for topic in topics:
+                        pipe.lpush(self.jobs_key(topic), *jobs[topic]) if left else pipe.rpush(self.jobs_key(topic), *jobs[topic])
+                    pipe.zadd(self.default_active_header, priorities)
+                    counts.update(zip(topics, pipe.execute()))
+        return {topic:counts.get(topic, 0) for topic in jobs}
+
+    def push_topics(self, jobs:Dict[str, List], retrys:int = 1, retry_delay:float = 1.0):
+        return self._push_topics(jobs)
+
+    def insert_topics(self, jobs:Dict[str, List]):
+        return self._push_topics(jobs, left=False)
+
+    # 合并各实例的活跃topic：按优先级从高到低，同优先级时各实例交错，从本客户端的起始实例开始
+    def get_topics(self, withscores:bool = False):
+        items = []
+        for index, conn in enumerate(self.shards()):
+            with conn:
+                topics = conn.zrevrange(self.default_active_header, 0, -1, withscores=True)
+            order = (index-self._offset)%len(self.pools)
+            items.extend((-score, rank, order, topic) for rank, (topic, score) in enumerate(topics))
+        items.sort()
+        return [(topic, -score) for score, _, _, topic in items] if withscores else [topic for _, _, _, topic in items]
+
+    def get_depths(self, topics:List[str]):
+        depths = {}
+        for index, _topics in self.group(topics).items():
+            with self.connect_shard(index) as conn:
+                with conn.pipeline(transaction=False) as pipe:
+                    for topic in _topics:
+                        pipe.llen(self.jobs_key(topic))
+                    depths.update(zip(_topics, pipe.execute()))
+        return {topic:depths[topic] for topic in topics}
+
+    # 不能同时阻塞在多个实例上：各实例轮流阻塞等待 timeout/实例数 秒，每次从下一个实例开始
+    def wait_jobs(self, topics:List[str], chunksize:int = 1, timeout:float = 1.0):
+        groups = list(self.group(topics).values())
+        if len(groups)<2:
+            return super().wait_jobs(topics, chunksize, timeout)
+        self._waits += 1
+        start = self._waits%len(groups)
+        for _topics in groups[start:]+groups[:start]:
+            topic, jobs = super().wait_jobs(_topics, chunksize, timeout/len(groups))
+            if topic is not None:
+                return topic, jobs
+        return None, []
+
+    # 把不在一致性哈希所属实例上的任务队列（增加或调整实例后）迁移过去，放在目标队列的出队端，返回迁移的任务数。
+    # 先写入目标实例，成功后才从源实例删除已迁移的任务，中途失败时任务留在源实例上，不会丢失
+    def rebalance(self):
+        n = 0
+        for index, conn in enumerate(self.shards()):
+            with conn:
+                for key in conn.scan_iter(match=self.jobs_key("*"), count=1000):
+                    topic = to_str(self.key2topic(key))
+                    target = self.shard_index(topic)
+                    if target==index:
+                        continue
+                    jobs = conn.lrange(key, 0, -1)
+                    if len(jobs)<1:
+                        continue
+                    with self.connect_shard(target) as dst:
+                        priority = self.priority(dst, topic)
+                        with dst.pipeline(transaction=True) as pipe:
+                            for chunk in iter2chunk(jobs, 1000):
+                                pipe.rpush(key, *chunk)
+                            pipe.zadd(self.default_active_header, {topic:priority})
+                            pipe.execute()
+                    # 只删除已迁移的任务（出队端），期间新推入源实例的任务留待下一次迁移
+                    with conn.pipeline(transaction=True) as pipe:
+                        pipe.ltrim(key, 0, -len(jobs)-1)
+                        pipe.llen(key)
+                        if pipe.execute()[1]==0:
+                            conn.zrem(self.default_active_header, topic)
+                    n += len(jobs)
+        return n
+
+    # 补齐各实例上的优先级副本，迁移归属改变的任务队列，再重建各实例的活跃topic索引
+    def rebuild_active(self):
+        with self.connect() as conn:
+            priorities = dict(conn.zrange(self.default_topics_header, 0, -1, withscores=True))
+        if len(priorities)>0:
+            for conn in self.shards()[1:]:
+                with conn:
+                    conn.zadd(self.default_topics_header, priorities)
+        self.rebalance()
+        return super().rebuild_active()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/07/16 15:03:27
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+supervisor.py -- Worker子进程的事件驱动管理：退出重启、指数退避、按队列深度自动扩缩容
+"""
+
+from typing import Callable, Dict
+from multiprocessing import Process
+from multiprocessing.connection import wait
+import math
+import time
+
+from .client import Client
+from .worker import EXIT_RECYCLE
+
+class Supervisor:
+    """
+    阻塞等待子进程退出（sentinel）或下一次扩缩容检查，空闲时不占CPU。
+    - Worker达到max_jobs/max_rss_mb后主动退出（EXIT_RECYCLE），立即补充
+    - Worker因没有任务正常退出后，只有队列中重新出现任务（或还有延迟任务）才补充；until_idle=True时所有Worker退出且队列为空即返回
+    - 异常退出按 backoff*2^n 秒指数退避重启，最长max_backoff秒
+    - 设置了max_workers时，每scale_interval秒按队列总深度/jobs_per_worker在[min_workers, max_workers]之间调整进程数，
+      缩容不杀进程，由空闲的Worker自行退出
+    """
+
+    def __init__(self, spawn:Callable[[], Process], client:Client, min_workers:int = 1, max_workers:int = None, jobs_per_worker:int = 1000, scale_interval:float = 5.0, backoff:float = 1.0, max_backoff:float = 60.0, until_idle:bool = True):
+        self.spawn = spawn
+        self.client = client
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max(max_workers or self.min_workers, self.min_workers)
+        self.jobs_per_worker = max(jobs_per_worker, 1)
+        self.scale_interval = scale_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.until_idle = until_idle
+        self.workers:Dict[int, Process] = {}
+        self.target = self.min_workers
+        self.failures = 0
+        self.restart_at = 0.0
+        self.drained = False
+        self._stop = False
+
+    def depth(self):
+        return sum(self.client.get_depths(self.client.get_topics()).values())
+
+    def autoscale(self):
+        if self.max_workers>self.min_workers:
+            self.target = max(self.min_workers, min(self.max_workers, math.ceil(self.depth()/self.jobs_per_worker)))
+
+    # 收集已退出的子进程，按退出码决定补充方式
+    def reap(self):
+        for pid in [pid for pid, process in self.workers.items() if not process.is_alive()]:
+            process = self.workers.pop(pid)
+            process.join()
+            if process.exitcode==EXIT_RECYCLE:
+                self.failures = 0
+            elif process.exitcode==0:
+                self.failures = 0
+                self.drained = True
+            else:
+                self.failures += 1
+                self.restart_at = time.time()+min(self.backoff*2**(self.failures-1), self.max_backoff)
+
+    # 本轮需要补充的进程数
+    def wanted(self):
+        want = self.target-len(self.workers)
+        if want<1 or time.time()<self.restart_at:
+            return 0
+        if self.drained:
+            if self.depth()<1 and self.client.count_delayed()<1:
+                floor = 0 if self.until_idle else self.min_workers
+                return max(floor-len(self.workers), 0)
+            self.drained = False
+        return want
+
+    def run(self):
+        scaled_at = time.time()
+        try:
+            while not self._stop:
+                self.reap()
+                if time.time()-scaled_at>=self.scale_interval:
+                    scaled_at = time.time()
+                    self.autoscale()
+
+                for _ in range(self.wanted()):
+                    process = self.spawn()
+                    self.workers[process.pid] = process
+
+                if self.until_idle and len(self.workers)<1 and self.drained:
+                    break
+
+                timeout = max(scaled_at+self.scale_interval-time.time(), 0)
+                if self.restart_at>time.time():
+                    timeout = min(timeout, self.restart_at-time.time())
+                if len(self.workers)>0:
+                    wait([process.sentinel for process in self.workers.values()], timeout)
+                else:
+                    time.sleep(timeout)
+        except BaseException:
+            self.stop()
+            raise
+
+    def stop(self):
+        self._stop = True
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.workers.values():
+            process.join()
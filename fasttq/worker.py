@@ -10,47 +10,162 @@ worker.py -- 任务处理子进程
 """
 
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+import random
+import math
 import time
 from collections import defaultdict
 from functools import reduce
+import asyncio
+import inspect
+import psutil
+import socket
 import os
 
-from .client import Client, str2func, unserialize
+from .client import Client, str2func, str2handlers, serialize, unserialize, iter2chunk, to_str
+from .codec import Codec
+from .metrics import Metrics, ClientSink
+from .results import ResultSink, TopicSink
+from .scheduler import Scheduler, StrictPriority, RoundRobin, WeightedFair
+from .blob import load_blob
+from .context import ContextCache
+from .ratelimit import RateLimiter
+
+# Worker达到max_jobs/max_rss_mb主动退出时的进程退出码，Supervisor据此立即补充新进程
+EXIT_RECYCLE = 75
 
 class Assignor(Enum):
     PriorityOne = 0 # 按优先级广度遍历
     PriorityAll = 1 # 按优先级深度遍历
     RoundRobinOne = 2 # 轮询广度遍历
     RoundRobinAll = 3 # 轮询深度遍历
+    WeightedFair = 4 # 按优先级加权公平分配
+
+    # 深度遍历：每次出队从一个topic取满一批（chunksize）任务
+    @property
+    def chunked(self):
+        return self in (Assignor.PriorityAll, Assignor.RoundRobinAll, Assignor.WeightedFair)
+
+    # 广度遍历每轮把额度平分给各topic，一个topic只需一次出队
+    def scheduler(self, chunksize:int, quanta:dict = None) -> Scheduler:
+        quantum = chunksize if self.chunked else 0
+        if self in (Assignor.PriorityOne, Assignor.PriorityAll):
+            return StrictPriority(quantum)
+        if self in (Assignor.RoundRobinOne, Assignor.RoundRobinAll):
+            return RoundRobin(quantum, quanta)
+        return WeightedFair(quantum)
 
 class Pusher:
     
-    def __init__(self, client_str:str, conn_url:str):
+    def __init__(self, client_str:str, conn_url:str, codec:Codec = None, backpressure:bool = True):
         client_class = str2func(client_str)
         self.client:Client = client_class(conn_url)
+        self.codec = codec
+        self.backpressure = backpressure
+        self._watermarks = {}
+
+    # topic的背压水位，每个推送进程只查询一次；backpressure=False时不限制
+    def watermarks(self, topic:str):
+        if not self.backpressure:
+            return 0, 0, 0
+        topic = to_str(topic).partition("#")[0]
+        if topic not in self._watermarks:
+            self._watermarks[topic] = self.client.get_watermarks(topic)
+        return self._watermarks[topic]
 
     def push_topic(self, topic:str, jobs:list):
-        # print(f"Pusher({os.getpid()}): {len(jobs)}", "#"*40)
         return self.client.push_topic(topic, jobs)
 
     def push_topics(self, jobs:dict):
-        # print(f"Pusher({os.getpid()}): {len(jobs)}", "#"*40)
         return self.client.push_topics(jobs)
 
+    # 序列化一组原始任务数据chunk并一次管道推入
+    def push_chunks(self, topic:str, chunks:list, retrys:int = 1, retry_delay:float = 1.0, window:int = 8):
+        chunks = ([serialize(data, retrys, retry_delay, self.codec) for data in chunk] for chunk in chunks)
+        return self.client.push_chunks(topic, chunks, window, *self.watermarks(topic))
+
+    # 流式推入原始任务数据
+    def push(self, topic:str, datas, retrys:int = 1, retry_delay:float = 1.0, chunksize:int = 100, window:int = 8):
+        return self.push_chunks(topic, iter2chunk(datas, chunksize), retrys, retry_delay, window)
+
+# 同步Worker中的async def处理器：在新的事件循环中等待它执行完；需要并发执行时用AsyncWorker（worker_options指定concurrency）
+def resolve(rs):
+    return asyncio.run(rs) if inspect.iscoroutine(rs) else rs
+
+class BatchHandler:
+    """批处理器：一次接收一个chunk的任务数据列表，返回等长的结果列表，某一项为异常实例表示该任务失败"""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, datas:list, context:dict):
+        return self.func(datas, context)
+
 class Worker:
 
-    _handlers = {}
     _jobs = defaultdict(list)
     _stop = False 
     _topic = None
 
-    def __init__(self, client_str:str, conn_url:str, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 1, retrys:int = 10, retry_delay:int = 1):
+    def __init__(self, client_str:str, conn_url:str, assignor:Assignor = Assignor.PriorityOne, chunksize:int = 1, retrys:int = 10, retry_delay:int = 1, blocking:bool = False, reliable:bool = False, visibility_timeout:float = 300, threads:int = 0, metrics:bool = True, metrics_sinks:list = None, metrics_interval:float = 10.0, result_flush_size:int = 100, result_flush_interval:float = 1.0, max_jobs:int = 0, max_rss_mb:float = 0, quanta:dict = None, retry_backoff:bool = True, max_retry_delay:float = 300, handlers_check_interval:float = 1.0, context_cache:int = 0, context_ttl:float = 0, claim_ttl:float = 60, affinity_ttl:float = 0, steal_threshold:int = 0):
         client_class = str2func(client_str)
         self.client:Client = client_class(conn_url)
         self.assignor = assignor
+        # 多topic调度，quanta为轮询时各topic每次的出队上限 {topic: n}
+        self.scheduler = assignor.scheduler(chunksize, quanta)
         self.chunksize = chunksize 
         self.retrys = retrys
         self.retry_delay = retry_delay
+        # 阻塞模式：空闲时用BRPOP/BLMPOP在所有活跃topic上等待，超时取 retrys*retry_delay
+        self.blocking = blocking
+        self.timeout = retrys*retry_delay
+        # 可靠模式：出队的任务原子地移入本worker的处理中列表，处理完后批量确认，超时未确认的任务会被重新入队
+        self.reliable = reliable
+        self.visibility_timeout = visibility_timeout
+        self.name = f"{socket.gethostname()}-{os.getpid()}"
+        self._raws = defaultdict(list)
+        self._replies = defaultdict(list)
+        self._reaped_at = 0
+        self._touched_at = time.time()
+        # 线程池模式：每个进程threads个线程并发执行同一chunk内的任务，适合释放GIL的处理器
+        self.threads = threads
+        self._executor = None
+        # 运行指标：metrics=True时定期写入 fasttq:metrics 并在 fasttq:liveness 中登记存活，metrics_sinks为额外的Sink
+        sinks = [ClientSink(self.client)] if metrics else []
+        self.metrics = Metrics(self.name, sinks+list(metrics_sinks or []), metrics_interval)
+        # 结果流式推送：有下游topic时每result_flush_size个结果或每result_flush_interval秒推送一次，result_flush_size=0时处理完整个chunk再推送
+        self.result_flush_size = result_flush_size
+        self.result_flush_interval = result_flush_interval
+        # 进程回收：处理完max_jobs个任务或RSS超过max_rss_mb后，在chunk边界退出，由Supervisor补充新进程；0为不限制
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.processed = 0
+        self.recycled = False
+        # 退避重试：失败的任务按 retry_delay*2^n（最长max_retry_delay，带随机抖动）延迟后重新入队，不在Worker内sleep；
+        # retry_backoff=False时沿用原地sleep重试
+        self.retry_backoff = retry_backoff
+        self.max_retry_delay = max_retry_delay
+        self._promote_at = 0
+        self._delayed_due = None
+        # 处理器缓存：按注册表版本号整体失效，最多每handlers_check_interval秒检查一次版本号
+        self.handlers_check_interval = handlers_check_interval
+        self._handlers = {}
+        self._handlers_version = None
+        self._handlers_checked_at = 0
+        # context缓存：before按topic构建一次，最多缓存context_cache个，创建context_ttl秒后重建；0为每个chunk调用一次before
+        self.contexts = ContextCache(context_cache, context_ttl)
+        # topic@独占模式的租约claim_ttl秒，心跳续约，worker崩溃后自动过期
+        self.claim_ttl = claim_ttl
+        # 软亲和：优先取空affinity_ttl秒内服务过的topic（0为关闭），减少在topic#xxxx之间切换，代价是调度器的公平性；
+        # 其他worker正在服务的topic，积压达到steal_threshold才分担
+        self.affinity_ttl = affinity_ttl
+        self.steal_threshold = steal_threshold
+        self._served = {}
+        self._owners = {}
+        self._heartbeat_at = 0
+        self._heartbeat_interval = min(ttl for ttl in (claim_ttl, affinity_ttl, math.inf) if ttl>0)/3
+        # 限速：注册了rate_limit的topic出队前先取得令牌，配置随处理器缓存一起刷新
+        self.limiter = RateLimiter(self.client)
 
     def len(self):
         if len(self._jobs)<1:
@@ -61,19 +176,103 @@ class Worker:
 
         return reduce(lambda x,y:x+y, [len(self._jobs[k]) for k in self._jobs])
 
+    # 导入处理器模块，返回 (handle, before, after, teardown)
+    def resolve_handlers(self, s:str):
+        handlers = str2handlers(s)
+        handle, before, after, teardown = (str2func(handlers[k]) for k in ("handle", "before", "after", "teardown"))
+        return (BatchHandler(handle) if handlers["batch"] else handle, before, after, teardown)
+
+    # 一次读取整个注册表并预先导入所有处理器模块；本机导入失败的topic跳过，用到时再报错
+    def refresh_handlers(self):
+        version, registry = self.client.get_registry()
+        handlers, limits = {}, {}
+        for topic, s in registry.items():
+            try:
+                limits[to_str(topic)] = str2handlers(s)["limits"]
+                handlers[to_str(topic)] = self.resolve_handlers(s)
+            except (ImportError, AttributeError, ValueError, SyntaxError):
+                pass
+        self._handlers, self._handlers_version = handlers, version
+        self.limiter.configure(limits)
+        self._handlers_checked_at = time.time()
+        # 重新注册的topic可能换了before，缓存的context一并失效
+        self.contexts.clear()
+
+    # 注册表版本号变化（重新注册或注销）时整体刷新缓存
+    def check_handlers(self):
+        if time.time()-self._handlers_checked_at<self.handlers_check_interval:
+            return
+        self._handlers_checked_at = time.time()
+        if self.client.get_handlers_version()!=self._handlers_version:
+            self.refresh_handlers()
+
     def load_handlers(self, topic:str):
-        topic = topic if topic.find(b"#")<0 else topic[:topic.find(b"#")]
+        topic = to_str(topic).partition("#")[0]
         if topic not in self._handlers:
-            handlers = eval(self.client.get_handlers(topic))
-            self._handlers[topic] = tuple(str2func(handle) for handle in handlers)
+            # 两次版本检查之间新注册的topic
+            s = self.client.get_handlers(topic)
+            if s is None:
+                raise LookupError(f"no handlers registered for topic {topic}")
+            self._handlers[topic] = self.resolve_handlers(s)
         return self._handlers[topic]
 
+    # 从topic取出最多chunksize个任务（限速的topic不超过持有的令牌数），可靠模式下移入处理中列表
+    def pop_jobs(self, topic:str, chunksize:int):
+        chunksize = self.limiter.clamp(topic, chunksize)
+        if chunksize<1:
+            return []
+        start = time.perf_counter()
+        if self.reliable:
+            jobs = self.client.reserve_jobs(topic, chunksize, self.name, self.visibility_timeout)
+        else:
+            jobs = self.client.get_jobs(topic, chunksize)
+        self.metrics.observe("dequeue_seconds", topic, time.perf_counter()-start)
+        return jobs
+
+    # 记录最近服务的topic，新服务的topic在下一次心跳立即登记
+    def serve(self, topic:bytes):
+        if self.affinity_ttl>0:
+            if topic not in self._served:
+                self._heartbeat_at = 0
+            self._served[topic] = time.time()
+
+    # 解码并缓存任务，可靠模式下保留原始报文用于确认
+    def add_jobs(self, topic:str, jobs:list):
+        if len(jobs)<1:
+            return
+        self.metrics.incr("dequeued", topic, len(jobs))
+        self.limiter.consume(topic, len(jobs))
+        self.serve(topic)
+        if self.reliable:
+            self._raws[topic].extend(jobs)
+        self._jobs[topic].extend(load_blob(unserialize(job), self.client) for job in jobs)
+
+    # 确认topic下已处理的任务
+    def ack_jobs(self, topic:str):
+        if self.reliable:
+            self.client.ack_jobs(topic, self._raws.pop(topic, []), self.name, self.visibility_timeout)
+
+    # 可靠模式：每visibility_timeout/3秒为持有的所有topic的任务续约，包括已出队、等待之后的chunk处理的topic
+    def touch_leases(self):
+        if self.reliable and time.time()-self._touched_at>self.visibility_timeout/3:
+            self._touched_at = time.time()
+            for topic in list(self._raws):
+                self.client.touch_jobs(topic, self.name, self.visibility_timeout)
+
+    # 定期回收租约过期的任务
+    def requeue_expired(self):
+        if self.reliable and time.time()-self._reaped_at>self.visibility_timeout/4:
+            self._reaped_at = time.time()
+            self.client.requeue_expired()
+
     def get_jobs(self, topic:str):
         retry_times = 0
         while retry_times<self.retrys:
-            jobs = self.client.get_jobs(topic, self.chunksize)
+            jobs = self.pop_jobs(topic, self.chunksize)
             if jobs is not None and len(jobs)>0:
                 return jobs
+            if self.blocking:
+                break
             retry_times+=1
             time.sleep(self.retry_delay)
         return None
@@ -81,51 +280,317 @@ class Worker:
     def get_job(self, topic:str):
         retry_times = 0
         while retry_times<self.retrys:
-            job = self.client.get_job(topic)
-            if job is not None and len(job)>0:
-                return job
+            jobs = self.pop_jobs(topic, 1)
+            if jobs is not None and len(jobs)>0:
+                return jobs[0]
+            if self.blocking:
+                break
             retry_times+=1
             time.sleep(self.retry_delay)
         return None
 
-    def load_jobs(self):
-        topics = self.client.get_topics()
-        topics_reported = self.client.get_topics_reported()
+    # 阻塞等待任意候选topic出现任务，没有活跃topic时等待所有注册的topic
+    def wait_jobs(self, topics:list, timeout:float = None):
+        if len(topics)<1:
+            topics = self.client.get_topics_registered()
+        chunksize = self.limiter.clamp_all(topics, self.chunksize if self.assignor.chunked else 1)
+        timeout = timeout or self.timeout
+        if not self.reliable:
+            topic, jobs = self.client.wait_jobs(topics, chunksize, timeout)
+            if topic is not None:
+                self.add_jobs(topic, jobs)
+        elif len(topics)==1:
+            self.add_jobs(topics[0], self.client.wait_reserve(topics[0], chunksize, timeout, self.name, self.visibility_timeout))
+        else:
+            # 多个topic无法原子地阻塞移动，可靠模式下退化为轮询
+            for _ in range(self.retrys):
+                time.sleep(self.retry_delay)
+                for topic in topics:
+                    jobs = self.pop_jobs(topic, chunksize)
+                    if len(jobs)>0:
+                        self.add_jobs(topic, jobs)
+                        return
+
+    # 按调度器的计划依次出队，每次请求一个topic的一批任务，取到的数量回传给调度器
+    def schedule(self, topics:list):
+        budget = self.chunksize-self.len()
+        if budget<1 or len(topics)<1:
+            return
+        plan = self.scheduler.plan(topics, budget)
+        try:
+            topic, n = next(plan)
+            while True:
+                jobs = self.pop_jobs(topic, n)
+                self.add_jobs(topic, jobs)
+                topic, n = plan.send(len(jobs))
+        except StopIteration:
+            pass
+
+    # 把到期的延迟任务移入任务队列，按下一个到期时间节流，最长间隔1秒
+    def promote_delayed(self):
+        now = time.time()
+        if now<self._promote_at:
+            return 0
+        n, self._delayed_due = self.client.promote_delayed()
+        self._promote_at = now+1.0 if self._delayed_due is None else min(self._delayed_due, now+1.0)
+        return n
 
-        last_priority = priority = -1
+    # 空闲时的等待时间，有未到期的延迟任务时等到下一次检查
+    def idle_timeout(self):
+        timeout = self.timeout if self.blocking else self.retry_delay
+        if self._delayed_due is None:
+            return timeout
+        return min(timeout, max(self._promote_at-time.time(), 0.01))
+
+    # 续约独占topic的租约，登记本worker最近服务过的topic并取回其他worker的亲和关系
+    def heartbeat(self):
+        now = time.time()
+        if now<self._heartbeat_at:
+            return
+        self._heartbeat_at = now+self._heartbeat_interval
+        if self._topic and not self.client.claim(self._topic, self.name, self.claim_ttl):
+            # 租约已过期并被其他worker取得
+            self._topic = None
+        if self.affinity_ttl>0:
+            self._served = {topic:at for topic, at in self._served.items() if now-at<self.affinity_ttl}
+            # 先到先得，不覆盖其他worker未过期的登记
+            mine = [topic for topic in self._served if self._owners.get(topic, self.name)==self.name]
+            self._owners = self.client.affinity(self.name, mine, self.affinity_ttl)
+
+    # 退出时释放仍归自己的亲和关系，其他worker无需等到过期
+    def release_affinity(self):
+        mine = [topic for topic in self._served if self._owners.get(topic)==self.name]
+        if len(mine)>0:
+            self.client.affinity(self.name, mine, 0)
+
+    # 软亲和：返回 (优先出队的topic, 其余可出队的topic)。
+    # 优先的是最高优先级中本worker最近服务过的topic，归属本worker的在前，其次按最近服务时间
+    def affine(self, topics:list):
+        if self.affinity_ttl<=0 or len(topics)<1:
+            return [], topics
+        others = {topic for topic, _ in topics if self._owners.get(topic, self.name)!=self.name}
+        depths = self.client.get_depths(list(others)) if self.steal_threshold>0 and len(others)>0 else {}
+        allowed = [(topic, score) for topic, score in topics if topic not in others or depths.get(topic, 0)>=self.steal_threshold]
+        if len(allowed)<1:
+            return [], []
+        top = max(score for _, score in allowed)
+        preferred = [(topic, score) for topic, score in allowed if score==top and topic in self._served]
+        preferred.sort(key=lambda item:(item[0] not in others, self._served[item[0]]), reverse=True)
+        return preferred, [item for item in allowed if item not in preferred]
+
+    # 依次取空优先的topic，不在它们之间轮转
+    def drain(self, topics:list):
+        for topic, _ in topics:
+            budget = self.chunksize-self.len()
+            if budget<1:
+                return
+            self.add_jobs(topic, self.pop_jobs(topic, budget))
+
+    def load_jobs(self):
+        self.check_handlers()
+        self.requeue_expired()
+        retry_times = 0
         while self.len()<self.chunksize: 
+            self.promote_delayed()
+            self.touch_leases()
+            self.heartbeat()
             last_len = self.len()
+            budget = self.chunksize-last_len
+            topics = list(self.client.get_topics(withscores=True))
+            topics_reported = self.client.get_topics_reported()
+            # 受限topic没有令牌而本轮跳过
+            candidates, throttled = [], False
             if self._topic:
-                jobs = self.get_jobs(self._topic)
+                throttled = len(self.limiter.acquire([(self._topic, 0)], budget))<1
+                jobs = None if throttled else self.get_jobs(self._topic)
                 if jobs is not None:
-                    for job in jobs:
-                        self._jobs[topic].append(unserialize(job))
+                    self.add_jobs(self._topic, jobs)
             else:
-                for topic in topics:
-                    if topic not in topics_reported and topic[-1]=="@":
-                        self.client.report(topic, os.getpid())
+                for topic, _ in topics:
+                    if topic not in topics_reported and to_str(topic).endswith("@") and self.client.claim(topic, self.name, self.claim_ttl):
                         self._topic = topic
+                        throttled = len(self.limiter.acquire([(topic, 0)], budget))<1
+                        self.add_jobs(topic, self.pop_jobs(topic, self.chunksize))
                         break
+                else:
+                    # topic@只由取得租约的worker处理
+                    preferred, rest = self.affine([(t, s) for t, s in topics if not to_str(t).endswith("@")])
+                    # 一次往返批量申请所有候选topic的令牌
+                    allowed = set(self.limiter.acquire(preferred+rest, budget))
+                    candidates = [item for item in preferred+rest if item in allowed]
+                    throttled = len(candidates)<len(preferred)+len(rest)
+                    self.drain([item for item in preferred if item in allowed])
+                    self.schedule([item for item in rest if item in allowed])
 
-                    if (self.assignor.value%2)==1:
-                        jobs = self.get_jobs(topic)
-                        if jobs is not None:
-                            for job in jobs:
-                                self._jobs[topic].append(unserialize(job))
-                    else:
-                        job = self.get_job(topic)
-                        if job is not None:
-                            self._jobs[topic].append(unserialize(job))
-                    
-                    if last_priority==priority or last_priority<1:
-                        continue
+            # 已经取到部分任务时不再阻塞，先处理手上的任务
+            if self.blocking and last_len == self.len() and last_len<1 and not throttled:
+                if self._topic or len(candidates)>0 or len(topics)<1:
+                    self.wait_jobs([self._topic] if self._topic else [t for t, _ in candidates], self.idle_timeout())
+                else:
+                    # 活跃topic都由其他worker服务且积压未达到窃取阈值
+                    time.sleep(self.idle_timeout())
             
             if last_len == self.len():
-                break
+                if self.len()>0:
+                    break
+                # 还有未到期的延迟任务时继续等待，不计入重试次数
+                if self._delayed_due is not None:
+                    if not self.blocking:
+                        time.sleep(self.idle_timeout())
+                    continue
+                # 限速的topic等到下一个令牌，同样不计入重试次数
+                if throttled:
+                    time.sleep(min(max(self.limiter.wait, 0.001), self.idle_timeout()))
+                    continue
+                # 所有topic都取空时按retry_delay间隔重试retrys次，阻塞模式下直接返回
+                retry_times += 1
+                if self.blocking or self._topic or retry_times>=self.retrys:
+                    break
+                time.sleep(self.retry_delay)
 
         return self._jobs
 
+    # 定期输出指标，同时采集活跃topic的队列深度
+    def flush_metrics(self, force:bool = False):
+        if not force and not self.metrics.due():
+            return
+        topics = self.client.get_topics()
+        for topic, depth in self.client.get_depths(topics).items():
+            self.metrics.gauge("queue_depth", topic, depth)
+        self.metrics.flush(force=True)
+
+    def should_recycle(self):
+        if self.max_jobs>0 and self.processed>=self.max_jobs:
+            return True
+        return self.max_rss_mb>0 and psutil.Process().memory_info().rss>=self.max_rss_mb*1024*1024
+
+    # 本chunk使用的context，没有before时使用默认context
+    def acquire_context(self, topic:bytes, before, teardown):
+        if before is None:
+            return {"_result":[], "client":self.client}
+        return self.contexts.acquire(topic, before, teardown)
+
+    # 有下游topic且没有after回调时，context["_result"]换成TopicSink，结果边处理边按批推送
+    def stream_results(self, context:dict, after):
+        if after is None and "topic" in context and type(context["_result"]) is list and self.result_flush_size>0:
+            sink = TopicSink(self.client, context["topic"], self.result_flush_size, self.result_flush_interval)
+            sink.extend(context["_result"])
+            context["_result"] = sink
+        return context
+
+    # 执行单个任务，按任务自身的retrys/retry_delay重试，返回(是否成功, 结果)；退避重试时失败返回(None, 异常)，由调用方重新入队
+    def run_job(self, topic:bytes, handle, job:dict, context:dict):
+        data, retrys, retry_delay = job["data"], int(job["retrys"]), float(job["retry_delay"])
+        retry_times, error = 0, None
+        while retry_times<retrys:
+            start = time.perf_counter()
+            try:
+                rs = resolve(handle(data, context))
+                self.metrics.observe("handler_seconds", topic, time.perf_counter()-start)
+                self.metrics.incr("succeeded", topic)
+                return True, rs
+            except Exception as e:
+                self.metrics.observe("handler_seconds", topic, time.perf_counter()-start)
+                error = e
+                retry_times +=1
+                if retry_times<retrys:
+                    self.metrics.incr("retried", topic)
+                    if self.retry_backoff:
+                        return None, error
+                    time.sleep(retry_delay)
+        self.metrics.incr("failed", topic)
+        return False, error
+
+    # 把批处理器的返回值按任务拆分为(是否成功, 结果)：整批抛出异常或某项为异常实例的任务失败，
+    # 还有重试次数的任务记为(None, 异常)，由调用方重新入队
+    def settle_batch(self, topic:bytes, jobs:list, results, error:Exception = None):
+        if error is None and (not isinstance(results, (list, tuple)) or len(results)!=len(jobs)):
+            error = ValueError(f"batch handler returned {type(results).__name__} for {len(jobs)} jobs")
+        if error is not None:
+            results = [error]*len(jobs)
+        rs = []
+        for job, r in zip(jobs, results):
+            if not isinstance(r, Exception):
+                self.metrics.incr("succeeded", topic)
+                rs.append((True, r))
+            elif int(job["retrys"])>1:
+                self.metrics.incr("retried", topic)
+                rs.append((None, r))
+            else:
+                self.metrics.incr("failed", topic)
+                rs.append((False, r))
+        return rs
+
+    # 第attempt次重试的延迟：指数退避，一半固定一半随机，避免同时失败的任务同时重试
+    def backoff(self, retry_delay:float, attempt:int):
+        delay = min(retry_delay*2**(attempt-1), self.max_retry_delay)
+        return delay/2+random.uniform(0, delay/2)
+
+    # 失败的任务单独延迟重新入队，重试次数减一，保留信封中的其他字段
+    def requeue_jobs(self, topic:bytes, jobs:list):
+        if len(jobs)<1:
+            return 0
+        raws, dues, now = [], [], time.time()
+        for job in jobs:
+            meta = {k:v for k, v in job.items() if k not in ("data", "retrys", "retry_delay")}
+            meta["attempt"] = int(job.get("attempt", 0))+1
+            # 大任务数据仍然只带引用重新入队
+            data = None if "blob" in job else job["data"]
+            raws.append(serialize(data, int(job["retrys"])-1, float(job["retry_delay"]), **meta))
+            dues.append(now+self.backoff(float(job["retry_delay"]), meta["attempt"]))
+        # 下一次load_jobs时立即检查延迟任务，避免Worker在重试任务到期前空闲退出
+        self._promote_at = 0
+        return self.client.push_delayed(topic, raws, dues)
+
+    # 一次调用批处理器处理整个chunk
+    def run_batch(self, topic:bytes, handle:BatchHandler, jobs:list, context:dict):
+        start = time.perf_counter()
+        try:
+            results, error = resolve(handle([job["data"] for job in jobs], context)), None
+        except Exception as e:
+            results, error = None, e
+        self.metrics.observe("handler_seconds", topic, time.perf_counter()-start)
+        return self.settle_batch(topic, jobs, results, error)
+
+    # 缓存FastQueue.submit提交的任务的结果，失败的任务写回异常信息
+    def add_reply(self, job:dict, ok:bool, rs):
+        try:
+            reply = serialize(rs if ok else repr(rs), id=job["id"], ok=ok)
+        except (TypeError, ValueError) as e:
+            reply = serialize(f"unserializable result: {e!r}", id=job["id"], ok=False)
+        self._replies[(job["reply"], job.get("ttl", 3600))].append(reply)
+
+    # 每个提交批次一次往返写回本chunk的结果
+    def push_replies(self):
+        while len(self._replies)>0:
+            (reply, ttl), results = self._replies.popitem()
+            self.client.push_results(reply, results, ttl)
+
+    # 执行一个chunk的任务，线程池模式下并发执行；结果按任务顺序在当前线程收集，写入context["_result"]无需加锁
+    def run_jobs(self, topic:bytes, handle, jobs:list, context:dict):
+        if isinstance(handle, BatchHandler):
+            results = self.run_batch(topic, handle, jobs, context)
+        elif self.threads>1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.threads)
+            results = self._executor.map(lambda job:self.run_job(topic, handle, job, context), jobs)
+        else:
+            results = (self.run_job(topic, handle, job, context) for job in jobs)
+
+        retries = []
+        for job, (ok, rs) in zip(jobs, results):
+            if ok:
+                context["_result"].append(rs)
+            elif ok is None:
+                retries.append(job)
+            if "reply" in job and ok is not None:
+                self.add_reply(job, ok, rs)
+            self.touch_leases()
+            self.heartbeat()
+        self.requeue_jobs(topic, retries)
+
     def work(self):
+        self.refresh_handlers()
         _retry_times = 0
         while not self._stop and _retry_times<self.retrys:
             _jobs = self.load_jobs()
@@ -136,35 +601,45 @@ class Worker:
             if len(jobs)<1:
                 time.sleep(self.retry_delay)
                 _retry_times +=1
-                # print(f"Workser({os.getpid()}): _retry_times = {_retry_times}", "#"*40)
             else:
                 _retry_times = 0
 
-            handle, before, after = self.load_handlers(topic)
+            handle, before, after, teardown = self.load_handlers(topic)
 
-            context = before(topic) if before else {"_result":[], "client":self.client}
-            for job in jobs:
-                data, retrys, retry_delay = job["data"], int(job["retrys"]), float(job["retry_delay"])
-                retry_times = 0
-                while retry_times<retrys:
-                    try:
-                        rs = handle(data, context)
-                        context["_result"].append(rs)
-                        break
-                    except:
-                        retry_times +=1
-                        time.sleep(retry_delay)
-                        # print(f"Job({os.getpid()}): _retry_times = {_retry_times}", "#"*40)
-                        continue
+            context = self.stream_results(self.acquire_context(topic, before, teardown), after)
+            self.run_jobs(topic, handle, jobs, context)
              
+            start = time.perf_counter()
+            results = context["_result"]
             if after is not None:
-                after(data, context)
-            elif "topic" in context:
-                self.client.push_topic(context["topic"], context["_result"])
+                after(jobs[-1]["data"] if len(jobs)>0 else None, context)
+            elif "topic" in context and not isinstance(results, ResultSink):
+                self.client.push_topic(context["topic"], results)
             elif "topics" in context:
                 self.client.push_topics(context["topics"])
-            # print(f"Workser({os.getpid()}): {len(context['_result'])}", "#"*40)
+            if isinstance(results, ResultSink):
+                results.flush()
+            self.push_replies()
+            self.metrics.observe("push_seconds", topic, time.perf_counter()-start)
+            self.contexts.release(topic, context, teardown)
+            self.ack_jobs(topic)
+            self.flush_metrics()
+            self.processed += len(jobs)
+            if self.should_recycle():
+                self.recycled = True
+                break
         
-        if self._topic:
-            self.client.unreport(topic)
+        self.flush_metrics(force=True)
+        try:
+            self.contexts.clear()
+        finally:
+            # teardown出错也要完成退出清理
+            self.release_affinity()
+            self.limiter.release()
+            self.client.unreport(self.name)
+            self.client.delete_metrics(self.name)
+            if self._executor is not None:
+                self._executor.shutdown()
+            if self._topic:
+                self.client.unreport(self._topic)
         
\ No newline at end of file
@@ -24,13 +24,14 @@ setup(
     author_email='2390245@qq.com',
     description='FastTQ是一款由 [德波量化](http://www.dealbot.cn) 开源的基于消息队列的多进程分布式任务调度器',
     long_description=__doc__,
-    packages=find_packages(exclude=['examples', '*.py']),
+    packages=find_packages(exclude=['examples', 'benchmarks', 'benchmarks.*', 'tests', 'tests.*', '*.py']),
     package_data={"fasttq": ["py.typed"]},
     include_package_data=True,
     zip_safe=False,
     platforms='any',
     install_requires=get_requirements(),
-    python_requires='>=3.6',
+    extras_require={"msgpack": ["msgpack>=1.0.0"]},
+    python_requires='>=3.7',
     entry_points={},
     classifiers=[
         # As from http://pypi.python.org/pypi?%3Aaction=list_classifiers
@@ -52,7 +53,6 @@ setup(
         'Operating System :: Unix',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: 3.9',
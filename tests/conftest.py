@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/08/27 10:40:16
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+conftest.py -- 测试用的Redis连接：设置FASTTQ_TEST_REDIS（逗号分隔的多个地址，如多个本地redis-server进程）时使用真实的Redis（会清空这些库），
+否则使用fakeredis（Lua脚本需要lupa），都没有时跳过
+"""
+
+from typing import List
+from redis import Redis, ConnectionPool
+import pytest
+import socket
+import os
+
+from fasttq.client import RedisClient
+from fasttq.local import LocalClient
+from fasttq.sharded import ShardedRedisClient
+
+URLS = [url.strip() for url in os.environ.get("FASTTQ_TEST_REDIS", "").split(",") if len(url.strip())>0]
+
+# n个相互独立的fakeredis实例
+def fake_pools(n:int):
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    connection_class = getattr(fakeredis, "FakeRedisConnection", None) or fakeredis.FakeConnection
+    return [ConnectionPool(connection_class=connection_class, server=fakeredis.FakeServer(version=(7, 2))) for _ in range(n)]
+
+def flush(pools:List[ConnectionPool]):
+    for pool in pools:
+        Redis(connection_pool=pool).flushdb()
+
+# fakeredis不支持INFO命令，直接给出服务端版本
+def use_fake(client:RedisClient, pools:List[ConnectionPool]):
+    client.pool = pools[0]
+    client._versions.update({pool:(7, 2) for pool in pools})
+    return client
+
+@pytest.fixture
+def client():
+    if len(URLS)>0:
+        client = RedisClient(URLS[0])
+    else:
+        client = use_fake(RedisClient("redis://fake/0"), fake_pools(1))
+    flush([client.pool])
+    yield client
+    flush([client.pool])
+
+# 返回创建分片客户端的函数：make(n)为n个实例，make(n, base)在base的实例之后追加实例，模拟扩容
+@pytest.fixture
+def make_sharded():
+    created = []
+    def make(n:int, base:ShardedRedisClient = None):
+        pools = [] if base is None else list(base.pools)
+        if len(URLS)>0:
+            if n>len(URLS):
+                pytest.skip(f"FASTTQ_TEST_REDIS需要至少{n}个地址")
+            client = ShardedRedisClient(",".join(URLS[:n]))
+            if len(pools)<1:
+                flush(client.pools)
+        else:
+            client = ShardedRedisClient(",".join(f"redis://fake{i}/0" for i in range(n)))
+            client.pools = pools+fake_pools(n-len(pools))
+            use_fake(client, client.pools)
+        created.append(client)
+        return client
+    yield make
+    for client in created:
+        flush(client.pools)
+
+# 本机空闲端口上的LocalClient，测试结束后关闭存储进程
+@pytest.fixture
+def local():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    client = LocalClient(f"local://127.0.0.1:{port}")
+    yield client
+    client.manager.shutdown()
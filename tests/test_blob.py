@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/09/10 15:42:31
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+test_blob.py -- blob存储的读写、删除和按写入时间清理
+"""
+
+import os
+import time
+import uuid
+import pytest
+
+from fasttq.blob import FileBlobStore, SharedMemoryBlobStore
+
+@pytest.fixture
+def shm_store():
+    pytest.importorskip("multiprocessing.shared_memory")
+    if not os.path.isdir(SharedMemoryBlobStore.SHM_PATH):
+        pytest.skip("需要/dev/shm枚举共享内存段")
+    store = SharedMemoryBlobStore(f"t{uuid.uuid4().hex[:6]}")
+    yield store
+    store.cleanup(-1)
+
+def age(path:str, seconds:float):
+    ts = time.time()-seconds
+    os.utime(path, (ts, ts))
+
+def test_file_cleanup(tmp_path):
+    store = FileBlobStore(str(tmp_path))
+    old, new = store.key(b"old"), store.key(b"new")
+    assert store.put(old, b"old") and store.put(new, b"new")
+    age(os.path.join(store.path, old), 100)
+    assert store.cleanup(50)==1
+    assert bytes(store.get(new))==b"new"
+    with pytest.raises(FileNotFoundError):
+        store.get(old)
+
+def test_shm_roundtrip(shm_store):
+    key = shm_store.key(b"payload")
+    assert shm_store.put(key, b"payload")
+    assert not shm_store.put(key, b"payload")
+    view = shm_store.get(key)
+    assert bytes(view)==b"payload"
+    # 视图仍在使用时删除，段立即从/dev/shm移除，视图释放后再关闭
+    assert shm_store.delete(key)==1
+    assert not os.path.exists(os.path.join(shm_store.SHM_PATH, shm_store.name(key)))
+    assert bytes(view)==b"payload"
+    del view
+    assert shm_store.delete(key)==0
+    shm_store.evict()
+    assert shm_store._closing==[]
+
+# 段不随进程退出回收，cleanup按最近一次写入删除过期的段，重复写入刷新写入时间
+def test_shm_cleanup(shm_store):
+    old, new, other = shm_store.key(b"old"), shm_store.key(b"new"), SharedMemoryBlobStore(shm_store.prefix+"x")
+    for key in (old, new):
+        shm_store.put(key, key.encode())
+        age(os.path.join(shm_store.SHM_PATH, shm_store.name(key)), 100)
+    other.put(old, b"other")
+    age(os.path.join(other.SHM_PATH, other.name(old)), 100)
+    shm_store.put(new, new.encode())
+    assert bytes(shm_store.get(old))==old.encode()
+    assert shm_store.cleanup(50)==1
+    assert bytes(shm_store.get(new))==new.encode()
+    with pytest.raises(FileNotFoundError):
+        SharedMemoryBlobStore(shm_store.prefix).get(old)
+    assert other.cleanup(50)==1
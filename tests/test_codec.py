@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/08/27 10:12:31
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+test_codec.py -- 任务信封编解码的往返测试
+"""
+
+import pytest
+
+from fasttq import codec as _codec
+from fasttq.codec import BinaryCodec, JsonCodec, msgpack, serialize, unserialize
+
+DATAS = ["文本", 0, 1.5, None, [1, "a", [2]], {"a":1, "b":[1, 2]}]
+BINARY = [BinaryCodec()]+([BinaryCodec(use_msgpack=True)] if msgpack is not None else [])
+
+# JSON信封不支持bytes
+@pytest.mark.parametrize("codec, data", [(codec, data) for codec in BINARY+[JsonCodec()] for data in DATAS]
+                         +[(codec, b"\x00\xffraw") for codec in BINARY])
+def test_roundtrip(codec, data):
+    job = unserialize(serialize(data, 3, 0.5, codec, id=7, reply="r"))
+    assert job["data"]==data
+    assert (job["retrys"], job["retry_delay"], job["id"], job["reply"])==(3, 0.5, 7, "r")
+
+# msgpack的map允许整数、bytes等非str键，解码时不能按默认的strict_map_key拒绝
+@pytest.mark.skipif(msgpack is None, reason="msgpack未安装")
+def test_msgpack_non_str_keys():
+    data = {1:"a", 2.5:[1], b"k":{3:None}, "s":True}
+    job = unserialize(serialize(data, codec=BinaryCodec(use_msgpack=True)))
+    assert job["data"]==data
+
+# 默认格式不取决于是否安装了msgpack；没有msgpack时编码要求msgpack、或解码msgpack任务都明确报错
+def test_msgpack_missing(monkeypatch):
+    assert BinaryCodec().dumps({"a":1})[0]==BinaryCodec.JSON
+    raw = BinaryCodec().pack(BinaryCodec.MSGPACK, b"\x81\xa1a\x01", 1, 0.01, {})
+    monkeypatch.setattr(_codec, "msgpack", None)
+    with pytest.raises(ImportError):
+        BinaryCodec(use_msgpack=True)
+    with pytest.raises(ImportError, match="msgpack"):
+        unserialize(raw)
+
+def test_plain_text_and_legacy_json():
+    assert unserialize("hello")=="hello"
+    assert unserialize(b'{"data":1,"retrys":2}')=={"data":1, "retrys":2}
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/09/03 09:21:14
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+test_context.py -- ContextCache的LRU淘汰、过期、使用计数和teardown
+"""
+
+import threading
+import time
+import pytest
+
+from fasttq.context import ContextCache
+
+class Recorder:
+
+    def __init__(self):
+        self.built, self.closed = [], []
+
+    def before(self, topic):
+        self.built.append(topic)
+        return {"topic":topic, "conn":object(), "_result":[]}
+
+    def teardown(self, topic, context):
+        self.closed.append(topic)
+
+def cycle(cache:ContextCache, r:Recorder, topic:str):
+    context = cache.acquire(topic, r.before, r.teardown)
+    cache.release(topic, context, r.teardown)
+    return context
+
+def test_lru():
+    cache, r = ContextCache(2), Recorder()
+    a = cycle(cache, r, "a")
+    cycle(cache, r, "b")
+    assert cycle(cache, r, "a")["conn"] is a["conn"]
+    cycle(cache, r, "c")
+    assert r.built==["a", "b", "c"] and r.closed==["b"]
+    assert len(cache)==2
+
+def test_ttl():
+    cache, r = ContextCache(4, ttl=0.05), Recorder()
+    a = cycle(cache, r, "a")
+    assert cycle(cache, r, "a")["conn"] is a["conn"]
+    time.sleep(0.06)
+    assert cycle(cache, r, "a")["conn"] is not a["conn"]
+    assert r.built==["a", "a"] and r.closed==["a"]
+
+# 每个chunk有自己的结果容器，共享before放入的数据
+def test_copy():
+    cache, r = ContextCache(2), Recorder()
+    c1 = cache.acquire("a", r.before, r.teardown)
+    c2 = cache.acquire("a", r.before, r.teardown)
+    c1["_result"].append(1)
+    assert c2["_result"]==[] and c1["conn"] is c2["conn"]
+
+# 被淘汰时仍有chunk在使用，等最后一个release后才teardown
+def test_refcount():
+    cache, r = ContextCache(1), Recorder()
+    c1 = cache.acquire("a", r.before, r.teardown)
+    c2 = cache.acquire("a", r.before, r.teardown)
+    cycle(cache, r, "b")
+    assert r.closed==[]
+    cache.release("a", c1, r.teardown)
+    assert r.closed==[]
+    cache.release("a", c2, r.teardown)
+    assert r.closed==["a"]
+    # 重复release不会再次teardown
+    cache.release("a", c2, r.teardown)
+    assert r.closed==["a"]
+
+def test_clear_in_use():
+    cache, r = ContextCache(4), Recorder()
+    c = cache.acquire("a", r.before, r.teardown)
+    cycle(cache, r, "b")
+    cache.clear()
+    assert r.closed==["b"] and len(cache)==0
+    cache.release("a", c, r.teardown)
+    assert r.closed==["b", "a"]
+
+def test_no_cache():
+    cache, r = ContextCache(0), Recorder()
+    cycle(cache, r, "a")
+    cycle(cache, r, "a")
+    assert r.built==["a", "a"] and r.closed==["a", "a"]
+
+# 个别teardown出错时其他context照常teardown，最后抛出第一个错误
+def test_clear_errors():
+    closed = []
+    def teardown(topic, context):
+        closed.append(topic)
+        if topic=="a":
+            raise ValueError(topic)
+    cache = ContextCache(4)
+    for topic in ("a", "b"):
+        cache.release(topic, cache.acquire(topic, lambda t:{}, teardown), teardown)
+    with pytest.raises(ValueError):
+        cache.clear()
+    assert closed==["a", "b"] and len(cache)==0
+
+# 一个线程反复clear，另一个线程acquire/release，每个context恰好teardown一次且不在使用中
+def test_threads():
+    cache, r = ContextCache(1), Recorder()
+    using, errors, stop = set(), [], threading.Event()
+    def teardown(topic, context):
+        if id(context) in using:
+            errors.append(topic)
+        r.teardown(topic, context)
+    def before(topic):
+        context = r.before(topic)
+        context["_id"] = id(context)
+        return context
+    def clearer():
+        while not stop.is_set():
+            cache.clear()
+            time.sleep(0.0001)
+    thread = threading.Thread(target=clearer)
+    thread.start()
+    for i in range(1000):
+        topic = "ab"[i%2]
+        c = cache.acquire(topic, before, teardown)
+        using.add(c["_id"])
+        time.sleep(0)
+        using.discard(c["_id"])
+        cache.release(topic, c, teardown)
+    stop.set()
+    thread.join()
+    cache.clear()
+    assert errors==[] and len(r.closed)==len(r.built)
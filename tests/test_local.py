@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/09/10 16:20:05
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+test_local.py -- LocalClient：存储进程的启动和authkey、出队、阻塞等待、指标清理
+"""
+
+from multiprocessing import AuthenticationError
+from urllib import parse
+import json
+import threading
+import time
+import pytest
+
+from fasttq.local import LocalClient
+
+def active(client):
+    return [topic.decode() for topic in client.get_topics()]
+
+# 没有指定authkey时随机生成并写回conn_url，用同一conn_url连接的客户端共享存储进程
+def test_start(local):
+    url = parse.urlparse(local.conn_url)
+    assert local.manager is not None and len(url.password)==32
+    other = LocalClient(local.conn_url)
+    assert other.manager is None
+    other.push_topic("t", [b"a"])
+    assert local.get_depths(["t"])=={"t":1}
+    with pytest.raises(AuthenticationError):
+        LocalClient(f"local://127.0.0.1:{url.port}")
+    with pytest.raises(AuthenticationError):
+        LocalClient(f"local://:wrong@127.0.0.1:{url.port}")
+
+def test_pop(local):
+    local.register("t", print, None, None)
+    local.push_topic("t", [b"a", b"b", b"c"])
+    assert active(local)==["t"]
+    assert local.get_jobs("t", 2)==[b"a", b"b"]
+    assert local.get_jobs("t", 5)==[b"c"]
+    assert active(local)==[]
+    assert local.get_jobs("t", 5)==[]
+
+# 阻塞等待在其他客户端推入任务后立即返回，超时返回空
+def test_wait(local):
+    assert local.wait_jobs(["t", "u"], 5, 0.05)==(None, [])
+    pusher = LocalClient(local.conn_url)
+    timer = threading.Timer(0.2, pusher.push_topic, ("u", [b"a", b"b"]))
+    timer.start()
+    start = time.time()
+    assert local.wait_jobs(["t", "u"], 5, 5)==(b"u", [b"a", b"b"])
+    assert time.time()-start<2
+    timer.join()
+
+# 过期的指标和存活状态一同清理
+def test_metrics(local):
+    for worker, ts in (("w1", time.time()), ("w2", time.time()-100)):
+        local.report_metrics(worker, json.dumps(dict(ts=ts)), json.dumps(dict(ts=ts)))
+    assert list(local.get_metrics(max_age=50))==["w1"]
+    assert list(local.store.hgetall(local.default_liveness_header))==["w1"]
+    local.delete_metrics("w1")
+    assert local.store.hgetall(local.default_liveness_header)=={}
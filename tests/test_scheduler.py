@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/09/10 17:05:48
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+test_scheduler.py -- 出队额度的分配：严格优先级、轮询、加权公平，Assignor对应的出队次数；令牌桶限流
+"""
+
+from collections import Counter
+
+from fasttq.ratelimit import RateLimiter
+from fasttq.scheduler import StrictPriority, RoundRobin, WeightedFair
+from fasttq.worker import Assignor
+
+# 按队列深度模拟出队，返回每次的 (topic, 请求数, 取到数)
+def drive(scheduler, topics, budget, depths):
+    steps, plan = [], scheduler.plan(topics, budget)
+    try:
+        topic, n = next(plan)
+        while True:
+            got = min(n, depths[topic])
+            depths[topic] -= got
+            steps.append((topic, n, got))
+            topic, n = plan.send(got)
+    except StopIteration:
+        return steps
+
+def taken(steps):
+    counts = Counter()
+    for topic, _, got in steps:
+        counts[topic] += got
+    return counts
+
+TOPICS = [("a", 2), ("b", 2), ("c", 0)]
+
+def test_strict_priority():
+    steps = drive(StrictPriority(2), TOPICS, 7, dict(a=3, b=10, c=10))
+    assert [topic for topic, _, _ in steps]==["a", "b", "a", "b"]
+    assert taken(steps)==dict(a=3, b=4)
+    steps = drive(StrictPriority(2), TOPICS, 20, dict(a=1, b=1, c=10))
+    assert taken(steps)==dict(a=1, b=1, c=10)
+
+# 广度遍历：每轮把剩余额度平分给仍有任务的topic
+def test_fair_share():
+    steps = drive(StrictPriority(0), TOPICS, 10, dict(a=10, b=10, c=10))
+    assert steps==[("a", 5, 5), ("b", 5, 5)]
+    steps = drive(StrictPriority(0), [("a", 0), ("b", 0), ("c", 0)], 10, dict(a=1, b=10, c=10))
+    # 取空的topic剩下的额度在下一轮平分
+    assert steps==[("a", 4, 1), ("b", 4, 4), ("c", 4, 4), ("b", 1, 1)]
+
+def test_round_robin():
+    scheduler = RoundRobin(2, {"c":1})
+    first = drive(scheduler, TOPICS, 5, dict(a=10, b=10, c=10))
+    second = drive(scheduler, TOPICS, 5, dict(a=10, b=10, c=10))
+    assert [topic for topic, _, _ in first]==["b", "c", "a"]
+    assert [topic for topic, _, _ in second]==["c", "a", "b"]
+    assert taken(first)==dict(a=2, b=2, c=1)
+
+# 长期看各topic的出队数与 priority+1 成正比，低优先级的topic不会被饿死
+def test_weighted_fair():
+    scheduler, counts = WeightedFair(), Counter()
+    for _ in range(100):
+        counts += taken(drive(scheduler, [("a", 3), ("b", 1), ("c", 0)], 7, dict(a=100, b=100, c=100)))
+    assert sum(counts.values())==700
+    assert abs(counts["a"]/counts["c"]-4)<0.1 and abs(counts["b"]/counts["c"]-2)<0.1
+    # 取空的topic的额度分给其他topic
+    assert taken(drive(WeightedFair(), [("a", 3), ("b", 0)], 10, dict(a=2, b=100)))==dict(a=2, b=8)
+
+# PriorityOne只有一个topic时一次出队取满额度，不再每个任务一次往返
+def test_assignor():
+    for assignor in Assignor:
+        steps = drive(assignor.scheduler(10), [("a", 0)], 10, dict(a=100))
+        assert steps==[("a", 10, 10)]
+    steps = drive(Assignor.PriorityOne.scheduler(10), TOPICS, 10, dict(a=100, b=100, c=100))
+    assert steps==[("a", 5, 5), ("b", 5, 5)]
+    steps = drive(Assignor.PriorityAll.scheduler(10), TOPICS, 10, dict(a=100, b=100, c=100))
+    assert steps==[("a", 10, 10)]
+
+# 令牌桶：按额度补足令牌，没有令牌的topic不出队，退出时归还没用完的令牌
+def test_rate_limiter(client):
+    limiter = RateLimiter(client)
+    limiter.configure({"api":dict(rate_limit=1, rate_burst=5), "free":{}})
+    topics = [(b"api#1", 0), (b"free", 0)]
+    assert limiter.acquire(topics, 10)==topics
+    assert limiter.clamp(b"api#2", 10)==5 and limiter.clamp(b"free", 10)==10
+    assert limiter.clamp_all([b"api#1", b"free"], 10)==5
+    limiter.consume(b"api#1", 3)
+    limiter.release()
+    other = RateLimiter(client)
+    other.configure({"api":dict(rate_limit=1, rate_burst=5)})
+    assert other.acquire(topics, 2)==topics and other.tokens["api"]==2
+    other.consume(b"api#1", 2)
+    assert other.acquire(topics, 5)==[(b"free", 0)] and 0<other.wait<=1
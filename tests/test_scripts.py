@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/08/27 11:05:42
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+test_scripts.py -- RedisClient的Lua脚本：出队、可靠出队/确认/回收、延迟任务、独占租约、令牌桶；以及活跃topic索引的重建、注销和指标的清理
+"""
+
+import json
+import time
+
+def active(client):
+    return [topic.decode() for topic in client.get_topics()]
+
+# POP_SCRIPT：按推入顺序出队，取空后从活跃topic索引中移除
+def test_pop(client):
+    client.register("t", print, None, None)
+    client.push_topic("t", [b"a", b"b", b"c"])
+    assert active(client)==["t"]
+    assert client.get_jobs("t", 2)==[b"a", b"b"]
+    assert active(client)==["t"]
+    assert client.get_jobs("t", 5)==[b"c"]
+    assert active(client)==[]
+    assert client.get_jobs("t", 5)==[]
+
+# 旧版本遗留的任务队列不在活跃topic索引中，rebuild_active按注册优先级补入
+def test_rebuild_active(client):
+    client.register("t", print, None, None, priority=5)
+    with client.connect() as conn:
+        conn.lpush(client.jobs_key("t#1"), b"a")
+        conn.lpush(client.jobs_key("u"), b"b")
+    assert active(client)==[]
+    assert client.rebuild_active()==2
+    assert sorted(client.get_topics(withscores=True))==[(b"t#1", 5), (b"u", 0)]
+
+# 注销时删除独占登记、租约、处理器、活跃索引和任务队列
+def test_unregister(client):
+    client.register("x@", print, None, None)
+    client.push_topic("x@", [b"a"])
+    assert client.claim("x@", "w1", 30)
+    assert client.unregister("x@")==(1, 1, 1, 1)
+    assert client.get_topics_reported()==[] and client.get_topics_registered()==[]
+    assert active(client)==[] and client.get_depths(["x@"])=={"x@":0}
+
+# RESERVE_SCRIPT/ACK_SCRIPT：任务移入处理中列表，确认后注销租约
+def test_reserve_ack(client):
+    client.push_topic("t", [b"a", b"b", b"c"])
+    jobs = client.reserve_jobs("t", 2, "w1", 30)
+    assert jobs==[b"a", b"b"]
+    processing = client.processing_key("w1", "t")
+    with client.connect() as conn:
+        assert conn.llen(processing)==2
+        assert conn.zscore(client.default_leases_header, processing)>time.time()
+    assert client.ack_jobs("t", jobs[:1], "w1", 30)==1
+    with client.connect() as conn:
+        assert conn.llen(processing)==1
+        assert conn.zscore(client.default_leases_header, processing) is not None
+    assert client.ack_jobs("t", jobs[1:], "w1", 30)==1
+    with client.connect() as conn:
+        assert conn.exists(processing)==0
+        assert conn.zscore(client.default_leases_header, processing) is None
+        assert conn.hlen(client.default_inflight_header)==0
+    assert client.get_jobs("t", 5)==[b"c"]
+
+# REAP_SCRIPT：租约过期的任务按原顺序放回出队端，先于后来推入的任务
+def test_reap(client):
+    client.register("t", print, None, None, priority=3)
+    client.push_topic("t", [b"a", b"b"])
+    assert client.reserve_jobs("t", 2, "w1", -1)==[b"a", b"b"]
+    assert active(client)==[]
+    client.push_topic("t", [b"c"])
+    assert client.requeue_expired()==2
+    assert client.get_topics(withscores=True)==[(b"t", 3)]
+    assert client.get_jobs("t", 5)==[b"a", b"b", b"c"]
+    assert client.requeue_expired()==0
+
+# PROMOTE_SCRIPT：只移入到期的延迟任务，返回下一个到期时间
+def test_promote(client):
+    now = time.time()
+    client.push_delayed("t#1", [b"due1", b"due2"], now-1)
+    client.push_delayed("t#1", [b"later"], now+60)
+    n, nxt = client.promote_delayed()
+    assert n==2 and abs(nxt-(now+60))<1
+    assert sorted(client.get_jobs("t#1", 5))==[b"due1", b"due2"]
+    assert client.count_delayed()==1
+
+# CLAIM_SCRIPT：租约未过期时其他worker取不到，过期后可以接手
+def test_claim(client):
+    assert client.claim("x@", "w1", 30)
+    assert not client.claim("x@", "w2", 30)
+    assert client.claim("x@", "w1", 30)
+    assert client.get_topics_reported()==[b"x@"]
+    assert client.claim("y@", "w1", -1)
+    assert client.get_topics_reported()==[b"x@"]
+    assert client.claim("y@", "w2", 30)
+
+# TOKEN_SCRIPT：按容量发放令牌，没有令牌时返回等待时间，归还的令牌可以再次取得
+def test_tokens(client):
+    assert client.acquire_tokens({"api":(1, 5, 10)})["api"][0]==5
+    n, wait = client.acquire_tokens({"api":(1, 5, 1)})["api"]
+    assert n==0 and 0<wait<=1
+    client.acquire_tokens({"api":(1, 5, -3)})
+    rs = client.acquire_tokens({"api":(1, 5, 10), "other":(100, 2, 1)})
+    assert rs["api"][0]==3 and rs["other"]==(1, 0.0)
+
+# worker退出时删除指标和存活状态，崩溃的worker的max_age秒后清理；存活状态不写入topic@独占登记所在的fasttq:workers
+def test_metrics(client):
+    client.claim("x@", "w1", 30)
+    for worker, ts in (("w1", time.time()), ("w2", time.time()-100)):
+        client.report_metrics(worker, json.dumps(dict(worker=worker, ts=ts)), json.dumps(dict(ts=ts)))
+    assert sorted(client.get_metrics(max_age=50))==[b"w1"]
+    assert sorted(client.get_metrics())==[b"w1"]
+    with client.connect() as conn:
+        assert conn.hkeys(client.default_liveness_header)==[b"w1"]
+        assert conn.hgetall(client.default_workers_header)=={b"x@":b"w1"}
+    client.delete_metrics("w1")
+    assert client.get_metrics()=={}
+    with client.connect() as conn:
+        assert conn.hlen(client.default_liveness_header)==0
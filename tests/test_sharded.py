@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/08/27 11:32:08
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+test_sharded.py -- 一致性哈希的重映射比例，分片客户端的出队和扩容迁移
+"""
+
+from redis import ConnectionPool
+from redis.exceptions import ConnectionError
+import pytest
+
+from fasttq.sharded import HashRing
+
+KEYS = [f"topic#{i}" for i in range(20000)]
+
+# 增加一个节点后只有约1/N的键改变归属，并且都归属新节点
+@pytest.mark.parametrize("n", [2, 3, 5])
+def test_ring_remap_fraction(n):
+    nodes = [f"redis://10.0.0.{i}:6379/0" for i in range(n+1)]
+    before, after = HashRing(nodes[:n]), HashRing(nodes)
+    moved = [key for key in KEYS if before.get(key)!=after.get(key)]
+    assert all(after.get(key)==n for key in moved)
+    assert abs(len(moved)/len(KEYS)-1/(n+1))<0.35/(n+1)
+
+def test_ring_balance():
+    ring = HashRing([f"redis://10.0.0.{i}:6379/0" for i in range(4)])
+    counts = [0]*4
+    for key in KEYS:
+        counts[ring.get(key)] += 1
+    assert max(counts)/min(counts)<1.5
+
+# 各实例上的脚本各自出队，队列深度和活跃topic跨实例合并
+def test_sharded_pop(make_sharded):
+    client = make_sharded(3)
+    topics = [f"t#{i}" for i in range(12)]
+    client.register("t", print, None, None, priority=2)
+    client.push_topics({topic:[f"{topic}-{j}".encode() for j in range(3)] for topic in topics})
+    assert len({client.shard_index(topic) for topic in topics})==3
+    assert client.get_depths(topics)=={topic:3 for topic in topics}
+    assert sorted(client.get_topics(withscores=True))==sorted((topic.encode(), 2) for topic in topics)
+    for topic in topics:
+        assert client.get_jobs(topic, 5)==[f"{topic}-{j}".encode() for j in range(3)]
+    assert client.get_topics()==[]
+
+# 扩容后迁移归属改变的任务队列，任务不丢失、顺序不变，迁移的任务在目标队列中先出队
+def test_rebalance(make_sharded):
+    old = make_sharded(2)
+    topics = [f"t#{i}" for i in range(30)]
+    old.register("t", print, None, None)
+    old.push_topics({topic:[f"{topic}-{j}".encode() for j in range(5)] for topic in topics})
+    new = make_sharded(3, old)
+    moved = [topic for topic in topics if new.shard_index(topic)!=old.shard_index(topic)]
+    assert len(moved)>0
+    new.push_topics({topic:[b"new"] for topic in moved})
+    assert new.rebuild_active()>=len(topics)
+    for topic in topics:
+        with old.connect_shard(old.shard_index(topic)) as conn:
+            assert conn.llen(new.jobs_key(topic))==(0 if topic in moved else 5)
+        assert new.get_jobs(topic, 10)==[f"{topic}-{j}".encode() for j in range(5)]+([b"new"] if topic in moved else [])
+    assert new.get_topics()==[]
+
+# 目标实例写入失败时任务留在源实例上
+def test_rebalance_keeps_source_on_failure(make_sharded):
+    old = make_sharded(2)
+    topics = [f"t#{i}" for i in range(30)]
+    old.push_topics({topic:[b"a", b"b"] for topic in topics})
+    new = make_sharded(3, old)
+    pool, new.pools[2] = new.pools[2], ConnectionPool.from_url("redis://127.0.0.1:1/0")
+    with pytest.raises(ConnectionError):
+        new.rebalance()
+    new.pools[2] = pool
+    assert old.get_depths(topics)=={topic:2 for topic in topics}
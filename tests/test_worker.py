@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+
+# @Time    :2023/09/03 10:15:27
+# @Author  :wakeblade (2390245#qq.com)
+# @version :8.1
+
+"""
+test_worker.py -- 同步Worker处理任务：普通处理器、async def处理器和批处理器，阻塞模式，可靠模式的租约续约
+"""
+
+import asyncio
+import threading
+import time
+
+from fasttq import FastQueue
+from fasttq.worker import Worker, Assignor
+
+def square(x, context):
+    return x*x
+
+async def asquare(x, context):
+    await asyncio.sleep(0)
+    return x*x
+
+async def abatch(xs, context):
+    return [x+1 for x in xs]
+
+processed = []
+
+def slow(x, context):
+    time.sleep(0.1)
+    processed.append(x)
+
+def stamp(x, context):
+    processed.append((x, time.time()))
+
+def run(client, **options):
+    Worker(client.__class__.__module__+"."+client.__class__.__name__, client.conn_url, Assignor.PriorityAll, chunksize=10, retrys=1, retry_delay=0.01, metrics=False, **options).work()
+
+def test_sync_handler(local):
+    fq = FastQueue(local)
+    fq.register("t")(square)
+    handle = fq.submit("t", range(20))
+    run(local)
+    assert sorted(handle.gather(timeout=5))==[x*x for x in range(20)]
+
+# 同步Worker也能执行async def处理器，结果是处理器的返回值而不是协程
+def test_async_handler(local):
+    fq = FastQueue(local)
+    fq.register("t")(asquare)
+    fq.register("b", batch=True)(abatch)
+    squares, incs = fq.submit("t", range(20)), fq.submit("b", range(5))
+    run(local)
+    assert sorted(squares.gather(timeout=5))==[x*x for x in range(20)]
+    assert sorted(incs.gather(timeout=5))==[1, 2, 3, 4, 5]
+
+# 阻塞模式：空闲时阻塞等待，任务推入后立即处理，而不是等到下一次轮询
+def test_blocking(local):
+    fq = FastQueue(local)
+    fq.register("t")(stamp)
+    processed.clear()
+    timer = threading.Timer(0.3, fq.push, ("t", [1]))
+    pushed_at = time.time()+0.3
+    timer.start()
+    Worker("fasttq.local.LocalClient", local.conn_url, Assignor.PriorityOne, chunksize=10, retrys=1, retry_delay=1, blocking=True, metrics=False).work()
+    timer.join()
+    assert [x for x, _ in processed]==[1]
+    assert processed[0][1]-pushed_at<0.5
+
+# 一次出队取得两个topic的任务，处理第一个topic期间另一个topic的租约也要续约，不会被回收后重复处理
+def test_reliable_touch(local):
+    fq = FastQueue(local)
+    fq.register("a")(slow)
+    fq.register("b")(slow)
+    fq.push("a", range(4))
+    fq.push("b", range(10, 16))
+    processed.clear()
+    stop = threading.Event()
+    def reap():
+        while not stop.wait(0.05):
+            local.requeue_expired()
+    reaper = threading.Thread(target=reap)
+    reaper.start()
+    try:
+        run(local, reliable=True, visibility_timeout=0.6)
+    finally:
+        stop.set()
+        reaper.join()
+    assert sorted(processed)==[0, 1, 2, 3]+list(range(10, 16))